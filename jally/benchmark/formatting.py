@@ -0,0 +1,118 @@
+"""
+Micro-benchmarks of `jally.formatting.ir.tool` text utilities against their previous implementations.
+
+Usage:
+    python -m jally.benchmark.formatting --n 100000 --repeat 5
+"""
+import argparse
+import copy
+import json
+import random
+import re
+import string
+import timeit
+from typing import Callable, Dict, List
+
+from jally.formatting.ir import tool
+
+
+def reference_flatten_list(nested_list):
+    # Previous implementation: deepcopy + `pop(0)` + list concatenation, quadratic in the input size
+    nested_list = copy.deepcopy(nested_list)
+
+    while nested_list:
+        sublist = nested_list.pop(0)
+
+        if isinstance(sublist, list):
+            nested_list = sublist + nested_list
+        else:
+            yield sublist
+
+
+def reference_format_document(s: str) -> str:
+    # Previous implementation: regex and punctuation set rebuilt on every call
+    def remove_articles(text):
+        regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+        return re.sub(regex, ' ', text)
+
+    def white_space_fix(text):
+        return ' '.join(text.split())
+
+    def remove_punc(text):
+        exclude = set(string.punctuation)
+        return ''.join(ch for ch in text if ch not in exclude)
+
+    def lower(text):
+        return text.lower()
+
+    return white_space_fix(remove_articles(remove_punc(lower(s))))
+
+
+def random_texts(n: int, words: int = 24, seed: int = 42) -> List[str]:
+    rnd = random.Random(seed)
+    vocab = ["the", "a", "an", "Book", "library", "story,", "war", "peace!", "(novel)", "author's", "Chapter-1", "and"]
+    return [" ".join(rnd.choice(vocab) for _ in range(words)) for _ in range(n)]
+
+
+def random_nested_list(n: int, seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    nested: list = []
+    stack = [nested]
+    for i in range(n):
+        r = rnd.random()
+        if r < 0.1:
+            sub: list = []
+            stack[-1].append(sub)
+            stack.append(sub)
+        elif r < 0.2 and len(stack) > 1:
+            stack.pop()
+        stack[-1].append(i)
+    return nested
+
+
+def measure(fn: Callable, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def run(n: int = 100_000, repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    texts = random_texts(n)
+    nested = random_nested_list(min(n, 20_000))
+
+    assert [reference_format_document(t) for t in texts[:1000]] == tool.format_documents(texts[:1000])
+    assert list(reference_flatten_list(nested)) == list(tool.flatten_list(nested))
+
+    cases = {
+        "flatten_list": (
+            lambda: list(reference_flatten_list(nested)),
+            lambda: list(tool.flatten_list(nested)),
+        ),
+        "format_document": (
+            lambda: [reference_format_document(t) for t in texts],
+            lambda: [tool.format_document(t) for t in texts],
+        ),
+        "format_documents": (
+            lambda: [reference_format_document(t) for t in texts],
+            lambda: tool.format_documents(texts),
+        ),
+        "get_tokens_many": (
+            lambda: [reference_format_document(t).split() for t in texts],
+            lambda: tool.get_tokens_many(texts),
+        ),
+    }
+    report = {}
+    for name, (before, after) in cases.items():
+        t_before, t_after = measure(before, repeat), measure(after, repeat)
+        report[name] = {"before_s": t_before, "after_s": t_after, "speedup": t_before / t_after}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=100_000, help="Number of strings to normalise.")
+    parser.add_argument("--repeat", type=int, default=5, help="Best of `repeat` runs is reported.")
+    args = parser.parse_args()
+    print(json.dumps(run(n=args.n, repeat=args.repeat), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""
+Retrieval benchmark: throughput, latency percentiles, memory and recall@k of jally engines and document stores.
+
+Every target answers the same query set (synthetic, or a corpus saved with `formatting.ir.io` plus a JSON-lines
+query file) at the requested concurrency. Recall@k is measured against exact search: brute-force dot product for
+dense targets, exhaustive BM25 for sparse ones. In-process targets need no server, so the default run works offline.
+
+Targets:
+    local-bm25       `ir.engine.local.LocalBM25Retriever`
+    numpy-dense      brute-force float32 dot product (the exact reference itself)
+    numpy-int8       brute-force dot product over `codec` int8-quantized vectors
+    elastic-bm25     `ir.engine.bm25.BM25Retriever` over `ElasticDocStore` (needs a server)
+    elastic-dense    `ElasticDocStore.query_by_embedding` (needs a server)
+    weaviate-dense   `WeaviateDocStore.query_by_embedding` (needs a server)
+
+Usage:
+    python -m jally.benchmark.retrieval --docs 100000 --queries 1000 --concurrency 1 4 --output report.json
+    python -m jally.benchmark.retrieval --data-dir data --filename corpus --queries-file queries.jsonl
+"""
+import abc
+import argparse
+import json
+import logging
+import platform
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from jally.formatting.ir import codec, io
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_INDEX = "jally_benchmark"
+
+
+def synthetic_corpus(
+    n_docs: int = 10_000,
+    n_queries: int = 1_000,
+    dim: int = 128,
+    doc_length: int = 60,
+    query_length: int = 4,
+    vocab_size: int = 30_000,
+    seed: int = 42,
+) -> Tuple[List[Dict], np.ndarray, List[Dict]]:
+    """
+    Documents with Zipf-distributed words and random unit embeddings. Each query takes a few words of a random
+    document and a noisy copy of its embedding, so both sparse and dense search have something to find.
+
+    :return: (documents, embedding matrix, queries) where queries are {"query": str, "embedding": np.ndarray}
+    """
+    rnd = np.random.default_rng(seed)
+    vocab = np.array([f"w{i}" for i in range(vocab_size)], dtype=object)
+    p = 1.0 / np.arange(1, vocab_size + 1)
+    words = rnd.choice(vocab_size, size=(n_docs, doc_length), p=p / p.sum())
+    texts = [" ".join(row) for row in vocab[words]]
+    embeddings = rnd.standard_normal((n_docs, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    documents = [{"id": f"doc-{i}", "text": text} for i, text in enumerate(texts)]
+
+    targets = rnd.integers(0, n_docs, size=n_queries)
+    noise = rnd.standard_normal((n_queries, dim)).astype(np.float32) * 0.05
+    queries = []
+    for j, i in enumerate(targets):
+        picked = rnd.choice(doc_length, size=query_length, replace=False)
+        query_emb = embeddings[i] + noise[j]
+        queries.append({"query": " ".join(vocab[words[i, picked]]), "embedding": query_emb / np.linalg.norm(query_emb)})
+    return documents, embeddings, queries
+
+
+def load_corpus(data_dir: str, filename: str, queries_file: str) -> Tuple[List[Dict], Optional[np.ndarray], List[Dict]]:
+    """
+    Corpus written by `formatting.ir.io.save` and a JSON-lines file of {"query": ..., "embedding": [...]} records
+    (the embedding is optional, dense targets are skipped without it).
+    """
+    with io.Corpus(data_dir, filename, embedding_field=None) as corpus:
+        documents = [
+            {"id": str(doc.get("id", i)), "text": doc.get("text", ""), "meta": doc.get("meta") or {}}
+            for i, doc in enumerate(corpus)
+        ]
+    embeddings = None
+    try:
+        with io.Corpus(data_dir, filename) as corpus:
+            embeddings = np.asarray(corpus.embeddings)
+            if corpus.scale is not None:
+                embeddings = codec.dequantize(embeddings, np.asarray(corpus.scale))
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    except FileNotFoundError:
+        logger.warning(f"No embeddings for corpus \"{filename}\", dense targets will be skipped")
+    queries = []
+    with open(queries_file, "r", encoding="utf-8") as fp:
+        for line in fp:
+            if line.strip():
+                query = json.loads(line)
+                if query.get("embedding") is not None:
+                    query["embedding"] = np.asarray(query["embedding"], dtype=np.float32)
+                queries.append(query)
+    return documents, embeddings, queries
+
+
+def top_k_rows(scores: np.ndarray, top_k: int) -> np.ndarray:
+    top_k = min(top_k, len(scores))
+    rows = np.argpartition(-scores, top_k - 1)[:top_k]
+    return rows[np.argsort(-scores[rows], kind="stable")]
+
+
+class Target(abc.ABC):
+    """
+    Something that answers queries with a ranked list of document ids.
+    """
+
+    name: str = ""
+    kind: str = "sparse"  # "sparse" targets get the query text, "dense" targets its embedding
+
+    def setup(self, documents: List[Dict], embeddings: Optional[np.ndarray]):
+        pass
+
+    @abc.abstractmethod
+    def search(self, query: Dict, top_k: int) -> List[str]:
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalBM25Target(Target):
+    name, kind = "local-bm25", "sparse"
+
+    def setup(self, documents, embeddings):
+        from jally.ir.engine.local import LocalBM25Retriever
+
+        self.retriever = LocalBM25Retriever(documents)
+
+    def search(self, query, top_k):
+        return [doc.id for doc in next(self.retriever.retrieve_top_k(query["query"], top_k=top_k))[0]]
+
+
+class NumpyDenseTarget(Target):
+    name, kind = "numpy-dense", "dense"
+
+    def setup(self, documents, embeddings):
+        self.ids = [doc["id"] for doc in documents]
+        self.embeddings = embeddings
+
+    def search(self, query, top_k):
+        return [self.ids[i] for i in top_k_rows(self.embeddings @ query["embedding"], top_k)]
+
+
+class NumpyInt8Target(NumpyDenseTarget):
+    name = "numpy-int8"
+
+    def setup(self, documents, embeddings):
+        self.ids = [doc["id"] for doc in documents]
+        self.values, self.scale = codec.quantize(embeddings, dtype="int8")
+
+    def search(self, query, top_k):
+        scores = (self.values @ query["embedding"].astype(np.float32)) * self.scale
+        return [self.ids[i] for i in top_k_rows(scores, top_k)]
+
+
+class ElasticTarget(Target):
+    def __init__(self, host: str = "localhost", port: int = 9200, batch_size: int = 10_000):
+        self.host, self.port, self.batch_size = host, port, batch_size
+
+    def setup(self, documents, embeddings):
+        from jally.ir.document_store.elastic import ElasticDocStore
+
+        dim = embeddings.shape[1] if embeddings is not None else 768
+        self.store = ElasticDocStore(host=self.host, port=self.port, index=BENCHMARK_INDEX, embedding_dim=dim)
+        self.store.delete_documents(index=BENCHMARK_INDEX)
+        rows = documents if embeddings is None else [{**d, "embedding": e} for d, e in zip(documents, embeddings)]
+        self.store.write_documents(rows, index=BENCHMARK_INDEX, batch_size=self.batch_size)
+        self.store.client.indices.refresh(index=BENCHMARK_INDEX)
+
+    def close(self):
+        self.store.client.indices.delete(index=BENCHMARK_INDEX, ignore=[404])
+
+
+class ElasticBM25Target(ElasticTarget):
+    name, kind = "elastic-bm25", "sparse"
+
+    def setup(self, documents, embeddings):
+        from jally.ir.engine.bm25 import BM25Retriever
+
+        super().setup(documents, None)
+        self.retriever = BM25Retriever(self.store)
+
+    def search(self, query, top_k):
+        response = self.retriever.retrieve_top_k(query["query"], top_k=top_k, index=BENCHMARK_INDEX)
+        return [doc.id for doc in next(response)[0]]
+
+
+class ElasticDenseTarget(ElasticTarget):
+    name, kind = "elastic-dense", "dense"
+
+    def search(self, query, top_k):
+        return [doc.id for doc in self.store.query_by_embedding(query["embedding"], top_k=top_k, index=BENCHMARK_INDEX)]
+
+
+class WeaviateDenseTarget(Target):
+    name, kind = "weaviate-dense", "dense"
+
+    def __init__(self, host: str = "http://localhost", port: int = 8080, batch_size: int = 10_000):
+        self.host, self.port, self.batch_size = host, port, batch_size
+
+    def setup(self, documents, embeddings):
+        from jally.ir.document_store.weaviate import WeaviateDocStore
+
+        self.store = WeaviateDocStore(
+            host=self.host, port=self.port, index=BENCHMARK_INDEX, embedding_dim=embeddings.shape[1], progress_bar=False
+        )
+        self.store.delete_all_documents(index=self.store.index)
+        rows = [{**d, "embedding": e} for d, e in zip(documents, embeddings)]
+        self.store.write_documents(rows, index=self.store.index, batch_size=self.batch_size)
+        # Weaviate only takes uuids, map them back to the benchmark ids
+        self.ids = {self.store._sanitize_id(d["id"], index=self.store.index): d["id"] for d in documents}
+
+    def search(self, query, top_k):
+        return [self.ids.get(doc.id, doc.id) for doc in self.store.query_by_embedding(query["embedding"], top_k=top_k)]
+
+    def close(self):
+        self.store.delete_all_documents(index=self.store.index)
+
+
+TARGETS = {
+    "local-bm25": LocalBM25Target,
+    "numpy-dense": NumpyDenseTarget,
+    "numpy-int8": NumpyInt8Target,
+    "elastic-bm25": ElasticBM25Target,
+    "elastic-dense": ElasticDenseTarget,
+    "weaviate-dense": WeaviateDenseTarget,
+}
+
+OFFLINE_TARGETS = ["local-bm25", "numpy-dense", "numpy-int8"]
+
+
+def exact_top_k(documents: List[Dict], embeddings: Optional[np.ndarray], queries: List[Dict], top_k: int) -> Dict:
+    """
+    Ground truth id lists per query for sparse (exhaustive BM25) and dense (brute-force dot product) search.
+    Sparse lists hold every document tied with the k-th best one, so they can be longer than `top_k`.
+    """
+    from jally.ir.engine.local import LocalBM25Retriever
+
+    ids = [doc["id"] for doc in documents]
+    bm25 = LocalBM25Retriever(documents)
+    truth = {"sparse": []}
+    for query in queries:
+        scores = bm25.get_scores(query["query"])
+        # BM25 ties a lot (same term counts, same lengths): any document scoring as high as the k-th one is correct
+        kth = scores[top_k_rows(scores, top_k)[-1]]
+        truth["sparse"].append([ids[i] for i in np.flatnonzero((scores >= kth) & (scores > 0))])
+    if embeddings is not None and all(q.get("embedding") is not None for q in queries):
+        matrix = np.stack([q["embedding"] for q in queries]).astype(np.float32)
+        scores = matrix @ embeddings.T
+        truth["dense"] = [[ids[i] for i in top_k_rows(row, top_k)] for row in scores]
+    return truth
+
+
+def measure(
+    target: Target, queries: List[Dict], top_k: int, concurrency: int
+) -> Tuple[List[List[str]], np.ndarray, float]:
+    """
+    Run all queries with `concurrency` clients. Returns (results, per-query latencies in seconds, wall time).
+    """
+    def timed(query):
+        start = time.perf_counter()
+        result = target.search(query, top_k)
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        results = [timed(q) for q in queries]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(timed, queries))
+    wall = time.perf_counter() - start
+    return [r for r, _ in results], np.array([t for _, t in results]), wall
+
+
+def recall_at_k(results: List[List[str]], truth: List[List[str]], top_k: int) -> float:
+    # Queries the exact search finds nothing for (e.g. no term of a sparse query is indexed) have no recall to measure
+    hits = [len(set(r[:top_k]) & set(t)) / min(top_k, len(t)) for r, t in zip(results, truth) if t]
+    return float(np.mean(hits)) if hits else 0.0
+
+
+def rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+
+
+def run(
+    targets: List[Target],
+    documents: List[Dict],
+    embeddings: Optional[np.ndarray],
+    queries: List[Dict],
+    top_k: int = 10,
+    concurrency: List[int] = (1,),
+    warmup: int = 10,
+) -> Dict:
+    truth = exact_top_k(documents, embeddings, queries, top_k)
+    report = {
+        "corpus": {
+            "documents": len(documents),
+            "queries": len(queries),
+            "dim": None if embeddings is None else int(embeddings.shape[1]),
+        },
+        "top_k": top_k,
+        "results": [],
+    }
+    for target in targets:
+        if target.kind not in truth:
+            logger.warning(f"Skipping {target.name}: queries have no embeddings")
+            continue
+        tracemalloc.start()
+        start = time.perf_counter()
+        target.setup(documents, embeddings)
+        setup_s = time.perf_counter() - start
+        _, index_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            for query in queries[:warmup]:
+                target.search(query, top_k)
+            for workers in concurrency:
+                results, latencies, wall = measure(target, queries, top_k, workers)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1_000
+                report["results"].append(
+                    {
+                        "target": target.name,
+                        "concurrency": workers,
+                        "qps": len(queries) / wall,
+                        "latency_ms": {"mean": float(latencies.mean() * 1_000), "p50": p50, "p95": p95, "p99": p99},
+                        f"recall@{top_k}": recall_at_k(results, truth[target.kind], top_k),
+                        "setup_s": setup_s,
+                        "setup_peak_mb": index_bytes / 2**20,
+                        "max_rss_mb": rss_mb(),
+                    }
+                )
+        finally:
+            target.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", nargs="+", default=OFFLINE_TARGETS, choices=sorted(TARGETS.keys()))
+    parser.add_argument("--docs", type=int, default=10_000, help="Size of the synthetic corpus.")
+    parser.add_argument("--queries", type=int, default=1_000, help="Number of synthetic queries.")
+    parser.add_argument("--dim", type=int, default=128, help="Dimension of synthetic embeddings.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", help="Directory of a corpus saved with `formatting.ir.io.save`.")
+    parser.add_argument("--filename", help="Name of the corpus in `--data-dir`.")
+    parser.add_argument("--queries-file", help="JSON-lines file of {\"query\", \"embedding\"} records.")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1], help="Numbers of concurrent clients.")
+    parser.add_argument("--elastic-host", default="localhost")
+    parser.add_argument("--elastic-port", type=int, default=9200)
+    parser.add_argument("--weaviate-host", default="http://localhost")
+    parser.add_argument("--weaviate-port", type=int, default=8080)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+    args = parser.parse_args()
+
+    if args.data_dir:
+        documents, embeddings, queries = load_corpus(args.data_dir, args.filename, args.queries_file)
+    else:
+        documents, embeddings, queries = synthetic_corpus(args.docs, args.queries, dim=args.dim, seed=args.seed)
+
+    server = {
+        "elastic-bm25": {"host": args.elastic_host, "port": args.elastic_port},
+        "elastic-dense": {"host": args.elastic_host, "port": args.elastic_port},
+        "weaviate-dense": {"host": args.weaviate_host, "port": args.weaviate_port},
+    }
+    targets = [TARGETS[name](**server.get(name, {})) for name in args.targets]
+    report = run(targets, documents, embeddings, queries, top_k=args.top_k, concurrency=args.concurrency)
+
+    payload = json.dumps(report, indent=4, default=float)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            fp.write(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from .tool import *
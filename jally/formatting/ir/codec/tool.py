@@ -0,0 +1,96 @@
+import base64
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+EMBEDDING_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "int8": np.int8,
+}
+
+# Number of decimals kept when a vector has to travel as a JSON list of numbers.
+# Shortest-repr floats rounded to the dtype precision are 3-4x shorter than `float64.tolist()`.
+JSON_DECIMALS = {
+    "float32": None,
+    "float16": 4,
+    "int8": 4,
+}
+
+INT8_MAX = 127.0
+
+
+def check_dtype(dtype: str) -> str:
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"Invalid embedding dtype \"{dtype}\". Choose one of {list(EMBEDDING_DTYPES.keys())}")
+    return dtype
+
+
+def quantize(embedding: Union[np.ndarray, list], dtype: str = "float32") -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Convert a single vector (1d) or a matrix of vectors (2d) into the storage `dtype`.
+
+    :param embedding: Vector(s) to convert.
+    :param dtype: One of `float32`, `float16` or `int8`.
+    :return: Tuple of (values, scale). `scale` is `None` for float dtypes. For `int8` it holds one float32
+             per vector (a scalar for 1d input) such that `values * scale` restores the original vector.
+    """
+    dtype = check_dtype(dtype)
+    embedding = np.asarray(embedding, dtype=np.float32)
+    if dtype != "int8":
+        return embedding.astype(EMBEDDING_DTYPES[dtype], copy=False), None
+    scale = np.abs(embedding).max(axis=-1, keepdims=True) / INT8_MAX
+    scale[scale == 0] = 1.0
+    values = np.rint(embedding / scale).astype(np.int8)
+    scale = scale[..., 0].astype(np.float32)
+    return values, scale
+
+
+def dequantize(
+    values: np.ndarray, scale: Optional[Union[np.ndarray, float]] = None, dtype: Union[str, type] = np.float32
+) -> np.ndarray:
+    """
+    Inverse of `quantize`. Float inputs are only cast (no copy if they already have the requested `dtype`).
+
+    :param values: Stored vector(s).
+    :param scale: Per-vector scale produced by `quantize` for `int8` values.
+    :param dtype: Float dtype of the returned array.
+    """
+    dtype = EMBEDDING_DTYPES[dtype] if isinstance(dtype, str) else dtype
+    values = np.asarray(values)
+    if scale is None:
+        return values.astype(dtype, copy=False)
+    scale = np.asarray(scale, dtype=np.float32)
+    return (values.astype(np.float32) * scale[..., None]).astype(dtype, copy=False)
+
+
+def to_json_list(embedding: Union[np.ndarray, list], dtype: str = "float32") -> list:
+    """
+    Compact JSON representation of a single vector for backends that only accept lists of numbers.
+    The vector keeps the precision of `dtype`, so there is no point in shipping more digits than that.
+    """
+    dtype = check_dtype(dtype)
+    decimals = JSON_DECIMALS[dtype]
+    if dtype == "int8":
+        embedding = dequantize(*quantize(embedding, dtype="int8"))
+    embedding = np.asarray(embedding, dtype=np.float32)
+    if decimals is None:
+        return embedding.tolist()
+    # float64 rounded to a few decimals has the shortest `repr`, that is what ends up in the payload
+    return np.round(embedding.astype(np.float64), decimals).tolist()
+
+
+def to_base64(values: np.ndarray) -> str:
+    """
+    Encode a (quantized) vector as a base64 string of its raw little-endian bytes.
+    """
+    values = np.asarray(values)
+    return base64.b64encode(values.astype(values.dtype.newbyteorder("<"), copy=False).tobytes()).decode("ascii")
+
+
+def from_base64(payload: Union[str, bytes], dtype: str = "float32") -> np.ndarray:
+    """
+    Decode a vector produced by `to_base64`. The result is a read-only view over the decoded buffer.
+    """
+    dtype = np.dtype(EMBEDDING_DTYPES[check_dtype(dtype)]).newbyteorder("<")
+    return np.frombuffer(base64.b64decode(payload), dtype=dtype)
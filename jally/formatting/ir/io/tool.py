@@ -1,12 +1,158 @@
+import array
 import ast
-import copy
+import hashlib
+import itertools
 import json
+import mmap
+import os
 import pathlib
-from typing import Union
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import numpy as np
-import random_name
 import simplejson
+from jally.formatting.ir import codec
+
+
+class Corpus:
+    """
+    Random-access, memory-mapped view over a corpus stored as a JSON-lines file (one record per line) and an
+    optional `<filename>_index.npy` embedding matrix holding one row per record.
+
+    Nothing is read upfront: the text file is mapped into memory, the byte offset of every record is kept in
+    `<filename>_offsets.npy` (built by a single pass on first open, only in memory if `data_dir` is read-only)
+    and the embeddings are opened with `np.load(mmap_mode="r")`, so records are decoded only when accessed and
+    embeddings are views, not copies.
+
+    >> corpus = Corpus(data_dir, "books")
+    >> corpus[42]["text"], corpus.embeddings[42]
+    >> for doc in corpus: ...
+    """
+
+    def __init__(
+        self,
+        data_dir: Union[pathlib.Path, str],
+        filename: str,
+        embedding_field: Optional[str] = "embedding",
+        load_embedding: bool = True,
+        ext: str = ".jsonl",
+        parse_meta: bool = False,
+        dequantize: bool = True,
+    ):
+        """
+        :param data_dir: Directory holding the corpus files.
+        :param filename: Name of the corpus without extension.
+        :param embedding_field: Key under which a record's embedding is exposed. `None` never attaches embeddings.
+        :param load_embedding: Whether to map `<filename>_index.npy`. If `False` the field is set to `np.nan`.
+        :param ext: Extension of the JSON-lines file.
+        :param parse_meta: Whether `meta` is stored as a python literal string and must be evaluated.
+        :param dequantize: Whether `int8` rows are scaled back to float32 on access (see `formatting.ir.codec`).
+        """
+        data_dir = pathlib.Path(data_dir)
+        self.filepath = data_dir / (filename + ext)
+        self.embedding_field = embedding_field
+        self.load_embedding = load_embedding
+        self.parse_meta = parse_meta
+        self.dequantize = dequantize
+
+        self._file = open(str(self.filepath), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # Zero-length files can't be mapped
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+
+        offsets_filepath = data_dir / (filename + "_offsets" + ".npy")
+        # `offsets[i]:offsets[i + 1]` is the i-th record, the last entry is the size of the file
+        if offsets_filepath.exists() and offsets_filepath.stat().st_mtime >= self.filepath.stat().st_mtime:
+            self.offsets = np.load(str(offsets_filepath), mmap_mode="r")
+        else:
+            self.offsets = build_offsets(self._buffer)
+            try:
+                np.save(offsets_filepath, self.offsets)
+            except OSError:
+                # read-only corpus: keep the offsets in memory, they are rebuilt on every open
+                pass
+
+        self.embeddings = None
+        self.scale = None
+        if embedding_field is not None and load_embedding:
+            self.embeddings = np.load(str(data_dir / (filename + "_index" + ".npy")), mmap_mode="r")
+            scale_filepath = data_dir / (filename + "_scale" + ".npy")
+            if scale_filepath.exists():
+                self.scale = np.load(str(scale_filepath), mmap_mode="r")
+            if len(self.embeddings) != len(self):
+                raise ValueError(
+                    f"Corpus \"{self.filepath}\" has {len(self)} records but {len(self.embeddings)} embeddings."
+                )
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(idx, slice):
+            return [self._record(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Corpus index {idx} is out of range")
+        return self._record(idx)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self._record(i)
+
+    def take(self, indices: Iterable[int]) -> List[Dict]:
+        """
+        Fetch the records at `indices` (e.g. the row ids returned by a vector search) in the given order.
+        """
+        return [self[int(i)] for i in indices]
+
+    def embedding(self, idx: int) -> np.ndarray:
+        """
+        Embedding of the `idx`-th record. Float rows are read-only views into the memory-mapped matrix.
+        """
+        row = self.embeddings[idx]
+        if self.scale is not None and self.dequantize:
+            return codec.dequantize(row, self.scale[idx])
+        return row
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+        self.embeddings = None
+        self.scale = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _record(self, idx: int) -> Dict:
+        doc = json.loads(self._buffer[self.offsets[idx] : self.offsets[idx + 1]])
+        if self.parse_meta and isinstance(doc.get("meta"), str):
+            doc["meta"] = ast.literal_eval(doc["meta"])
+        if self.embedding_field is not None:
+            doc[self.embedding_field] = self.embedding(idx) if self.embeddings is not None else np.nan
+        return doc
+
+
+def build_offsets(buffer: Union[bytes, mmap.mmap]) -> np.ndarray:
+    """
+    Byte offsets of every non-empty line of a JSON-lines buffer plus the trailing end offset.
+    """
+    offsets = array.array("q")
+    pos, size = 0, len(buffer)
+    # Skip utf-8 BOM so that the first record decodes like the others
+    if buffer[:3] == b"\xef\xbb\xbf":
+        pos = 3
+    while pos < size:
+        end = buffer.find(b"\n", pos)
+        end = size if end == -1 else end + 1
+        if buffer[pos:end].strip():
+            offsets.append(pos)
+        pos = end
+    offsets.append(size)
+    return np.frombuffer(offsets, dtype=np.int64).copy()
 
 
 def load(
@@ -14,23 +160,40 @@ def load(
     filename: str,
     embedding_field="embedding",
     load_embedding=True,
-    ext=".json",
+    ext=".jsonl",
     parse_meta: bool = False,
     lazy: bool = False,
+    dequantize: bool = True,
 ):
+    """
+    Load a corpus written by `save`. Files with `ext=".json"` are parsed as a single JSON array (legacy format),
+    anything else is read as JSON lines through `Corpus`.
+
+    :param lazy: Return the `Corpus` itself instead of a list (JSON lines only). Iterating it streams the records,
+                 use it as a context manager (or call `close`) to release the file.
+    :return: List of dicts or, if `lazy`, the `Corpus`.
+    """
     data_dir = pathlib.Path(data_dir)
+    if lazy or ext != ".json":
+        corpus = Corpus(
+            data_dir,
+            filename,
+            embedding_field=embedding_field,
+            load_embedding=load_embedding,
+            ext=ext,
+            parse_meta=parse_meta,
+            dequantize=dequantize,
+        )
+        if lazy:
+            return corpus
+        with corpus:
+            return list(corpus)
+
     db_filename = filename
     db_filepath = data_dir / (db_filename + ext)
 
     with open(str(db_filepath), "r", encoding="utf-8-sig") as j_ptr:
-        if lazy:
-            for jline in j_ptr:
-                yield json.loads(jline)
-        else:
-            docs = json.load(j_ptr)
-
-    if lazy:
-        raise StopIteration
+        docs = json.load(j_ptr)
 
     if parse_meta:
         for d in docs:
@@ -40,37 +203,217 @@ def load(
         if load_embedding:
             index_filename = filename + "_index" + ".npy"
             index_filepath = data_dir / index_filename
-            embeddings = np.load(str(index_filepath))
+            # Every document gets a view into the mapped matrix rather than its own copy
+            embeddings = np.load(str(index_filepath), mmap_mode="r")
+            scale_filepath = data_dir / (filename + "_scale" + ".npy")
+            if dequantize and scale_filepath.exists():
+                embeddings = codec.dequantize(embeddings, np.load(str(scale_filepath)))
             for iDoc, iEmb in zip(docs, embeddings):
                 iDoc[embedding_field] = iEmb
         else:
             for iDoc in docs:
                 iDoc[embedding_field] = np.nan
 
-    yield docs
+    return docs
 
 
-def save(data, data_dir: Union[str, pathlib.Path], embedding_field="embedding", save_embedding=True, ext=".json"):
-    data_dir = pathlib.Path(data_dir)
-    data_dir.parent.mkdir(parents=True, exist_ok=True)
-    db_filename = random_name.generate_name()
+class NpyAppender:
+    """
+    Append-only `.npy` file. Rows are streamed to disk as they come and the header is rewritten with the final
+    shape on `close`, so the array never has to be held in memory. The result can be opened with
+    `np.load(mmap_mode="r")` like any other `.npy` file.
+    """
 
-    db_filepath = data_dir / (db_filename + ext)
+    # Fixed header size so that rewriting it with the final shape never moves the data (numpy pads with spaces too)
+    HEADER_LEN = 128
 
-    if embedding_field is not None:
-        if save_embedding:
-            index_filename = db_filename + "_index" + ".npy"
-            index_filepath = data_dir / index_filename
-            index_data = []
-            for dic in data:
-                index_data.append(copy.deepcopy(dic[embedding_field]))
-                dic[embedding_field] = np.nan
-            np.save(index_filepath, np.array(index_data))
-        else:
-            for dic in data:
-                dic[embedding_field] = np.nan
-    else:
-        pass
+    def __init__(self, filepath: Union[str, pathlib.Path], dtype):
+        self.filepath = pathlib.Path(filepath)
+        self.dtype = np.dtype(dtype)
+        self.row_shape: Optional[tuple] = None
+        self.count = 0
+        self._file = open(str(self.filepath), "wb")
+        self._write_header()
+
+    def append(self, rows: np.ndarray):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if self.row_shape is None:
+            self.row_shape = rows.shape[1:]
+        elif rows.shape[1:] != self.row_shape:
+            raise ValueError(f"Expected rows of shape {self.row_shape} but got {rows.shape[1:]} for \"{self.filepath}\"")
+        self._file.write(np.ascontiguousarray(rows).tobytes())
+        self.count += len(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+    def _write_header(self):
+        shape = (self.count,) + (self.row_shape or ())
+        header = repr({"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": shape})
+        prefix = np.lib.format.MAGIC_PREFIX + bytes([1, 0])
+        space = self.HEADER_LEN - len(prefix) - 2
+        header = header.encode("latin1").ljust(space - 1) + b"\n"
+        if len(header) > space:
+            raise ValueError(f"Array header for shape {shape} doesn't fit into {self.HEADER_LEN} bytes")
+        self._file.write(prefix + len(header).to_bytes(2, "little") + header)
+
+
+class CorpusWriter:
+    """
+    Streams batches of dicts to disk in the format read by `Corpus`: compact JSON lines for the records,
+    `<name>_index.npy` for the embeddings (plus `<name>_scale.npy` for `int8`), `<name>_offsets.npy` and a
+    `<name>_manifest.json` describing all of it. Memory stays constant whatever the size of the corpus
+    and the input dicts are never modified.
+
+    If no `filename` is given the corpus is named after the sha1 of its content, so writing the same data
+    twice gives the same files.
+
+    >> with CorpusWriter(data_dir, embedding_dtype="float16") as writer:
+    >>     for batch in encoded_batches:
+    >>         writer.write(batch)
+    >> writer.manifest["name"]
+    """
+
+    def __init__(
+        self,
+        data_dir: Union[str, pathlib.Path],
+        filename: Optional[str] = None,
+        embedding_field: Optional[str] = "embedding",
+        save_embedding: bool = True,
+        ext: str = ".jsonl",
+        embedding_dtype: str = "float32",
+    ):
+        self.data_dir = pathlib.Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.filename = filename
+        self.embedding_field = embedding_field
+        self.save_embedding = save_embedding and embedding_field is not None
+        self.ext = ext
+        self.embedding_dtype = codec.check_dtype(embedding_dtype)
+        self.manifest: Optional[Dict] = None
+
+        # Records and vectors are hashed separately so that the digest doesn't depend on how the data was batched
+        self._sha1 = hashlib.sha1()
+        self._sha1_index = hashlib.sha1()
+        self._stem = filename if filename is not None else f".tmp-{os.getpid()}-{id(self):x}"
+        self._file = open(str(self.data_dir / (self._stem + ext)), "wb")
+        self._pos = 0
+        self._offsets = NpyAppender(self.data_dir / (self._stem + "_offsets" + ".npy"), np.int64)
+        self._index = None
+        self._scale = None
+        if self.save_embedding:
+            self._index = NpyAppender(
+                self.data_dir / (self._stem + "_index" + ".npy"), codec.EMBEDDING_DTYPES[self.embedding_dtype]
+            )
+            if self.embedding_dtype == "int8":
+                self._scale = NpyAppender(self.data_dir / (self._stem + "_scale" + ".npy"), np.float32)
+
+    def write(self, batch: Iterable[Dict]) -> int:
+        """
+        Append a batch of records. Returns the number of records written so far.
+        """
+        offsets, lines, embeddings = [], [], []
+        for doc in batch:
+            record = {k: v for k, v in doc.items() if k != self.embedding_field}
+            line = simplejson.dumps(record, ensure_ascii=False, separators=(",", ":"), ignore_nan=True)
+            line = line.encode("utf-8") + b"\n"
+            offsets.append(self._pos)
+            lines.append(line)
+            self._pos += len(line)
+            if self.save_embedding:
+                embeddings.append(doc[self.embedding_field])
+        if not lines:
+            return self._offsets.count
+
+        chunk = b"".join(lines)
+        self._file.write(chunk)
+        self._sha1.update(chunk)
+        self._offsets.append(np.asarray(offsets, dtype=np.int64))
+        if self.save_embedding:
+            values, scale = codec.quantize(np.stack(embeddings), dtype=self.embedding_dtype)
+            self._index.append(values)
+            self._sha1_index.update(np.ascontiguousarray(values).tobytes())
+            if scale is not None:
+                self._scale.append(scale)
+        return self._offsets.count
+
+    def close(self) -> Dict:
+        """
+        Finalize all files and write the manifest. Returns the manifest.
+        """
+        if self.manifest is not None:
+            return self.manifest
+        count = self._offsets.count
+        # `Corpus` expects the end of the file as the trailing offset
+        self._offsets.append(np.asarray([self._pos], dtype=np.int64))
+        self._file.close()
+        for appender in (self._offsets, self._index, self._scale):
+            if appender is not None:
+                appender.close()
+
+        if self._index is not None:
+            self._sha1.update(self._sha1_index.digest())
+        name = self.filename if self.filename is not None else "corpus-" + self._sha1.hexdigest()[:16]
+        files = {"records": name + self.ext, "offsets": name + "_offsets" + ".npy"}
+        if self._index is not None:
+            files["index"] = name + "_index" + ".npy"
+        if self._scale is not None:
+            files["scale"] = name + "_scale" + ".npy"
+        if name != self._stem:
+            for key, target in files.items():
+                os.replace(self.data_dir / target.replace(name, self._stem, 1), self.data_dir / target)
+
+        self.manifest = {
+            "name": name,
+            "count": count,
+            "embedding_field": self.embedding_field if self.save_embedding else None,
+            "embedding_dim": int(self._index.row_shape[0]) if self._index is not None and self._index.row_shape else None,
+            "embedding_dtype": self.embedding_dtype if self.save_embedding else None,
+            "sha1": self._sha1.hexdigest(),
+            "files": files,
+        }
+        with open(str(self.data_dir / (name + "_manifest" + ".json")), "w", encoding="utf-8") as j_ptr:
+            json.dump(self.manifest, j_ptr, indent=4)
+        return self.manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def save(
+    data: Iterable[Dict],
+    data_dir: Union[str, pathlib.Path],
+    embedding_field="embedding",
+    save_embedding=True,
+    ext=".jsonl",
+    embedding_dtype: str = "float32",
+    filename: Optional[str] = None,
+    batch_size: int = 10_000,
+) -> str:
+    """
+    Write `data` as a corpus readable by `load`/`Corpus` (see `CorpusWriter`). `data` may be any iterable, it is
+    consumed in batches of `batch_size` and left untouched.
 
-    with open(str(db_filepath), 'w', encoding='utf-8-sig') as j_ptr:
-        simplejson.dump(data, j_ptr, indent=4, ensure_ascii=False, ignore_nan=True)
+    :return: Name of the written corpus, to be passed as `filename` to `load`.
+    """
+    with CorpusWriter(
+        data_dir,
+        filename=filename,
+        embedding_field=embedding_field,
+        save_embedding=save_embedding,
+        ext=ext,
+        embedding_dtype=embedding_dtype,
+    ) as writer:
+        it = iter(data)
+        batch = list(itertools.islice(it, batch_size))
+        while batch:
+            writer.write(batch)
+            batch = list(itertools.islice(it, batch_size))
+    return writer.manifest["name"]
@@ -1 +1,2 @@
 from .tool import *
+from .dedup import *
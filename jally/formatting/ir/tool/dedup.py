@@ -0,0 +1,189 @@
+import logging
+from typing import Dict, Generator, Iterable, List, Optional, Union
+
+import mmh3
+import numpy as np
+from jally.formatting.ir.tool.tool import format_documents, get_batches_from_generator
+from jally.ir.document_store import base
+
+logger = logging.getLogger(__name__)
+
+# MinHash permutations are computed like in `datasketch`: (a * h + b) mod p over 32-bit shingle hashes
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+HASH128 = np.dtype([("hi", "<u8"), ("lo", "<u8")])
+
+
+class HashSet:
+    """
+    Compact set of 64 or 128 bit hashes: 8 (16) bytes per key instead of a Python int in a `set`.
+
+    Keys live in a few sorted numpy runs that are merged as they grow (like an LSM tree), so membership
+    tests and inserts are vectorised over whole batches and cost O(log n) per key.
+    """
+
+    def __init__(self, bits: int = 64):
+        if bits not in (64, 128):
+            raise ValueError(f"HashSet supports 64 or 128 bit keys, got {bits}")
+        self.dtype = np.dtype(np.uint64) if bits == 64 else HASH128
+        self._runs: List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self._runs)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(run.nbytes for run in self._runs)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        keys = np.asarray(keys, dtype=self.dtype)
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self._runs:
+            idx = np.searchsorted(run, keys)
+            hit = idx < len(run)
+            hit[hit] = run[idx[hit]] == keys[hit]
+            found |= hit
+        return found
+
+    def add(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Insert `keys`. Returns a mask that is `True` for keys that were not in the set before,
+        counting only the first occurrence of keys repeated within `keys`.
+        """
+        keys = np.asarray(keys, dtype=self.dtype)
+        new = np.zeros(len(keys), dtype=bool)
+        if len(keys) == 0:
+            return new
+        unique, first = np.unique(keys, return_index=True)
+        new[first] = ~self.contains(unique)
+        self._runs.append(unique[new[first]])
+        # Keep run sizes geometrically decreasing so that there are O(log n) runs to probe
+        while len(self._runs) > 1 and len(self._runs[-1]) * 2 >= len(self._runs[-2]):
+            last = self._runs.pop()
+            self._runs[-1] = np.sort(np.concatenate([self._runs[-1], last]))
+        return new
+
+
+class Deduplicator:
+    """
+    Streaming de-duplication of raw dicts, `Document` objects or `DocumentBatch` rows.
+
+    Exact mode keys every document on its id (the given `id`, or the hash of `id_hash_keys` like `Document` does)
+    and remembers one 64/128 bit hash per unique document in a `HashSet`.
+
+    Near-duplicate mode additionally computes a MinHash signature over word shingles of the normalised text and
+    drops a document if any of its LSH bands was seen before. With `num_perm` permutations split into `bands`
+    bands of `r` rows, documents above a Jaccard similarity of roughly `(1 / bands) ** (1 / r)` collide
+    (~0.7 by default), which catches reprinted descriptions with small edits. Only band hashes are kept, so memory
+    stays at `bands * 8` bytes per document whatever the text length.
+
+    >> dedup = Deduplicator(near_duplicates=True)
+    >> store.write_documents(list(dedup(docs)))
+    """
+
+    def __init__(
+        self,
+        id_hash_keys: Optional[List[str]] = None,
+        field_map: Dict[str, str] = {},
+        bits: int = 64,
+        near_duplicates: bool = False,
+        num_perm: int = 128,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 1,
+    ):
+        """
+        :param id_hash_keys: Fields ("text" and/or meta keys) identifying a document, see `base.get_id_key`.
+        :param field_map: Store field map, used to find the text of dicts with a custom content field.
+        :param bits: Size of the exact hashes, 64 or 128.
+        :param near_duplicates: Whether to also drop near-duplicates (MinHash/LSH).
+        :param num_perm: Number of MinHash permutations, must be a multiple of `bands`.
+        :param bands: Number of LSH bands.
+        :param shingle_size: Number of words per shingle.
+        :param seed: Seed of the MinHash permutations.
+        """
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm={num_perm} must be a multiple of bands={bands}")
+        self.id_hash_keys = id_hash_keys
+        self.field_map = field_map
+        self.bits = bits
+        self.near_duplicates = near_duplicates
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+
+        self.seen = HashSet(bits=bits)
+        self.band_tables = [HashSet(bits=64) for _ in range(bands)] if near_duplicates else []
+        rnd = np.random.RandomState(seed)
+        self._a = rnd.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self._b = rnd.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def __call__(
+        self, documents: Iterable[Union[dict, base.Document]], batch_size: int = 10_000
+    ) -> Generator[Union[dict, base.Document], None, None]:
+        """
+        Lazily yield the documents not seen before, in input order.
+        """
+        for batch in get_batches_from_generator(documents, batch_size):
+            keys = base.get_ids(batch, id_hash_keys=self.id_hash_keys, field_map=self.field_map)
+            texts = [self._text(doc) for doc in batch] if self.near_duplicates else None
+            keep = self.add(keys, texts)
+            yield from (doc for doc, k in zip(batch, keep) if k)
+
+    def dedup_batch(self, batch: base.DocumentBatch) -> base.DocumentBatch:
+        """
+        Rows of `batch` not seen before.
+        """
+        keys = [str(_id) for _id in batch.id]
+        keep = self.add(keys, list(batch.text) if self.near_duplicates else None)
+        return batch.take(np.flatnonzero(keep))
+
+    def add(self, keys: List[str], texts: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Register a batch of documents given by their ids (and text for near-duplicate mode).
+        Returns the mask of documents to keep.
+        """
+        keep = self.seen.add(self._hash_keys(keys))
+        if self.near_duplicates and keep.any():
+            rows = np.flatnonzero(keep)
+            words = [text.split() for text in format_documents([texts[i] for i in rows])]
+            # Texts without any word would all share one shingle, they are deduplicated by id only
+            has_words = np.fromiter((bool(w) for w in words), dtype=bool, count=len(words))
+            rows = rows[has_words]
+            if len(rows) == 0:
+                return keep
+            near = np.zeros(len(rows), dtype=bool)
+            band_keys = self._band_hashes(self._signatures([w for w in words if w]))
+            for table, column in zip(self.band_tables, band_keys.T):
+                near |= ~table.add(column)
+            keep[rows[near]] = False
+        return keep
+
+    def _text(self, doc: Union[dict, base.Document]) -> str:
+        if isinstance(doc, base.Document):
+            return doc.text or ""
+        text_key = next((k for k, v in self.field_map.items() if v == "text"), "text")
+        return doc.get(text_key) or ""
+
+    def _hash_keys(self, keys: List[str]) -> np.ndarray:
+        if self.bits == 64:
+            return np.fromiter((mmh3.hash64(k, signed=False)[0] for k in keys), dtype=np.uint64, count=len(keys))
+        return np.array([mmh3.hash64(k, signed=False) for k in keys], dtype=np.uint64).view(HASH128).reshape(-1)
+
+    def _signatures(self, documents: List[List[str]]) -> np.ndarray:
+        signatures = np.empty((len(documents), self.num_perm), dtype=np.uint64)
+        n = self.shingle_size
+        for i, words in enumerate(documents):
+            shingles = {" ".join(words[j : j + n]) for j in range(max(len(words) - n + 1, 1))}
+            hv = np.fromiter((mmh3.hash(s, signed=False) for s in shingles), dtype=np.uint64, count=len(shingles))
+            phv = ((hv[:, None] * self._a + self._b) % MERSENNE_PRIME) & MAX_HASH
+            signatures[i] = phv.min(axis=0)
+        return signatures
+
+    def _band_hashes(self, signatures: np.ndarray) -> np.ndarray:
+        rows = self.num_perm // self.bands
+        bands = np.ascontiguousarray(signatures).reshape(len(signatures), self.bands, rows)
+        return np.array(
+            [[mmh3.hash64(band.tobytes(), signed=False)[0] for band in doc] for doc in bands], dtype=np.uint64
+        ).reshape(len(signatures), self.bands)
@@ -0,0 +1,32 @@
+import unittest
+
+from jally.formatting.ir.tool.dedup import Deduplicator
+from jally.formatting.ir.tool.tool import get_unique_docs
+from jally.ir.document_store import base
+
+
+class GetUniqueDocsTest(unittest.TestCase):
+    def test_document_and_dict_with_same_text_are_duplicates(self):
+        docs = get_unique_docs([base.Document(text="x"), {"text": "x"}], {})
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0].id, base.Document(text="x").id)
+
+    def test_given_id_does_not_collide_with_text(self):
+        docs = get_unique_docs([{"id": "foo", "text": "a"}, {"text": "foo"}], {})
+        self.assertEqual([d.text for d in docs], ["a", "foo"])
+        self.assertEqual(len({d.id for d in docs}), 2)
+
+
+class NearDuplicatesTest(unittest.TestCase):
+    def test_empty_texts_are_not_near_duplicates(self):
+        docs = [{"id": "a", "text": ""}, {"id": "b", "text": "   "}, {"id": "c", "text": "?!"}, {"id": "a", "text": ""}]
+        self.assertEqual([d["id"] for d in Deduplicator(near_duplicates=True)(docs)], ["a", "b", "c"])
+
+    def test_edited_copy_is_a_near_duplicate(self):
+        text = " ".join(f"word{i}" for i in range(200))
+        docs = [{"id": "a", "text": text}, {"id": "b", "text": text + " one more"}, {"id": "c", "text": "other"}]
+        self.assertEqual([d["id"] for d in Deduplicator(near_duplicates=True)(docs)], ["a", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
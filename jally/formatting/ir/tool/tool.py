@@ -1,9 +1,8 @@
-import copy
 import itertools
 import logging
 import re
 import string
-from typing import Callable, Dict, List, Union
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 from jally.ir.document_store import base
@@ -12,14 +11,19 @@ from more_itertools import windowed
 logger = logging.getLogger(__name__)
 
 
-def get_unique_docs(data: List[Union[dict, base.Document]], field_map: dict) -> List[base.Document]:
+def get_unique_docs(
+    data: List[Union[dict, base.Document]], field_map: dict, id_hash_keys: Optional[List[str]] = None
+) -> List[base.Document]:
+    """
+    Exact de-duplication of `data` by document id, see `dedup.Deduplicator` for streaming and near-duplicate modes.
+    """
+    from jally.formatting.ir.tool.dedup import Deduplicator
+
     docs = []
-    buffer = set()
-    for doc in data:
-        doc = base.Document.from_dict(doc, field_map=field_map) if isinstance(doc, dict) else doc
-        if doc.id in buffer:
-            continue
-        buffer.add(doc.id)
+    # Only the survivors are turned into `Document` objects
+    for doc in Deduplicator(id_hash_keys=id_hash_keys, field_map=field_map)(data):
+        if isinstance(doc, dict):
+            doc = base.Document.from_dict(doc, field_map=field_map, id_hash_keys=id_hash_keys)
         docs.append(doc)
     return docs
 
@@ -32,15 +36,16 @@ def flatten_list(nested_list):
     >> list(flatten_list([[1, 2], 3]))
     [1, 2, 3]
     """
-    nested_list = copy.deepcopy(nested_list)
-
-    while nested_list:
-        sublist = nested_list.pop(0)
-
-        if isinstance(sublist, list):
-            nested_list = sublist + nested_list
+    # Stack of iterators over the lists being walked: linear time and nothing gets copied
+    stack = [iter(nested_list)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, list):
+                stack.append(iter(item))
+                break
+            yield item
         else:
-            yield sublist
+            stack.pop()
 
 
 def get_batches_from_generator(iterable, n):
@@ -60,67 +65,182 @@ def chunked_dict(dictionary, size):
         yield {k: dictionary[k] for k in itertools.islice(it, size)}
 
 
-def chunk(
-    document: Union[dict, base.Document],
-    chunk_length: int = 184,
-    chunk_overlap: int = 64,
-    on_dot: bool = True,
-    _nlp: Callable = None,
-) -> List[dict]:
-    """
-    :param document:
-    :return: List[Document]
+def pack_sentences(counts: List[int], chunk_length: int, chunk_overlap: int) -> List[List[int]]:
     """
+    Greedily pack consecutive sentences into chunks of at most `chunk_length` units (words, tokens...),
+    repeating the trailing sentences of a chunk, up to `chunk_overlap` units, at the start of the next one.
 
-    def wrap_return(txt: List[str]) -> List[dict]:
-        documents = []
-        for i, txt in enumerate(txt_chunks):
-            doc = copy.deepcopy(document)
-            doc["text"] = txt
-            if "meta" not in doc.keys() or doc["meta"] is None:
-                doc["meta"] = {}
-            doc["meta"]["chunk_id"] = i
-            documents.append(doc)
-        return documents
-
-    if isinstance(document, base.Document):
-        document = document.to_dict()
-    text = document['text']
-    sents = _nlp(text).sents
-    if not on_dot:
-        result = []
-        segments = list([w for s in sents for w in s.text.split()])
-        for seg in windowed(segments, n=chunk_length, step=chunk_length - chunk_overlap):
-            result.append(' '.join(list(seg)))
-        return wrap_return(result)
-    word_cnt = 0
+    :param counts: Size of every sentence, in the same unit as `chunk_length` and `chunk_overlap`.
+    :return: Indices of the sentences making up each chunk.
+    """
     chunks = []
-    cur_chunk = []
-    for sen in sents:
-        cur_word_cnt = len(sen.text.split())
-        if cur_word_cnt > chunk_length:
-            logger.warning(f'Sentence \"{sen}\" contains {str(cur_word_cnt)} words. which is more than {str(chunk_length)}.')
+    cur_chunk: List[int] = []
+    word_cnt = 0
+    for i, cur_word_cnt in enumerate(counts):
         if word_cnt + cur_word_cnt > chunk_length:
             if len(cur_chunk) > 0:
                 chunks.append(cur_chunk)
             overlap = []
             cnt = 0
             for candidate in reversed(cur_chunk):
-                seq_len = len(candidate.split())
-                if cnt + seq_len < chunk_overlap:
+                if cnt + counts[candidate] < chunk_overlap:
                     overlap.append(candidate)
-                    cnt += seq_len
+                    cnt += counts[candidate]
                 else:
                     break
             cur_chunk = list(reversed(overlap))
             word_cnt = cnt
-        cur_chunk.append(str(sen))
+        cur_chunk.append(i)
         word_cnt += cur_word_cnt
     if cur_chunk:
         chunks.append(cur_chunk)
-    txt_chunks = [' '.join(_chunk) for _chunk in chunks]
+    return chunks
+
+
+def _chunk_sentences(sents: List[str], chunk_length: int, chunk_overlap: int, on_dot: bool) -> List[str]:
+    words = [s.split() for s in sents]
+    if not on_dot:
+        segments = [w for ws in words for w in ws]
+        # `windowed` pads the last window with `None`
+        return [
+            ' '.join(w for w in seg if w is not None)
+            for seg in windowed(segments, n=chunk_length, step=chunk_length - chunk_overlap)
+            if seg and seg[0] is not None
+        ]
+    counts = [len(ws) for ws in words]
+    for sen, cur_word_cnt in zip(sents, counts):
+        if cur_word_cnt > chunk_length:
+            logger.warning(f'Sentence \"{sen}\" contains {str(cur_word_cnt)} words. which is more than {str(chunk_length)}.')
+    return [' '.join(sents[i] for i in _chunk) for _chunk in pack_sentences(counts, chunk_length, chunk_overlap)]
+
+
+def _chunk_tokens(
+    text: str, sent_spans: List[Tuple[int, int]], offsets: np.ndarray, budget: int, overlap: int
+) -> List[str]:
+    """
+    Pack sentences into chunks of at most `budget` tokens with `overlap` tokens of trailing sentences repeated.
+    Sentences longer than `budget` are cut at token boundaries so nothing gets truncated by the encoder.
+
+    :param sent_spans: (start_char, end_char) of every sentence of `text`.
+    :param offsets: (start_char, end_char) of every token of `text`, as returned by a fast tokenizer.
+    """
+    if len(offsets) == 0:
+        return []
+    # Sentence i owns the tokens [bounds[i], bounds[i + 1])
+    bounds = np.searchsorted(offsets[:, 0], [start for start, _ in sent_spans] + [len(text)])
+    bounds[-1] = len(offsets)
+    units = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if hi - lo <= budget:
+            if hi > lo:
+                units.append((lo, hi))
+            continue
+        logger.warning(f"Sentence of {hi - lo} tokens exceeds the budget of {budget} tokens and is split.")
+        step = max(budget - overlap, 1)
+        for piece in range(lo, hi, step):
+            units.append((piece, min(piece + budget, hi)))
+            if piece + budget >= hi:
+                break
+    counts = [hi - lo for lo, hi in units]
+    return [
+        text[offsets[units[_chunk[0]][0], 0] : offsets[units[_chunk[-1]][1] - 1, 1]]
+        for _chunk in pack_sentences(counts, budget, overlap)
+    ]
+
+
+def _token_offsets(tokenizer: Callable, texts: List[str]) -> List[np.ndarray]:
+    encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, return_attention_mask=False)
+    return [np.asarray(o, dtype=np.int64).reshape(-1, 2) for o in encoded["offset_mapping"]]
+
+
+def _wrap_chunks(document: dict, txt_chunks: List[str]) -> List[dict]:
+    # Shallow copies: chunks share every field of `document` but the text and the (copied) meta
+    meta = document.get("meta") or {}
+    return [{**document, "text": txt, "meta": {**meta, "chunk_id": i}} for i, txt in enumerate(txt_chunks)]
 
-    return wrap_return(txt_chunks)
+
+def chunk(
+    document: Union[dict, base.Document],
+    chunk_length: int = 184,
+    chunk_overlap: int = 64,
+    on_dot: bool = True,
+    _nlp: Callable = None,
+    tokenizer: Optional[Callable] = None,
+) -> List[dict]:
+    """
+    :param document:
+    :param tokenizer: Fast (offset mapping capable) tokenizer of the encoder, e.g. `IProcessor.query_tokenizer`.
+                      If given, `chunk_length` is the encoder's max sequence length (special tokens included) and
+                      `chunk_overlap` is counted in tokens, so every chunk fits the encoder exactly.
+    :return: List[Document]
+    """
+    if isinstance(document, base.Document):
+        document = document.to_dict()
+    sdoc = _nlp(document['text'])
+    if tokenizer is not None:
+        budget = chunk_length - tokenizer.num_special_tokens_to_add()
+        spans = [(sen.start_char, sen.end_char) for sen in sdoc.sents]
+        offsets = _token_offsets(tokenizer, [document['text']])[0]
+        return _wrap_chunks(document, _chunk_tokens(document['text'], spans, offsets, budget, chunk_overlap))
+    sents = [sen.text for sen in sdoc.sents]
+    return _wrap_chunks(document, _chunk_sentences(sents, chunk_length, chunk_overlap, on_dot))
+
+
+def sentencizer(_nlp: Callable) -> Tuple[Callable, List[str]]:
+    """
+    The cheapest pipeline able to split sentences for the language of `_nlp`: its own rule-based `sentencizer`
+    with every other component disabled or, if it has none, a blank pipeline with just a sentencizer.
+
+    :return: Tuple of the pipeline and the names of the components to disable when calling `pipe`.
+    """
+    if "sentencizer" in _nlp.pipe_names:
+        return _nlp, [name for name in _nlp.pipe_names if name != "sentencizer"]
+    import spacy
+
+    nlp = spacy.blank(_nlp.lang)
+    nlp.add_pipe("sentencizer")
+    return nlp, []
+
+
+def chunk_many(
+    documents: Iterable[Union[dict, base.Document]],
+    chunk_length: int = 184,
+    chunk_overlap: int = 64,
+    on_dot: bool = True,
+    _nlp: Callable = None,
+    batch_size: int = 256,
+    n_process: int = 1,
+    tokenizer: Optional[Callable] = None,
+) -> Generator[dict, None, None]:
+    """
+    Corpus-level `chunk`. Documents are streamed through `nlp.pipe` with only a sentencizer enabled
+    (see `sentencizer`), so sentence splitting runs in batches and across `n_process` processes.
+
+    :param documents: Any iterable of dicts or `Document` objects, consumed lazily.
+    :param batch_size: Number of texts per `nlp.pipe` batch.
+    :param n_process: Number of processes spaCy splits sentences with.
+    :param tokenizer: Budget chunks in encoder tokens instead of words, see `chunk`. Texts are tokenized
+                      `batch_size` at a time.
+    :return: Generator of chunk dicts in the order of `documents`.
+    """
+    nlp, disable = sentencizer(_nlp)
+    docs, texts = itertools.tee(d.to_dict() if isinstance(d, base.Document) else d for d in documents)
+    # Only the texts are piped (and pickled to the workers when n_process > 1), the documents are buffered
+    # by `tee` in this process and zipped back in order, as `nlp.pipe` yields in input order
+    sdocs = nlp.pipe((d["text"] for d in texts), batch_size=batch_size, n_process=n_process, disable=disable)
+    pipe = zip(sdocs, docs)
+    if tokenizer is None:
+        for sdoc, document in pipe:
+            sents = [sen.text for sen in sdoc.sents]
+            yield from _wrap_chunks(document, _chunk_sentences(sents, chunk_length, chunk_overlap, on_dot))
+        return
+
+    budget = chunk_length - tokenizer.num_special_tokens_to_add()
+    for batch in get_batches_from_generator(pipe, batch_size):
+        all_offsets = _token_offsets(tokenizer, [document["text"] for _, document in batch])
+        for (sdoc, document), offsets in zip(batch, all_offsets):
+            spans = [(sen.start_char, sen.end_char) for sen in sdoc.sents]
+            yield from _wrap_chunks(document, _chunk_tokens(document["text"], spans, offsets, budget, chunk_overlap))
 
 
 def format_to_str(arg: Union[Union[Union[str, Dict], base.Document], List[str]]) -> str:
@@ -130,26 +250,28 @@ def format_to_str(arg: Union[Union[Union[str, Dict], base.Document], List[str]])
     return arg["text"]
 
 
-def format_document(s: str) -> List[str]:
+ARTICLES_RE = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+# Glues a batch into one string so that lowering, punctuation and article removal run once over the whole batch
+BATCH_SEPARATOR = '\x00'
+
+
+def format_document(s: str) -> str:
     """
     Lower text and remove punctuation, articles and extra whitespace.
     """
+    return ' '.join(ARTICLES_RE.sub(' ', s.lower().translate(PUNCTUATION_TABLE)).split())
 
-    def remove_articles(text):
-        regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-        return re.sub(regex, ' ', text)
-
-    def white_space_fix(text):
-        return ' '.join(text.split())
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
-
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+def format_documents(batch: List[str]) -> List[str]:
+    """
+    `format_document` over a list of strings.
+    """
+    joined = BATCH_SEPARATOR.join(batch)
+    if joined.count(BATCH_SEPARATOR) != max(len(batch) - 1, 0):
+        return [format_document(s) for s in batch]
+    joined = ARTICLES_RE.sub(' ', joined.lower().translate(PUNCTUATION_TABLE))
+    return [' '.join(s.split()) for s in joined.split(BATCH_SEPARATOR)] if batch else []
 
 
 def get_tokens(s: str) -> List[str]:
@@ -158,11 +280,26 @@ def get_tokens(s: str) -> List[str]:
     return format_document(s).split()
 
 
+def get_tokens_many(batch: List[str]) -> List[List[str]]:
+    """
+    `get_tokens` over a list of strings.
+    """
+    return [s.split() for s in format_documents([s or '' for s in batch])]
+
+
 def elastic_query_api(
-    query_emb: np.ndarray, top_k: int = 10, embedding_field="embedding", similarity="dot_product", mode: str = "strict"
+    query_emb: np.ndarray,
+    top_k: int = 10,
+    embedding_field="embedding",
+    similarity="dot_product",
+    mode: str = "strict",
+    scale_field: Optional[str] = None,
 ):
     """
     Generate Elasticsearch query for vector similarity.
+
+    :param scale_field: Field holding the per-document scale of `int8` quantized vectors. The dot product is
+                        multiplied by it so that scores stay comparable across documents. Cosine is scale invariant.
     """
     if similarity == "cosine":
         similarity_fn_name = "cosineSimilarity"
@@ -171,6 +308,10 @@ def elastic_query_api(
     else:
         raise Exception("Invalid value for similarity in ElasticDocStore. Either \'cosine\' or \'dot_product\'")
 
+    similarity_fn = f"{similarity_fn_name}(params.query_vector,'{embedding_field}')"
+    if scale_field is not None and similarity == "dot_product":
+        similarity_fn = f"{similarity_fn} * doc['{scale_field}'].value"
+
     # To handle scenarios where embeddings may be missing
     script_score_query: dict = {"match_all": {}}
     if mode == "strict":
@@ -181,7 +322,7 @@ def elastic_query_api(
             "query": script_score_query,
             "script": {
                 # offset score to ensure a positive range as required by Elasticsearch
-                "source": f"{similarity_fn_name}(params.query_vector,'{embedding_field}') + 1000",
+                "source": f"{similarity_fn} + 1000",
                 "params": {"query_vector": query_emb.tolist()},
             },
         }
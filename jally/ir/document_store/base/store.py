@@ -1,11 +1,100 @@
 import uuid
 from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Union
 
 import mmh3
 import numpy as np
 
+# Joins the values of several `id_hash_keys` into the string that gets hashed
+ID_HASH_SEPARATOR = ":::"
+
+
+class DuplicateDocumentError(ValueError):
+    """Raised by a document store when a document to write already exists and `duplicate_documents="fail"`."""
+
+
+def hash_id(value: str, uuid_type: Optional[str] = None) -> str:
+    """
+    Hash a single key string into a document id (mmh3 by default, or a `uuid3`/`uuid5` string).
+    """
+    if uuid_type is None:
+        return "{:02x}".format(mmh3.hash128(value, signed=False))
+    elif uuid_type == "uuid3":
+        return str(uuid.uuid3(uuid.NAMESPACE_DNS, value))
+    elif uuid_type == 'uuid5':
+        return str(uuid.uuid5(uuid.NAMESPACE_DNS, value))
+    else:
+        raise ValueError(f"Choose either \"uuid3\" or \"uuid5\" or None")
+
+
+def _hash_ids(values: List[str], uuid_type: Optional[str] = None) -> List[str]:
+    return [hash_id(v, uuid_type=uuid_type) for v in values]
+
+
+def get_id_key(
+    doc: Union[dict, "Document"], id_hash_keys: Optional[List[str]] = None, field_map: Dict[str, str] = {}
+) -> str:
+    """
+    The string a document id is hashed from. `id_hash_keys` names the fields to use: `"text"` for the content and
+    any other name for a meta field, looked up at the top level of a flat dict or in its `"meta"`.
+    The default (`None` or `["text"]`) is the text alone, which keeps ids of existing indexes stable.
+    """
+    id_hash_keys = id_hash_keys or ["text"]
+    if isinstance(doc, Document):
+        values = [doc.text if k == "text" else doc.meta.get(k) for k in id_hash_keys]
+    else:
+        text_key = next((k for k, v in field_map.items() if v == "text"), "text")
+        meta = doc.get("meta") or {}
+        values = [doc.get(text_key) if k == "text" else doc.get(k, meta.get(k)) for k in id_hash_keys]
+    if len(values) == 1:
+        return "" if values[0] is None else str(values[0])
+    return ID_HASH_SEPARATOR.join("" if v is None else str(v) for v in values)
+
+
+def get_ids(
+    documents: Iterable[Union[dict, "Document"]],
+    id_hash_keys: Optional[List[str]] = None,
+    uuid_type: Optional[str] = None,
+    field_map: Dict[str, str] = {},
+    n_jobs: int = 1,
+    chunk_size: int = 100_000,
+) -> List[str]:
+    """
+    Ids for a batch of documents without building `Document` objects. Documents that already carry an `id`
+    keep it, the others get the same id `Document` would generate for them.
+
+    :param documents: Dicts (as accepted by `Document.from_dict`) or `Document` objects.
+    :param id_hash_keys: Fields the id is computed from, see `get_id_key`.
+    :param uuid_type: `None` (mmh3), `"uuid3"` or `"uuid5"`.
+    :param field_map: Store field map, used to find the text of dicts coming with a custom content field.
+    :param n_jobs: mmh3/uuid hold the GIL, so batches larger than `chunk_size` are hashed in `n_jobs`
+                   worker processes instead of threads.
+    :param chunk_size: Number of keys hashed per worker task.
+    """
+    ids: List[Optional[str]] = []
+    keys, positions = [], []
+    for i, doc in enumerate(documents):
+        _id = doc.id if isinstance(doc, Document) else doc.get("id")
+        if _id is not None:
+            ids.append(str(_id))
+            continue
+        ids.append(None)
+        keys.append(get_id_key(doc, id_hash_keys=id_hash_keys, field_map=field_map))
+        positions.append(i)
+
+    if n_jobs > 1 and len(keys) > chunk_size:
+        chunks = [keys[i : i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            hashed = [h for chunk in executor.map(_hash_ids, chunks, [uuid_type] * len(chunks)) for h in chunk]
+    else:
+        hashed = _hash_ids(keys, uuid_type=uuid_type)
+
+    for i, h in zip(positions, hashed):
+        ids[i] = h
+    return ids
+
 
 class Document:
     def __init__(
@@ -38,9 +127,9 @@ class Document:
         :param question: Question text (e.g. for FAQs where one document usually consists of one question and one answer text).
         :param meta: Meta fields for a document like name, url, or author.
         :param embedding: Vector encoding of the text
-        :param id_hash_keys: Generate the document id from a custom list of strings.
+        :param id_hash_keys: Generate the document id from a custom list of fields: "text" and/or meta keys.
                              If you want ensure you don't have duplicate documents in your DocumentStore but texts are
-                             not unique, you can provide custom strings here that will be used (e.g. ["filename_xy", "text_of_doc"].
+                             not unique, you can provide the keys that identify a document (e.g. ["text", "title"]).
         """
 
         self.text = text
@@ -53,14 +142,7 @@ class Document:
         self.id = self._get_id(id_hash_keys, uuid_type=uuid_type) if id is None else str(id)
 
     def _get_id(self, id_hash_keys, uuid_type=None):
-        if uuid_type is None:
-            return "{:02x}".format(mmh3.hash128(self.text, signed=False))
-        elif uuid_type == "uuid3":
-            return str(uuid.uuid3(uuid.NAMESPACE_DNS, self.text))
-        elif uuid_type == 'uuid5':
-            return str(uuid.uuid5(uuid.NAMESPACE_DNS, self.text))
-        else:
-            raise ValueError(f"Choose either \"uuid3\" or \"uuid5\" or None")
+        return hash_id(get_id_key(self, id_hash_keys=id_hash_keys), uuid_type=uuid_type)
 
     def to_dict(self, field_map={}):
         inv_field_map = {v: k for k, v in field_map.items()}
@@ -71,7 +153,7 @@ class Document:
         return _doc
 
     @classmethod
-    def from_dict(cls, dict, field_map={}, uuid_type=None):
+    def from_dict(cls, dict, field_map={}, uuid_type=None, id_hash_keys=None):
         _doc = deepcopy(dict)
         init_args = [
             "text",
@@ -99,6 +181,8 @@ class Document:
 
         if uuid_type:
             _new_doc["uuid_type"] = uuid_type
+        if id_hash_keys:
+            _new_doc["id_hash_keys"] = id_hash_keys
 
         return cls(**_new_doc)
 
@@ -106,6 +190,238 @@ class Document:
         return str(self.to_dict())
 
 
+class DocumentView:
+    """
+    Lightweight read-only `Document` over a single row of a `DocumentBatch`.
+    Exposes the same attributes as `Document` without copying anything out of the batch.
+    """
+
+    __slots__ = ("_batch", "_row")
+
+    def __init__(self, batch: "DocumentBatch", row: int):
+        self._batch = batch
+        self._row = row
+
+    @property
+    def text(self) -> str:
+        return self._batch.text[self._row]
+
+    @property
+    def id(self) -> str:
+        return self._batch.id[self._row]
+
+    @property
+    def score(self) -> Optional[float]:
+        return self._batch._optional_float(self._batch.score, self._row)
+
+    @property
+    def probability(self) -> Optional[float]:
+        return self._batch._optional_float(self._batch.probability, self._row)
+
+    @property
+    def question(self) -> Optional[str]:
+        return None if self._batch.question is None else self._batch.question[self._row]
+
+    @property
+    def embedding(self) -> Optional[np.ndarray]:
+        if self._batch.embedding is None:
+            return None
+        embedding = self._batch.embedding[self._row]
+        # rows of documents without a vector are NaN, see `DocumentBatch`
+        if embedding.dtype.kind == "f" and embedding.size and np.isnan(embedding[0]):
+            return None
+        return embedding
+
+    @property
+    def meta(self) -> Dict[str, Any]:
+        row = self._row
+        return {k: col[row] for k, col in self._batch.meta.items() if col[row] is not None}
+
+    def to_dict(self, field_map={}) -> Dict[str, Any]:
+        inv_field_map = {v: k for k, v in field_map.items()}
+        _doc = {
+            "text": self.text,
+            "score": self.score,
+            "probability": self.probability,
+            "question": self.question,
+            "meta": self.meta,
+            "embedding": self.embedding,
+            "id": self.id,
+        }
+        return {inv_field_map.get(k, k): v for k, v in _doc.items()}
+
+    def to_document(self) -> Document:
+        return Document(
+            text=self.text,
+            id=self.id,
+            score=self.score,
+            probability=self.probability,
+            question=self.question,
+            meta=self.meta,
+            embedding=self.embedding,
+        )
+
+    def __repr__(self):
+        return str(self.to_dict())
+
+
+class DocumentBatch:
+    """
+    Columnar container for many documents: one array per field instead of one `Document` object per row.
+
+    - `text`, `id` (and `question`) are object arrays, `score` and `probability` float64 arrays where
+      missing values are `NaN`, `embedding` is a 2d matrix (or `None`) whose rows are `NaN` for documents without
+      a vector, and `meta` maps each meta key to an object array with `None` for rows that don't have it.
+    - Slicing with a `slice` returns a new batch of views over the same columns, nothing is copied.
+      Integer arrays / boolean masks (`take`) copy only the selected rows.
+    - Indexing with an int returns a `DocumentView`, which behaves like a read-only `Document`.
+    """
+
+    def __init__(
+        self,
+        text: Union[List[str], np.ndarray],
+        id: Optional[Union[List[str], np.ndarray]] = None,
+        score: Optional[Union[List[Optional[float]], np.ndarray]] = None,
+        probability: Optional[Union[List[Optional[float]], np.ndarray]] = None,
+        embedding: Optional[np.ndarray] = None,
+        meta: Optional[Dict[str, Union[list, np.ndarray]]] = None,
+        question: Optional[Union[List[Optional[str]], np.ndarray]] = None,
+    ):
+        self.text = self._object_column(text)
+        n = len(self.text)
+        if id is None:
+            id = _hash_ids(self.text)
+        self.id = self._object_column(id)
+        self.score = self._float_column(score, n)
+        self.probability = self._float_column(probability, n)
+        self.embedding = None if embedding is None else np.asarray(embedding)
+        self.question = None if question is None else self._object_column(question)
+        self.meta = {k: self._object_column(v) for k, v in (meta or {}).items()}
+
+        for name, col in (("id", self.id), ("embedding", self.embedding), ("question", self.question), *self.meta.items()):
+            if col is not None and len(col) != n:
+                raise ValueError(f"Column \"{name}\" has {len(col)} rows but there are {n} texts")
+
+    @staticmethod
+    def _object_column(values: Union[list, np.ndarray]) -> np.ndarray:
+        if isinstance(values, np.ndarray) and values.dtype == object:
+            return values
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+
+    @staticmethod
+    def _float_column(values: Optional[Union[list, np.ndarray]], n: int) -> np.ndarray:
+        if values is None:
+            return np.full(n, np.nan)
+        if isinstance(values, np.ndarray) and values.dtype == np.float64:
+            return values
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+    @staticmethod
+    def _optional_float(column: np.ndarray, row: int) -> Optional[float]:
+        value = column[row]
+        return None if np.isnan(value) else float(value)
+
+    @classmethod
+    def from_documents(cls, documents: List[Union[dict, Document]], field_map={}) -> "DocumentBatch":
+        """
+        Build a batch from dicts (in the format accepted by `Document.from_dict`) or `Document` objects.
+        """
+        docs = [Document.from_dict(d, field_map=field_map) if isinstance(d, dict) else d for d in documents]
+        meta_keys = {k: None for d in docs for k in d.meta}
+        embeddings = [d.embedding for d in docs]
+        has_embedding = len(docs) > 0 and all(e is not None for e in embeddings)
+        return cls(
+            text=[d.text for d in docs],
+            id=[d.id for d in docs],
+            score=[d.score for d in docs],
+            probability=[d.probability for d in docs],
+            embedding=np.stack(embeddings) if has_embedding else None,
+            meta={k: [d.meta.get(k) for d in docs] for k in meta_keys},
+            question=[d.question for d in docs] if any(d.question is not None for d in docs) else None,
+        )
+
+    @classmethod
+    def concat(cls, batches: List["DocumentBatch"]) -> "DocumentBatch":
+        """
+        Stack several batches (e.g. the responses of different retrievers before fusion) into one.
+        """
+        batches = [b for b in batches if len(b) > 0]
+        if not batches:
+            return cls(text=[])
+        meta_keys = {k: None for b in batches for k in b.meta}
+        embedding = None
+        if all(b.embedding is not None for b in batches):
+            embedding = np.concatenate([b.embedding for b in batches])
+        question = None
+        if any(b.question is not None for b in batches):
+            question = np.concatenate([b.question if b.question is not None else np.full(len(b), None) for b in batches])
+        return cls(
+            text=np.concatenate([b.text for b in batches]),
+            id=np.concatenate([b.id for b in batches]),
+            score=np.concatenate([b.score for b in batches]),
+            probability=np.concatenate([b.probability for b in batches]),
+            embedding=embedding,
+            meta={
+                k: np.concatenate([b.meta[k] if k in b.meta else np.full(len(b), None) for b in batches])
+                for k in meta_keys
+            },
+            question=question,
+        )
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield DocumentView(self, row)
+
+    def __getitem__(self, idx: Union[int, slice, np.ndarray, List[int]]) -> Union[DocumentView, "DocumentBatch"]:
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f"DocumentBatch index {idx} is out of range")
+            return DocumentView(self, int(idx))
+        return self._select(idx)
+
+    def take(self, indices: Union[np.ndarray, List[int]]) -> "DocumentBatch":
+        """
+        New batch holding the rows at `indices` in the given order.
+        """
+        return self._select(np.asarray(indices, dtype=np.int64))
+
+    def top_k(self, k: int, by: str = "score") -> "DocumentBatch":
+        """
+        The `k` rows with the highest `score` (or `probability`), best first. Rows without a value come last.
+        """
+        values = getattr(self, by)
+        values = np.where(np.isnan(values), -np.inf, values)
+        k = min(k, len(self))
+        if k <= 0:
+            return self[:0]
+        best = np.argpartition(-values, k - 1)[:k]
+        return self.take(best[np.argsort(-values[best], kind="stable")])
+
+    def to_documents(self) -> List[Document]:
+        return [view.to_document() for view in self]
+
+    def _select(self, idx: Union[slice, np.ndarray]) -> "DocumentBatch":
+        return DocumentBatch(
+            text=self.text[idx],
+            id=self.id[idx],
+            score=self.score[idx],
+            probability=self.probability[idx],
+            embedding=None if self.embedding is None else self.embedding[idx],
+            meta={k: col[idx] for k, col in self.meta.items()},
+            question=None if self.question is None else self.question[idx],
+        )
+
+    def __repr__(self):
+        return f"DocumentBatch(size={len(self)}, meta={list(self.meta.keys())})"
+
+
 class BaseDocStore:
     """
     Base class for implementing Document Stores.
@@ -218,3 +534,16 @@ class BaseDocStore:
             documents = list(filter(lambda doc: doc.id not in ids_exist_in_db, documents))
 
         return documents
+
+    def _drop_duplicate_documents(self, documents: List[Document]) -> List[Document]:
+        """
+        Drop documents with an id already seen earlier in `documents`.
+        """
+        seen = set()
+        unique = []
+        for doc in documents:
+            if doc.id in seen:
+                continue
+            seen.add(doc.id)
+            unique.append(doc)
+        return unique
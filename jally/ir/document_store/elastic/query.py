@@ -0,0 +1,241 @@
+import copy
+import json
+import logging
+from functools import lru_cache
+from string import Template
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+import numpy as np
+from jally.formatting.ir import tool
+
+logger = logging.getLogger(__name__)
+
+# Stands for the query text / vector in request skeletons until it is spliced in
+PLACEHOLDER = "\x00jally-query\x00"
+
+Path = Tuple[Union[str, int], ...]
+
+
+def freeze_filters(filters: Optional[Dict[str, List]]) -> Hashable:
+    """
+    Validate `filters` and turn them into a hashable key, e.g. {"name": ["some", "more"], "category": ["only_one"]}.
+    """
+    if not filters:
+        return ()
+    frozen = []
+    for key, values in filters.items():
+        if type(values) != list:
+            raise ValueError(
+                f'Wrong filter format for key "{key}": Please provide a list of allowed values for each key. '
+                'Example: {"name": ["some", "more"], "category": ["only_one"]} '
+            )
+        # True, 1 and 1.0 are equal (and hash alike) in Python, but not to Elastic: key on the type as well
+        typed = tuple((type(v).__name__, v) for v in values)
+        try:
+            hash(typed)
+            frozen.append((key, typed))
+        except TypeError:
+            # unhashable values (e.g. dicts) are keyed by their JSON
+            frozen.append((key, json.dumps(values, sort_keys=True)))
+    return tuple(frozen)
+
+
+@lru_cache(maxsize=1024)
+def _filter_clause(frozen: Hashable) -> List[dict]:
+    return [
+        {"terms": {key: json.loads(values) if isinstance(values, str) else [v for _, v in values]}}
+        for key, values in frozen
+    ]
+
+
+def filter_clause(filters: Optional[Dict[str, List]]) -> List[dict]:
+    """
+    `terms` filter clauses of `filters`. The result is shared between calls and must not be mutated.
+    """
+    return _filter_clause(freeze_filters(filters))
+
+
+def placeholder_paths(node: Any, path: Path = ()) -> List[Path]:
+    """
+    Paths (dict keys / list indices) to every occurrence of `PLACEHOLDER` in `node`.
+    """
+    if isinstance(node, str):
+        return [path] if node == PLACEHOLDER else []
+    items = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else ()
+    return [p for key, child in items for p in placeholder_paths(child, path + (key,))]
+
+
+class CompiledQuery:
+    """
+    Request body with holes for the query. Calling it copies only the containers on the path to each hole, the
+    rest of the skeleton (filter clauses, field lists, `_source`) is shared by all requests built from it.
+    """
+
+    def __init__(self, skeleton: dict):
+        self.skeleton = skeleton
+        self.paths = placeholder_paths(skeleton)
+
+    def __call__(self, value: Any) -> dict:
+        body = copy.copy(self.skeleton)
+        for path in self.paths:
+            node = body
+            for key in path[:-1]:
+                node[key] = copy.copy(node[key])
+                node = node[key]
+            node[path[-1]] = value
+        return body
+
+
+class ElasticQueryBuilder:
+    """
+    Builds every request body `ElasticDocStore` and `BM25Retriever` send. Skeletons are compiled once per
+    (kind, top_k, filters, template) and cached, then only the query text or vector is spliced in per request.
+    """
+
+    def __init__(
+        self,
+        search_fields: List[str],
+        embedding_field: str = "embedding",
+        similarity: str = "dot_product",
+        scale_field: Optional[str] = None,
+        excluded_meta_data: Optional[List[str]] = None,
+        cache_size: int = 256,
+    ):
+        self.search_fields = search_fields
+        self.embedding_field = embedding_field
+        self.similarity = similarity
+        self.scale_field = scale_field
+        self.excluded_meta_data = excluded_meta_data or []
+        self.cache_size = cache_size
+        self._compiled: Dict[Hashable, CompiledQuery] = {}
+
+    def source(self, return_embedding: bool = True, exclude_meta_data: bool = True) -> Optional[dict]:
+        """
+        `_source` filtering of a request: `excluded_meta_data` (for searches, see `exclude_meta_data`),
+        plus the vector fields if they are not returned.
+        """
+        excludes = list(self.excluded_meta_data) if exclude_meta_data else []
+        if not return_embedding and self.embedding_field:
+            excludes.extend(f for f in (self.embedding_field, self.scale_field) if f)
+        return {"excludes": excludes} if excludes else None
+
+    def bool_query(
+        self,
+        filters: Optional[Dict[str, List]] = None,
+        ids: Optional[List[str]] = None,
+        only_documents_without_embedding: bool = False,
+    ) -> dict:
+        """
+        Query matching documents by `filters`, `ids` and/or a missing embedding (all documents if none is given).
+        """
+        clauses: dict = {}
+        if filters:
+            clauses["filter"] = filter_clause(filters)
+        if ids:
+            clauses["must"] = {"ids": {"values": ids}}
+        if only_documents_without_embedding:
+            clauses["must_not"] = [{"exists": {"field": self.embedding_field}}]
+        return {"bool": clauses} if clauses else {"match_all": {}}
+
+    def body(
+        self,
+        filters: Optional[Dict[str, List]] = None,
+        ids: Optional[List[str]] = None,
+        only_documents_without_embedding: bool = False,
+        return_embedding: bool = True,
+        size: Optional[int] = None,
+    ) -> dict:
+        """
+        Search or scan request body around `bool_query` (counts and deletes take the bare query).
+        Documents fetched by id or scanned keep their `excluded_meta_data`, only the vector fields can be left out.
+        """
+        body: dict = {"query": self.bool_query(filters, ids, only_documents_without_embedding)}
+        if size is not None:
+            body["size"] = size
+        source = self.source(return_embedding, exclude_meta_data=False)
+        if source is not None:
+            body["_source"] = source
+        return body
+
+    def bm25(
+        self,
+        top_k: int,
+        filters: Optional[Dict[str, List]] = None,
+        custom_query: Optional[str] = None,
+        return_embedding: bool = False,
+    ) -> CompiledQuery:
+        """
+        Compiled BM25 request over `search_fields`, or over `custom_query`: a `string.Template` of the request
+        with a `${query}` placeholder and one `${<key>}` placeholder per filter key, e.g.
+
+        >> '{"query": {"bool": {"must": {"match": {"text": ${query}}}, "filter": {"terms": {"year": ${years}}}}}}'
+        """
+        key = ("bm25", top_k, freeze_filters(filters), custom_query, return_embedding)
+        return self._get(key, lambda: self._bm25(top_k, filters, custom_query, return_embedding))
+
+    def embedding(
+        self, top_k: int, filters: Optional[Dict[str, List]] = None, return_embedding: bool = False
+    ) -> Callable[[np.ndarray], dict]:
+        """
+        Compiled vector similarity request, the returned callable takes the query embedding.
+        """
+        key = ("embedding", top_k, freeze_filters(filters), return_embedding)
+        compiled = self._get(key, lambda: self._embedding(top_k, filters, return_embedding))
+        return lambda query_emb: compiled(np.asarray(query_emb).tolist())
+
+    def _get(self, key: Hashable, build: Callable[[], CompiledQuery]) -> CompiledQuery:
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            if len(self._compiled) >= self.cache_size:
+                self._compiled.pop(next(iter(self._compiled)))
+            compiled = self._compiled[key] = build()
+        return compiled
+
+    def _bm25(
+        self, top_k: int, filters: Optional[Dict[str, List]], custom_query: Optional[str], return_embedding: bool
+    ) -> CompiledQuery:
+        if custom_query:
+            # Example: filters={"years":[2018]} => replaces {$years} in custom_query with '[2018]'
+            substitutions = {key: json.dumps(values) for key, values in (filters or {}).items()}
+            substitutions["query"] = json.dumps(PLACEHOLDER)
+            skeleton = json.loads(Template(custom_query).substitute(**substitutions))
+            skeleton["size"] = str(top_k)
+        else:
+            skeleton = {
+                "size": str(top_k),
+                "query": {
+                    "bool": {
+                        "should": [
+                            {
+                                "multi_match": {
+                                    "query": PLACEHOLDER,
+                                    "type": "most_fields",
+                                    "fields": self.search_fields,
+                                }
+                            }
+                        ]
+                    }
+                },
+            }
+            if filters:
+                skeleton["query"]["bool"]["filter"] = filter_clause(filters)
+        source = self.source(return_embedding)
+        if source is not None:
+            skeleton["_source"] = source
+        return CompiledQuery(skeleton)
+
+    def _embedding(self, top_k: int, filters: Optional[Dict[str, List]], return_embedding: bool) -> CompiledQuery:
+        query = tool.elastic_query_api(
+            np.zeros(0),
+            embedding_field=self.embedding_field,
+            similarity=self.similarity,
+            scale_field=self.scale_field,
+        )
+        query["script_score"]["script"]["params"]["query_vector"] = PLACEHOLDER
+        if filters:
+            query["script_score"]["query"] = {"bool": {"filter": filter_clause(filters)}}
+        skeleton = {"size": top_k, "query": query}
+        source = self.source(return_embedding)
+        if source is not None:
+            skeleton["_source"] = source
+        return CompiledQuery(skeleton)
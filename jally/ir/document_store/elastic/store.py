@@ -11,8 +11,9 @@ import torch.nn as nn
 from elasticsearch import Elasticsearch, RequestsHttpConnection
 from elasticsearch.exceptions import RequestError
 from elasticsearch.helpers import bulk, scan
-from jally.formatting.ir import tool
-from jally.ir.document_store.base import BaseDocStore, Document
+from jally.formatting.ir import codec, tool
+from jally.ir.document_store.base import BaseDocStore, Document, DocumentBatch, get_ids
+from jally.ir.document_store.elastic.query import ElasticQueryBuilder
 from scipy.special import expit
 from tqdm.auto import tqdm
 
@@ -55,6 +56,7 @@ class ElasticDocStore(BaseDocStore):
         return_embedding: bool = False,
         index_type: str = "flat",
         scroll: str = "1d",
+        embedding_dtype: str = "float32",
     ):
 
         if type(search_fields) == str:
@@ -65,7 +67,12 @@ class ElasticDocStore(BaseDocStore):
         self.name_field = name_field
         self.embedding_field = embedding_field
         self.embedding_dim = embedding_dim
+        self.embedding_dtype = codec.check_dtype(embedding_dtype)
+        # `int8` vectors are indexed as small integers, their per-vector scale lives in a sibling field
+        self.scale_field = f"{embedding_field}_scale" if embedding_dtype == "int8" else None
         self.excluded_meta_data = excluded_meta_data
+        # `_source` keys that are not returned as meta
+        self.non_meta_fields = tuple(f for f in (text_field, "content_type", embedding_field, self.scale_field) if f)
         self.analyzer = analyzer
         self.return_embedding = return_embedding
 
@@ -81,6 +88,14 @@ class ElasticDocStore(BaseDocStore):
         self.request_timeout = request_timeout
         self.refresh_type = refresh_type
 
+        self.query_builder = ElasticQueryBuilder(
+            search_fields=search_fields,
+            embedding_field=embedding_field,
+            similarity=similarity,
+            scale_field=self.scale_field,
+            excluded_meta_data=excluded_meta_data,
+        )
+
         self.client = self._init_elastic_client(
             host=host,
             port=port,
@@ -102,7 +117,18 @@ class ElasticDocStore(BaseDocStore):
         index: Optional[str] = None,
         batch_size: int = 10_000,
         duplicate_documents: Optional[str] = None,
+        id_hash_keys: Optional[List[str]] = None,
     ):
+        """
+        Add new documents to the DocumentStore, `batch_size` documents per bulk request.
+
+        :param documents: List of `Dicts` or List of `Documents`. Documents with the same id overwrite each other.
+        :param index: index name for storing the docs and metadata
+        :param batch_size: Number of documents per bulk request.
+        :param duplicate_documents: Not used, kept for the common `write_documents` signature.
+        :param id_hash_keys: Fields ("text" and/or meta keys) the ids of dicts without an "id" are hashed from.
+        :return: None
+        """
         if index and not self.client.indices.exists(index=index):
             self._create_document_index(index)
 
@@ -110,7 +136,12 @@ class ElasticDocStore(BaseDocStore):
             index = self.index
 
         field_map = self._create_document_field_map()
-        document_objects = [Document.from_dict(d, field_map=field_map) if isinstance(d, dict) else d for d in documents]
+        # Ids of all dicts are hashed in one batch, so `Document` gets them ready-made instead of hashing one by one
+        ids = get_ids(documents, id_hash_keys=id_hash_keys, field_map=field_map)
+        document_objects = [
+            Document.from_dict({**d, "id": _id}, field_map=field_map) if isinstance(d, dict) else d
+            for d, _id in zip(documents, ids)
+        ]
 
         docs_to_index = []
         for doc in document_objects:
@@ -122,8 +153,7 @@ class ElasticDocStore(BaseDocStore):
 
             # cast embedding type as ES cannot deal with np.array
             if _doc[self.embedding_field] is not None:
-                if type(_doc[self.embedding_field]) == np.ndarray:
-                    _doc[self.embedding_field] = _doc[self.embedding_field].tolist()
+                _doc.update(self._embedding_to_source(_doc[self.embedding_field]))
 
             # rename id for elastic
             _doc["_id"] = str(_doc.pop("id"))
@@ -214,10 +244,30 @@ class ElasticDocStore(BaseDocStore):
         if return_embedding is None:
             return_embedding = self.return_embedding
 
-        result = self._get_all_documents_in_index(index=index, filters=filters, batch_size=batch_size)
-        for hit in result:
-            document = self._convert_es_hit_to_document(hit, return_embedding=return_embedding)
-            yield document
+        for batch in self.get_all_documents_batches(
+            index=index, filters=filters, return_embedding=return_embedding, batch_size=batch_size, as_batch=False
+        ):
+            yield from batch
+
+    def get_all_documents_batches(
+        self,
+        index: Optional[str] = None,
+        filters: Optional[Dict[str, List[str]]] = None,
+        return_embedding: Optional[bool] = None,
+        batch_size: int = 10_000,
+        as_batch: bool = True,
+    ) -> Generator[Union[DocumentBatch, List[Document]], None, None]:
+        """
+        Like `get_all_documents_generator`, but yields whole batches of `batch_size` documents: a `DocumentBatch`
+        (or a list of `Document` if `as_batch=False`), each decoded at once from the scan hits.
+        """
+        index = index or self.index
+        return_embedding = self.return_embedding if return_embedding is None else return_embedding
+        result = self._get_all_documents_in_index(
+            index=index, filters=filters, batch_size=batch_size, return_embedding=return_embedding
+        )
+        for hits in tool.get_batches_from_generator(result, batch_size):
+            yield self._convert_es_hits(hits, return_embedding=return_embedding, as_batch=as_batch)
 
     def get_document_count(
         self,
@@ -227,31 +277,20 @@ class ElasticDocStore(BaseDocStore):
     ) -> int:
         index = index or self.index
 
-        body: dict = {"query": {"bool": {}}}
-        if only_documents_without_embedding:
-            body['query']['bool']['must_not'] = [{"exists": {"field": self.embedding_field}}]
-
-        if filters:
-            filter_clause = []
-            for key, values in filters.items():
-                if type(values) != list:
-                    raise ValueError(
-                        f'Wrong filter format for key "{key}": Please provide a list of allowed values for each key. '
-                        'Example: {"name": ["some", "more"], "category": ["only_one"]} '
-                    )
-                filter_clause.append({"terms": {key: values}})
-            body["query"]["bool"]["filter"] = filter_clause
-
+        body = {
+            "query": self.query_builder.bool_query(
+                filters=filters, only_documents_without_embedding=only_documents_without_embedding
+            )
+        }
         result = self.client.count(index=index, body=body)
         count = result["count"]
         return count
 
     def get_documents_by_id(self, ids, index: Optional[str] = None, **kwargs) -> List[Document]:
         index = self.index if index is None else index
-        query = {"query": {"ids": {"values": ids}}}
-        response = self.client.search(index=index, body=query)["hits"]["hits"]
-        documents = [self._convert_es_hit_to_document(hit, return_embedding=self.return_embedding) for hit in response]
-        return documents
+        body = self.query_builder.body(ids=ids, return_embedding=self.return_embedding, size=len(ids))
+        response = self.client.search(index=index, body=body)["hits"]["hits"]
+        return self._convert_es_hits(response, return_embedding=self.return_embedding)
 
     def query_by_embedding(
         self,
@@ -274,17 +313,7 @@ class ElasticDocStore(BaseDocStore):
         index = self.index if index is None else index
         return_embedding = self.return_embedding if return_embedding is None else return_embedding
 
-        body = {
-            "size": top_k,
-            "query": tool.elastic_query_api(self.similarity, query_emb, embedding_field=self.embedding_field),
-        }
-
-        if filters:
-            filter_clause = []
-            for k, v in filters.items():
-                filter_clause.append({"terms": {k: v}})
-
-            body["query"]["script_score"]["query"] = {"bool": {"filter": filter_clause}}
+        body = self.query_builder.embedding(top_k, filters=filters, return_embedding=return_embedding)(query_emb)
 
         # Finally make a request. TODO: time it up
         try:
@@ -299,12 +328,7 @@ class ElasticDocStore(BaseDocStore):
             else:
                 raise e
 
-        documents = [
-            self._convert_es_hit_to_document(hit, adapt_score_for_embedding=True, return_embedding=return_embedding)
-            for hit in response
-        ]
-
-        return documents
+        return self._convert_es_hits(response, return_embedding=return_embedding, adapt_score_for_embedding=True)
 
     def describe(self, index=None):
         """Similar to pandas.describe(...)
@@ -360,11 +384,12 @@ class ElasticDocStore(BaseDocStore):
             filters=filters,
             batch_size=batch_size,
             only_documents_without_embedding=not update_existing_embeddings,
+            return_embedding=False,
         )
 
         with tqdm(total=document_count, position=0, unit="Docs", desc="Update embeddings") as pb:
             for chunk in tool.get_batches_from_generator(response, batch_size):
-                document_batch = [self._convert_es_hit_to_document(hit, return_embedding=False) for hit in chunk]
+                document_batch = self._convert_es_hits(chunk, return_embedding=False)
                 # TODO: Replace fake generating with nn.Module
                 # embeddings = retriever.embed_passages(document_batch)  # type: ignore
                 embeddings = torch.rand(len(document_batch), self.embedding_dim)
@@ -376,7 +401,7 @@ class ElasticDocStore(BaseDocStore):
                         "_op_type": "update",
                         "_index": index,
                         "_id": doc.id,
-                        "doc": {self.embedding_field: emb.tolist()},
+                        "doc": self._embedding_to_source(emb),
                     }
                     doc_updates.append(update)
 
@@ -395,20 +420,7 @@ class ElasticDocStore(BaseDocStore):
         filters: Optional[Dict[str, List[str]]] = None,
     ):
         index = self.index if index is None else index
-        query = {"query": {}}
-        if filters:
-            filter_clause = []
-            for k, vs in filters.items():
-                filter_clause.append({"terms": {k: vs}})
-                query["query"]["bool"] = {"filter": filter_clause}
-
-            if ids:
-                query["query"]["bool"]["must"] = {"ids": {"values": ids}}
-
-        elif ids:
-            query["query"]["ids"] = {"values": ids}
-        else:
-            query["query"] = {"match_all": {}}
+        query = {"query": self.query_builder.bool_query(filters=filters, ids=ids)}
         # TODO: The call is blocking by default, therefore we pass `wait_for_completion=False`
         # Not sure: shall we pass the callback to be invoked as soon as all docs are deleted ?
         response = self.client.delete_by_query(index=index, body=query, ignore=[404], wait_for_completion=False)
@@ -474,6 +486,8 @@ class ElasticDocStore(BaseDocStore):
                     "type": "dense_vector",
                     "dims": self.embedding_dim,
                 }
+                if self.scale_field:
+                    mapping["properties"][self.scale_field] = {"type": "float"}
                 response = self.client.indices.put_mapping(index=index_name, body=mapping)
                 return response
 
@@ -511,6 +525,8 @@ class ElasticDocStore(BaseDocStore):
                     "type": "dense_vector",
                     "dims": self.embedding_dim,
                 }
+                if self.scale_field:
+                    mapping["mappings"]["properties"][self.scale_field] = {"type": "float"}
 
         try:
             response = self.client.indices.create(index=index_name, body=mapping)
@@ -525,43 +541,117 @@ class ElasticDocStore(BaseDocStore):
         return_embedding: bool,
         adapt_score_for_embedding: bool = False,
     ) -> Document:
-        # We put all additional data of the doc into meta_data and return it in the API
-        meta_data = {
-            k: v for k, v in hit["_source"].items() if k not in (self.content_field, "content_type", self.embedding_field)
-        }
-        name = meta_data.pop(self.name_field, None)
-        if name:
-            meta_data["name"] = name
-
-        score = hit["_score"] if hit["_score"] else None
-        if score:
-            if adapt_score_for_embedding:
-                score = self._scale_embedding_score(score)
-                if self.similarity == "cosine":
-                    probability = (score + 1) / 2  # scaling probability from cosine similarity
-                elif self.similarity == "dot_product":
-                    probability = float(expit(np.asarray(score / 100)))  # scaling probability from dot product
+        return self._convert_es_hits([hit], return_embedding, adapt_score_for_embedding=adapt_score_for_embedding)[0]
+
+    def _convert_es_hits(
+        self,
+        hits: List[dict],
+        return_embedding: bool,
+        adapt_score_for_embedding: bool = False,
+        as_batch: bool = False,
+    ) -> Union[List[Document], DocumentBatch]:
+        """
+        Decode a whole response at once: scores and probabilities are computed on arrays (one `expit` call),
+        embeddings are dequantized as one matrix and meta is the `_source` minus the precomputed `self.non_meta_fields`.
+        Returns a list of `Document` or, with `as_batch=True`, a `DocumentBatch`.
+        """
+        n = len(hits)
+        # a missing or zero score means there is no score (filter-only queries)
+        scores = np.fromiter((hit["_score"] or np.nan for hit in hits), dtype=np.float64, count=n)
+        if adapt_score_for_embedding:
+            scores = self._scale_embedding_score(scores)
+            if self.similarity == "cosine":
+                probabilities = (scores + 1) / 2  # scaling probability from cosine similarity
+            elif self.similarity == "dot_product":
+                probabilities = expit(scores / 100)  # scaling probability from dot product
             else:
-                probability = float(expit(np.asarray(score / 8)))  # scaling probability from TFIDF/BM25
+                probabilities = np.full(n, np.nan)
         else:
-            probability = None
-
-        embedding = None
-        if return_embedding:
-            embedding_list = hit["_source"].get(self.embedding_field)
-            if embedding_list:
-                embedding = np.asarray(embedding_list, dtype=np.float32)
-
-        document = Document(
-            id=hit["_id"],
-            text=hit["_source"].get(self.content_field),
-            meta=meta_data,
-            score=score,
-            probability=probability,
-            embedding=embedding,
-        )
+            probabilities = expit(scores / 8)  # scaling probability from TFIDF/BM25
+
+        sources = [hit["_source"] for hit in hits]
+        non_meta, name_field = self.non_meta_fields, self.name_field
+        metas = []
+        for source in sources:
+            # We put all additional data of the doc into meta_data and return it in the API.
+            # Copying the source and dropping the few known non-meta keys is ~2x faster than filtering every key.
+            meta = source.copy()
+            for key in non_meta:
+                meta.pop(key, None)
+            name = meta.pop(name_field, None)
+            if name:
+                meta["name"] = name
+            metas.append(meta)
+
+        embeddings = self._decode_embeddings(sources) if return_embedding else [None] * n
+        ids = [hit["_id"] for hit in hits]
+        texts = [source.get(self.content_field) for source in sources]
+
+        if as_batch:
+            matrix = embeddings if isinstance(embeddings, np.ndarray) else self._embedding_matrix(embeddings)
+            keys = dict.fromkeys(k for meta in metas for k in meta)
+            columns = {k: [meta.get(k) for meta in metas] for k in keys}
+            return DocumentBatch(
+                text=texts, id=ids, score=scores, probability=probabilities, embedding=matrix, meta=columns
+            )
 
-        return document
+        return [
+            Document(
+                id=_id,
+                text=text,
+                meta=meta,
+                score=score if score == score else None,  # NaN != NaN
+                probability=probability if probability == probability else None,
+                embedding=embedding,
+            )
+            for _id, text, meta, score, probability, embedding in zip(
+                ids, texts, metas, scores.tolist(), probabilities.tolist(), embeddings
+            )
+        ]
+
+    def _decode_embeddings(self, sources: List[dict]) -> Union[np.ndarray, List[Optional[np.ndarray]]]:
+        """
+        Embeddings of `sources` as one matrix, or as a list with `None` for documents without a vector.
+        """
+        dtype = np.float16 if self.embedding_dtype == "float16" else np.float32
+        vectors = [source.get(self.embedding_field) for source in sources]
+        scales = [source.get(self.scale_field) for source in sources] if self.scale_field else None
+        if vectors and all(vectors):
+            return codec.dequantize(np.asarray(vectors, dtype=np.float32), scales, dtype=dtype)
+        return [
+            codec.dequantize(vector, scales[i] if scales else None, dtype=dtype) if vector else None
+            for i, vector in enumerate(vectors)
+        ]
+
+    @staticmethod
+    def _embedding_matrix(embeddings: List[Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """
+        Stack the embeddings of a batch in which some documents have none: their rows are `NaN`
+        (`DocumentView.embedding` returns `None` for them). `None` if no document has a vector.
+        """
+        first = next((e for e in embeddings if e is not None), None)
+        if first is None:
+            return None
+        matrix = np.full((len(embeddings), len(first)), np.nan, dtype=first.dtype)
+        for row, embedding in enumerate(embeddings):
+            if embedding is not None:
+                matrix[row] = embedding
+        return matrix
+
+    def _scale_embedding_score(self, score: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        # undo the offset `elastic_query_api` adds to keep script scores positive
+        return score - 1000
+
+    def _embedding_to_source(self, embedding: Union[np.ndarray, List[float]]) -> Dict[str, Any]:
+        """
+        Indexed field(s) of a single embedding stored as `self.embedding_dtype`.
+        `dense_vector` only accepts a JSON list of numbers, so `int8` vectors travel as small integers next to
+        their scale and float vectors are rounded to the precision of the dtype instead of full float64 reprs.
+        """
+        if self.embedding_dtype == "int8":
+            values, scale = codec.quantize(embedding, dtype="int8")
+            return {self.embedding_field: values.tolist(), self.scale_field: float(scale)}
+        return {self.embedding_field: codec.to_json_list(embedding, dtype=self.embedding_dtype)}
 
     def _get_all_documents_in_index(
         self,
@@ -569,20 +659,15 @@ class ElasticDocStore(BaseDocStore):
         filters: Optional[Dict[str, List[str]]] = None,
         batch_size: int = 10_000,
         only_documents_without_embedding: bool = False,
+        return_embedding: bool = True,
     ) -> Generator[dict, None, None]:
         """
         Return all documents in a specific index in the document store
         """
-        body: dict = {"query": {"bool": {}}}
-
-        if filters:
-            filter_clause = []
-            for k, vs in filters.items():
-                filter_clause.append({"terms": {k: vs}})
-            body["query"]["bool"]["filter"] = filter_clause
-
-        if only_documents_without_embedding:
-            body['query']['bool']['must_not'] = [{"exists": {"field": self.embedding_field}}]
-
+        body = self.query_builder.body(
+            filters=filters,
+            only_documents_without_embedding=only_documents_without_embedding,
+            return_embedding=return_embedding,
+        )
         result = scan(self.client, query=body, index=index, size=batch_size, scroll=self.scroll)
         yield from result
@@ -8,6 +8,7 @@ from typing import Union
 import numpy as np
 import random_name
 import simplejson
+from jally.formatting.ir import codec
 from jally.ir.document_store import base
 
 
@@ -28,7 +29,14 @@ def chunked_dict(dictionary, size):
         yield {k: dictionary[k] for k in itertools.islice(it, size)}
 
 
-def load(data_dir: Union[pathlib.Path, str], filename: str, embedding_field="embedding", load_embedding=True, ext=".json"):
+def load(
+    data_dir: Union[pathlib.Path, str],
+    filename: str,
+    embedding_field="embedding",
+    load_embedding=True,
+    ext=".json",
+    dequantize: bool = True,
+):
     data_dir = pathlib.Path(data_dir)
     db_filename = filename
     db_filepath = data_dir / (db_filename + ext)
@@ -48,6 +56,9 @@ def load(data_dir: Union[pathlib.Path, str], filename: str, embedding_field="emb
             index_filename = filename + "_index" + ".npy"
             index_filepath = data_dir / index_filename
             embeddings = np.load(str(index_filepath))
+            scale_filepath = data_dir / (filename + "_scale" + ".npy")
+            if dequantize and scale_filepath.exists():
+                embeddings = codec.dequantize(embeddings, np.load(str(scale_filepath)))
             for iDoc, iEmb in zip(docs, embeddings):
                 iDoc[embedding_field] = iEmb
         else:
@@ -57,7 +68,14 @@ def load(data_dir: Union[pathlib.Path, str], filename: str, embedding_field="emb
     return docs
 
 
-def save(data, data_dir: Union[str, pathlib.Path], embedding_field="embedding", save_embedding=True, ext=".json"):
+def save(
+    data,
+    data_dir: Union[str, pathlib.Path],
+    embedding_field="embedding",
+    save_embedding=True,
+    ext=".json",
+    embedding_dtype: str = "float32",
+):
     data_dir = pathlib.Path(data_dir)
     data_dir.parent.mkdir(parents=True, exist_ok=True)
     db_filename = random_name.generate_name()
@@ -72,7 +90,10 @@ def save(data, data_dir: Union[str, pathlib.Path], embedding_field="embedding",
             for dic in data:
                 index_data.append(copy.deepcopy(dic[embedding_field]))
                 dic[embedding_field] = np.nan
-            np.save(index_filepath, np.array(index_data))
+            index_data, scale = codec.quantize(np.array(index_data), dtype=embedding_dtype)
+            np.save(index_filepath, index_data)
+            if scale is not None:
+                np.save(data_dir / (db_filename + "_scale" + ".npy"), scale)
         else:
             for dic in data:
                 dic[embedding_field] = np.nan
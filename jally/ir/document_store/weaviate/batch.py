@@ -0,0 +1,156 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from weaviate import ObjectsBatchRequest
+
+logger = logging.getLogger(__name__)
+
+# (properties, class name, uuid, vector, attempt)
+WeaviateObject = Tuple[Dict[str, str], str, str, list, int]
+
+
+class AdaptiveBatchSize:
+    """
+    Additive-increase / multiplicative-decrease batch sizing: grow while batches come back faster than
+    `target_latency` seconds, halve as soon as one is slower.
+    """
+
+    def __init__(self, initial: int = 512, min_size: int = 32, max_size: int = 10_000, target_latency: float = 1.0):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.size = min(max(initial, min_size), self.max_size)
+        self.target_latency = target_latency
+
+    def update(self, batch_size: int, latency: float) -> int:
+        if latency > self.target_latency:
+            self.size = max(self.min_size, min(self.size, batch_size) // 2)
+        elif batch_size >= self.size:
+            # only full batches say something about the server being able to take more
+            self.size = min(self.max_size, self.size + max(self.min_size, self.size // 4))
+        return self.size
+
+
+class BatchWriter:
+    """
+    Sends objects to Weaviate in several concurrent batch requests.
+
+    - At most `workers` batches are in flight, `add` blocks while they are all busy (bounded memory).
+    - The batch size adapts to the latency of the last requests, see `AdaptiveBatchSize`.
+    - Objects Weaviate reports as failed, and all objects of a request that raised, are re-sent with exponential
+      backoff up to `max_retries` times; what still fails is returned by `close`.
+
+    >> with BatchWriter(client, workers=4) as writer:
+    >>     writer.add(properties, class_name="Document", uuid=uuid, vector=vector)
+    """
+
+    def __init__(
+        self,
+        client,
+        workers: int = 4,
+        batch_size: int = 512,
+        max_batch_size: int = 10_000,
+        min_batch_size: int = 32,
+        target_latency: float = 1.0,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        on_done: Optional[Callable[[int], None]] = None,
+    ):
+        """
+        :param client: `weaviate.Client`.
+        :param workers: Number of batch requests in flight.
+        :param batch_size: Initial number of objects per request.
+        :param max_batch_size: Upper bound of the adaptive batch size.
+        :param min_batch_size: Lower bound of the adaptive batch size.
+        :param target_latency: Request latency (seconds) above which batches shrink.
+        :param max_retries: Number of times a failed object is re-sent.
+        :param backoff: Delay before the first retry, doubled on every further attempt.
+        :param on_done: Called with the number of objects of every finished request (e.g. a progress bar update).
+        """
+        self.client = client
+        self.workers = workers
+        self.sizer = AdaptiveBatchSize(batch_size, min_batch_size, max_batch_size, target_latency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_done = on_done
+        self.failed: List[WeaviateObject] = []
+        self._buffer: List[WeaviateObject] = []
+        self._in_flight: Set[Future] = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="weaviate-batch")
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, properties: Dict[str, str], class_name: str, uuid: str, vector: list):
+        self._buffer.append((properties, class_name, uuid, vector, 0))
+        if len(self._buffer) >= self.sizer.size:
+            self._flush()
+
+    def close(self) -> List[WeaviateObject]:
+        """
+        Send what is buffered, wait for (and retry) all requests. Returns the objects that could not be written.
+        """
+        while self._buffer or self._in_flight:
+            if self._buffer:
+                self._flush()
+            self._collect(wait_all=not self._buffer)
+        self._executor.shutdown(wait=True)
+        return self.failed
+
+    def _flush(self):
+        while len(self._in_flight) >= self.workers:
+            self._collect()
+        batch, self._buffer = self._buffer[: self.sizer.size], self._buffer[self.sizer.size :]
+        self._in_flight.add(self._executor.submit(self._send, batch))
+
+    def _collect(self, wait_all: bool = False):
+        if not self._in_flight:
+            return
+        done, self._in_flight = wait(self._in_flight, return_when=FIRST_COMPLETED)
+        if wait_all:
+            done |= self._in_flight
+            wait(self._in_flight)
+            self._in_flight = set()
+        for future in done:
+            batch, failed, latency = future.result()
+            self.sizer.update(len(batch), latency)
+            self._retry(failed)
+            if self.on_done is not None:
+                self.on_done(len(batch) - len(failed))
+
+    def _retry(self, failed: List[WeaviateObject]):
+        for properties, class_name, uuid, vector, attempt in failed:
+            if attempt < self.max_retries:
+                self._buffer.append((properties, class_name, uuid, vector, attempt + 1))
+            else:
+                self.failed.append((properties, class_name, uuid, vector, attempt))
+
+    def _send(self, batch: List[WeaviateObject]) -> Tuple[List[WeaviateObject], List[WeaviateObject], float]:
+        attempt = max(obj[-1] for obj in batch)
+        if attempt > 0:
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+        request = ObjectsBatchRequest()
+        for properties, class_name, uuid, vector, _ in batch:
+            request.add(properties, class_name=class_name, uuid=uuid, vector=vector)
+        start = time.perf_counter()
+        try:
+            results = self.client.batch.create_objects(request)
+        except Exception as e:
+            logger.warning(f"Weaviate batch request of {len(batch)} objects failed: {e}")
+            return batch, batch, time.perf_counter() - start
+        latency = time.perf_counter() - start
+
+        # Weaviate returns errors for every failed document in the batch
+        failed_ids = set()
+        for result in results or []:
+            errors = ((result.get("result") or {}).get("errors") or {}).get("error")
+            if errors:
+                failed_ids.add(result.get("id"))
+                for message in errors:
+                    logger.error(f"{message['message']}")
+        failed = [obj for obj in batch if obj[2] in failed_ids]
+        return batch, failed, latency
@@ -1,4 +1,5 @@
 import hashlib
+import itertools
 import json
 import logging
 import re
@@ -6,11 +7,13 @@ import uuid
 from typing import Dict, Generator, List, Optional, Union
 
 import numpy as np
-from jally.ir.document_store.base import BaseDocStore, Document
+from jally.formatting.ir import codec
+from jally.ir.document_store.base import BaseDocStore, Document, get_ids
 from jally.ir.document_store.util import get_batches_from_generator
+from jally.ir.document_store.weaviate.batch import BatchWriter
 from tqdm.autonotebook import tqdm
 
-from weaviate import AuthClientPassword, ObjectsBatchRequest, client
+from weaviate import AuthClientPassword, client
 
 logger = logging.getLogger(__name__)
 UUID_PATTERN = re.compile(r'^[\da-f]{8}-([\da-f]{4}-){3}[\da-f]{12}$', re.IGNORECASE)
@@ -57,6 +60,7 @@ class WeaviateDocStore(BaseDocStore):
         embedding_field: str = "embedding",
         progress_bar: bool = True,
         duplicate_documents: str = 'overwrite',
+        embedding_dtype: str = "float32",
         **kwargs,
     ):
         """
@@ -89,6 +93,9 @@ class WeaviateDocStore(BaseDocStore):
                                     skip: Ignore the duplicates documents
                                     overwrite: Update any existing documents with the same ID when adding documents.
                                     fail: an error is raised if the document ID of the document being added already exists.
+        :param embedding_dtype: Precision of the embeddings, one of `float32`, `float16` or `int8`.
+                                Weaviate keeps float32 vectors internally, so the dtype bounds the digits sent in
+                                batch payloads and the dtype of embeddings returned in `Document` objects.
         """
         # Connect to Weaviate server using python binding
         weaviate_url = f"{host}:{port}"
@@ -123,6 +130,7 @@ class WeaviateDocStore(BaseDocStore):
         self.embedding_field = embedding_field
         self.progress_bar = progress_bar
         self.duplicate_documents = duplicate_documents
+        self.embedding_dtype = codec.check_dtype(embedding_dtype)
 
         self._create_schema_and_index_if_not_exist(self.index)
         self.uuid_format_warning_raised = False
@@ -204,7 +212,7 @@ class WeaviateDocStore(BaseDocStore):
         meta_data = {k: v for k, v in props.items() if k not in (self.content_field, self.embedding_field)}
 
         if return_embedding and embedding:
-            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = codec.dequantize(embedding, dtype=np.float16 if self.embedding_dtype == "float16" else np.float32)
 
         document = Document.from_dict(
             {
@@ -308,6 +316,46 @@ class WeaviateDocStore(BaseDocStore):
         property_dict = {"dataType": ["string"], "description": f"dynamic property {new_prop}", "name": new_prop}
         self.weaviate_client.schema.property.create(index, property_dict)
 
+    @staticmethod
+    def normalize_embedding(embedding: Union[np.ndarray, List[float]]) -> np.ndarray:
+        """
+        L2-normalise a vector (or the rows of a matrix) for cosine similarity. Float arrays are normalised in place.
+        """
+        if not (isinstance(embedding, np.ndarray) and np.issubdtype(embedding.dtype, np.floating)):
+            embedding = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(embedding, axis=-1, keepdims=True)
+        norm[norm == 0] = 1.0
+        embedding /= norm.astype(embedding.dtype)
+        return embedding
+
+    def _to_weaviate_object(self, doc: Document, field_map: Dict) -> tuple:
+        """
+        (properties, uuid, vector) of a document as sent in a batch request.
+        """
+        _doc = doc.to_dict(field_map=field_map)
+
+        # In order to have a flat structure in elastic + similar behaviour to the other DocStores,
+        # we "unnest" all value within "meta"
+        if "meta" in _doc.keys():
+            for k, v in _doc["meta"].items():
+                assert k not in _doc.keys()
+                _doc[k] = v
+            _doc.pop("meta")
+
+        doc_id = str(_doc.pop("id"))
+        vector = _doc.pop(self.embedding_field)
+
+        if self.similarity == "cosine":
+            vector = self.normalize_embedding(vector)
+        vector = codec.to_json_list(vector, dtype=self.embedding_dtype)
+
+        # Converting content to JSON-string as Weaviate doesn't allow other nested list for tables
+        _doc["text"] = json.dumps(_doc["text"])
+
+        # Remove all None props
+        properties = {k: v for k, v in _doc.items() if isinstance(v, str)}
+        return properties, doc_id, vector
+
     def _check_document(self, cur_props: List[str], doc: dict) -> List[str]:
         """
         Find the properties in the document that don't exist in the existing schema.
@@ -320,19 +368,29 @@ class WeaviateDocStore(BaseDocStore):
         index: Optional[str] = None,
         batch_size: int = 10_000,
         duplicate_documents: Optional[str] = None,
+        id_hash_keys: Optional[List[str]] = None,
+        workers: int = 4,
+        max_retries: int = 3,
+        schema_sample: int = 1_000,
     ):
         """
         Add new documents to the DocumentStore.
 
         :param documents: List of `Dicts` or List of `Documents`. A dummy embedding vector for each document is automatically generated if it is not provided. The document id needs to be in uuid format. Otherwise a correctly formatted uuid will be automatically generated based on the provided id.
         :param index: index name for storing the docs and metadata
-        :param batch_size: When working with large number of documents, batching can help reduce memory footprint.
+        :param batch_size: Upper bound of the number of documents per batch request. Requests start smaller and the
+                           size adapts to the observed latency of the server, see `batch.BatchWriter`.
         :param duplicate_documents: Handle duplicates document based on parameter options.
                                     Parameter options : ( 'skip','overwrite','fail')
                                     skip: Ignore the duplicates documents
                                     overwrite: Update any existing documents with the same ID when adding documents.
                                     fail: an error is raised if the document ID of the document being added already
                                     exists.
+        :param id_hash_keys: Fields ("text" and/or meta keys) the ids of dicts without an "id" are hashed from.
+        :param workers: Number of batch requests in flight.
+        :param max_retries: Number of times objects rejected by Weaviate (or of a failed request) are re-sent.
+        :param schema_sample: Number of leading documents whose new properties are added to the schema in one
+                              pre-pass, before anything is sent. Properties first seen later are added on the fly.
         :raises DuplicateDocumentError: Exception trigger on duplicate document
         :return: None
         """
@@ -352,8 +410,11 @@ class WeaviateDocStore(BaseDocStore):
         # Get and cache current properties in the schema
         current_properties = self._get_current_properties(index)
 
+        # Ids of all dicts are hashed in one batch, so `Document` gets them ready-made instead of hashing one by one
+        ids = get_ids(documents, id_hash_keys=id_hash_keys, uuid_type="uuid5", field_map=field_map)
         document_objects = [
-            Document.from_dict(d, field_map=field_map, uuid_type="uuid5") if isinstance(d, dict) else d for d in documents
+            Document.from_dict({**d, "id": _id}, field_map=field_map) if isinstance(d, dict) else d
+            for d, _id in zip(documents, ids)
         ]
 
         # Weaviate has strict requirements for what ids can be used.
@@ -381,57 +442,34 @@ class WeaviateDocStore(BaseDocStore):
                     )
                     dummy_embed_warning_raised = True
 
-        batched_documents = get_batches_from_generator(document_objects, batch_size)
+        # Auto schema: add the properties of a sample of documents up front, so requests don't race schema updates
+        objects = (self._to_weaviate_object(doc, field_map) for doc in document_objects)
+        sample = list(itertools.islice(objects, schema_sample))
+        new_properties = dict.fromkeys(
+            k for properties, _, _ in sample for k in self._check_document(current_properties, properties)
+        )
+        for prop in new_properties:
+            self._update_schema(prop, index)
+            current_properties.append(prop)
+        known_properties = set(current_properties)
+
         with tqdm(total=len(document_objects), disable=not self.progress_bar) as progress_bar:
-            for document_batch in batched_documents:
-                docs_batch = ObjectsBatchRequest()
-                # docs_batch = Batch(self.weaviate_client)
-                for idx, doc in enumerate(document_batch):
-                    _doc = {**doc.to_dict(field_map=self._create_document_field_map())}
-
-                    # In order to have a flat structure in elastic + similar behaviour to the other DocStores,
-                    # we "unnest" all value within "meta"
-                    if "meta" in _doc.keys():
-                        for k, v in _doc["meta"].items():
-                            assert k not in _doc.keys()
-                            _doc[k] = v
-                        _doc.pop("meta")
-
-                    doc_id = str(_doc.pop("id"))
-                    vector = _doc.pop(self.embedding_field)
-
-                    if self.similarity == "cosine":
-                        self.normalize_embedding(vector)
-
-                    # Converting content to JSON-string as Weaviate doesn't allow other nested list for tables
-                    _doc["text"] = json.dumps(_doc["text"])
-
-                    # Check if additional properties are in the document, if so,
-                    # append the schema with all the additional properties
-                    missing_props = self._check_document(current_properties, _doc)
-                    if missing_props:
-                        for property in missing_props:
-                            self._update_schema(property, index)
-                            current_properties.append(property)
-
-                    # Remove all None props
-                    valid_props = {k: v for k, v in _doc.items() if isinstance(v, str)}
-                    _doc.clear()
-                    _doc.update(valid_props)
-
-                    docs_batch.add(_doc, class_name=index, uuid=doc_id, vector=vector)
-                    # self.weaviate_client.batch.add_data_object(_doc, class_name=index, uuid=doc_id, vector=vector)
-
-                # Ingest a batch of documents
-                results = self.weaviate_client.batch.create_objects(docs_batch)
-                # Weaviate returns errors for every failed document in the batch
-                if results is not None:
-                    for result in results:
-                        if 'result' in result and 'errors' in result['result'] and 'error' in result['result']['errors']:
-                            for message in result['result']['errors']['error']:
-                                logger.error(f"{message['message']}")
-                progress_bar.update(batch_size)
-        progress_bar.close()
+            writer = BatchWriter(
+                self.weaviate_client,
+                workers=workers,
+                batch_size=min(batch_size, 512),
+                max_batch_size=batch_size,
+                max_retries=max_retries,
+                on_done=progress_bar.update,
+            )
+            with writer:
+                for properties, doc_id, vector in itertools.chain(sample, objects):
+                    for prop in properties.keys() - known_properties:
+                        self._update_schema(prop, index)
+                        known_properties.add(prop)
+                    writer.add(properties, class_name=index, uuid=doc_id, vector=vector)
+        if writer.failed:
+            logger.error(f"{len(writer.failed)} documents could not be written to Weaviate after {max_retries} retries")
 
     def update_document_meta(self, id: str, meta: Dict[str, str]):
         """
@@ -628,7 +666,7 @@ class WeaviateDocStore(BaseDocStore):
         properties.append("_additional {id, certainty, vector}")
 
         if self.similarity == "cosine":
-            self.normalize_embedding(query_emb)
+            query_emb = self.normalize_embedding(query_emb)
 
         query_emb = query_emb.reshape(1, -1).astype(np.float32)
 
@@ -713,7 +751,7 @@ class WeaviateDocStore(BaseDocStore):
             for doc, emb in zip(document_batch, embeddings):
                 # Using update method to only update the embeddings, other properties will be in tact
                 if self.similarity == "cosine":
-                    self.normalize_embedding(emb)
+                    emb = self.normalize_embedding(emb)
                 self.weaviate_client.data_object.update({}, class_name=index, uuid=doc.id, vector=emb)
 
     def delete_all_documents(self, index: Optional[str] = None, filters: Optional[Dict[str, List[str]]] = None):
@@ -1,6 +1,4 @@
-import json
 import logging
-import string
 from typing import Dict, Generator, List, Optional, Union
 
 from jally.ir.document_store.base.store import Document
@@ -24,81 +22,30 @@ class BM25Retriever(base_engine.IR):
         batch_size: int = 10_000,
         custom_query: Optional[str] = None,
         index: Optional[str] = None,
-    ) -> List[Document]:
-        if self.store.index is None:
-            index = self.store.index
+    ) -> Generator[List[List[Document]], None, None]:
+        """
+        Yields, per batch of queries, one list of documents per query. Without a query only `filters` are applied.
+        With `custom_query` (see `ElasticQueryBuilder.bm25`) the template is compiled once, not per query.
+        """
+        index = index or self.store.index
         top_k = top_k or self.top_k
-        if isinstance(query, str):
-            query = [{"query": query}]
+        builder = self.store.query_builder
+        return_embedding = self.store.return_embedding
 
         # Naive retrieval without BM25, only filtering
         if query is None:
-            body = {"query": {"bool": {"must": {"match_all": {}}}}}
-            if filters:
-                filter_clause = []
-                for key, values in filters.items():
-                    filter_clause.append({"terms": {key: values}})
-                body["query"]["bool"]["filter"] = filter_clause
-
-        # Retrieval via custom query
-        elif custom_query:  # substitute placeholder for query and filters for the custom_query template string
-            template = string.Template(custom_query)
-            # replace all "${query}" placeholder(s) with query
-            substitutions = {"query": f'"{query}"'}
-            # For each filter we got passed, we'll try to find & replace the corresponding placeholder in the template
-            # Example: filters={"years":[2018]} => replaces {$years} in custom_query with '[2018]'
-            if filters:
-                for key, values in filters.items():
-                    values_str = json.dumps(values)
-                    substitutions[key] = values_str
-            custom_query_json = template.substitute(**substitutions)
-            body = json.loads(custom_query_json)
-            # add top_k
-            body["size"] = str(top_k)
-
-        # Default Retrieval via BM25 using the user query on `self.search_fields`
-        else:
-            for i, batch in enumerate(chunked(query, batch_size)):
-                response = []
-                for j, q in enumerate(batch):
-                    body = {
-                        "size": str(top_k),
-                        "query": {
-                            "bool": {
-                                "should": [
-                                    {
-                                        "multi_match": {
-                                            "query": q["query"],
-                                            "type": "most_fields",
-                                            "fields": self.store.search_fields,
-                                        }
-                                    }
-                                ]
-                            }
-                        },
-                    }
+            body = builder.body(filters=filters, return_embedding=return_embedding, size=top_k)
+            yield [self._search(body, index, return_embedding)]
+            return
 
-                    if filters:
-                        filter_clause = []
-                        for key, values in filters.items():
-                            if type(values) != list:
-                                raise ValueError(
-                                    f'Wrong filter format for key "{key}": Please provide a list of allowed values for each key. '
-                                    'Example: {"name": ["some", "more"], "category": ["only_one"]} '
-                                )
-                            filter_clause.append({"terms": {key: values}})
-                        body["query"]["bool"]["filter"] = filter_clause
-
-                    if self.store.excluded_meta_data:
-                        body["_source"] = {"excludes": self.store.excluded_meta_data}
-
-                    logger.debug(f"Retriever query: {body}")
-                    result = self.store.client.search(index=index, body=body)["hits"]["hits"]
+        if isinstance(query, str):
+            query = [{"query": query}]
 
-                    documents = [
-                        self.store._convert_es_hit_to_document(hit, return_embedding=self.store.return_embedding)
-                        for hit in result
-                    ]
-                    response.append(documents)
+        compiled = builder.bm25(top_k, filters=filters, custom_query=custom_query, return_embedding=return_embedding)
+        for batch in chunked(query, batch_size):
+            yield [self._search(compiled(q["query"]), index, return_embedding) for q in batch]
 
-                yield response
+    def _search(self, body: Dict, index: str, return_embedding: bool) -> List[Document]:
+        logger.debug("Retriever query: %s", body)
+        result = self.store.client.search(index=index, body=body)["hits"]["hits"]
+        return self.store._convert_es_hits(result, return_embedding=return_embedding)
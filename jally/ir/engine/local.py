@@ -0,0 +1,185 @@
+import json
+import logging
+import pathlib
+from collections import Counter
+from typing import Callable, Dict, Generator, Iterable, List, Optional, Union
+
+import numpy as np
+from jally.formatting.ir import io, tool
+from jally.ir.document_store.base import Document
+from jally.ir.engine import base as base_engine
+from more_itertools import chunked
+from scipy.special import expit
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBM25Retriever(base_engine.IR):
+    """
+    In-process BM25 over a compact inverted index, for catalogues and tests that don't warrant an Elasticsearch
+    cluster. `retrieve_top_k` has the same signature and output as `bm25.BM25Retriever`.
+
+    The index is stored in CSR form: the postings of term `t` are `doc_ids[indptr[t]:indptr[t + 1]]`, and instead of
+    raw term frequencies each posting keeps its precomputed BM25 weight, so scoring a query is a single
+    `np.bincount` over the postings of its terms followed by an `argpartition` top-k.
+    `save`/`load` persist the arrays as `.npy` files that are memory-mapped back, documents go to a `Corpus`.
+    """
+
+    def __init__(
+        self,
+        documents: Optional[Iterable[Union[dict, Document]]] = None,
+        tokenizer: Optional[Callable[[List[str]], List[List[str]]]] = None,
+        top_k: Optional[int] = 10,
+        k1: float = 1.5,
+        b: float = 0.75,
+        field_map: Dict[str, str] = {},
+    ):
+        """
+        :param documents: Documents to index right away, see `index_documents`.
+        :param tokenizer: Batch tokenizer mapping a list of texts to a list of token lists,
+                          `formatting.get_tokens_many` by default. Pass the same one to `load`.
+        :param top_k: Default number of documents to return per query.
+        :param k1: BM25 term frequency saturation.
+        :param b: BM25 document length normalisation.
+        :param field_map: Field map for dicts whose text is not under "text".
+        """
+        super().__init__(store=None, query_processor=None, query_model=None)
+        self.tokenizer = tokenizer or tool.get_tokens_many
+        self.top_k = top_k
+        self.k1 = k1
+        self.b = b
+        self.field_map = field_map
+        self.vocab: Dict[str, int] = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.weights = np.zeros(0, dtype=np.float32)
+        self.doc_len = np.zeros(0, dtype=np.int32)
+        self.documents: Union[List[dict], io.Corpus] = []
+        if documents is not None:
+            self.index_documents(documents)
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def index_documents(self, documents: Iterable[Union[dict, Document]], batch_size: int = 10_000):
+        """
+        (Re)build the index from `documents`, consumed in batches of `batch_size`.
+        """
+        text_key = next((k for k, v in self.field_map.items() if v == "text"), "text")
+        vocab: Dict[str, int] = {}
+        store: List[dict] = []
+        terms, docs, tfs, doc_len = [], [], [], []
+        for batch in chunked(documents, batch_size):
+            dicts = [d.to_dict() if isinstance(d, Document) else d for d in batch]
+            for d, tokens in zip(dicts, self.tokenizer([d.get(text_key) or "" for d in dicts])):
+                counts = Counter(tokens)
+                terms.extend(vocab.setdefault(t, len(vocab)) for t in counts)
+                tfs.extend(counts.values())
+                docs.extend([len(store)] * len(counts))
+                doc_len.append(len(tokens))
+                store.append({k: v for k, v in d.items() if k not in ("embedding", "score", "probability")})
+
+        n_docs, n_terms = len(store), len(vocab)
+        terms = np.asarray(terms, dtype=np.int64)
+        order = np.argsort(terms, kind="stable")
+        docs = np.asarray(docs, dtype=np.int32)[order]
+        tfs = np.asarray(tfs, dtype=np.float32)[order]
+        doc_len = np.asarray(doc_len, dtype=np.int32)
+
+        indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=n_terms), out=indptr[1:])
+        df = np.diff(indptr)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = doc_len.mean() if n_docs > 0 else 1.0
+        norm = self.k1 * (1 - self.b + self.b * doc_len[docs] / max(avgdl, 1e-9))
+
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = docs
+        self.weights = (np.repeat(idf, df) * tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+        self.doc_len = doc_len
+        self.documents = store
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """
+        BM25 score of every indexed document for `query`.
+        """
+        tokens = self.tokenizer([query])[0]
+        term_ids = [self.vocab[t] for t in tokens if t in self.vocab]
+        if not term_ids:
+            return np.zeros(len(self), dtype=np.float32)
+        term_ids, qtf = np.unique(term_ids, return_counts=True)
+        spans = [slice(self.indptr[t], self.indptr[t + 1]) for t in term_ids]
+        doc_ids = np.concatenate([self.doc_ids[s] for s in spans])
+        weights = np.concatenate([self.weights[s] * q for s, q in zip(spans, qtf)])
+        return np.bincount(doc_ids, weights=weights, minlength=len(self)).astype(np.float32)
+
+    def retrieve_top_k(
+        self,
+        query: Union[str, List[Dict]],
+        filters: Optional[Dict[str, List]] = None,
+        top_k: int = None,
+        batch_size: int = 10_000,
+        index: Optional[str] = None,
+        **kwargs,
+    ) -> Generator[List[List[Document]], None, None]:
+        """
+        Same contract as `BM25Retriever.retrieve_top_k`: yields, per batch of queries, one list of documents per
+        query, best first. `filters` keep documents whose meta value for every key is among the given values.
+        `index` is ignored, there is a single in-process index.
+        """
+        top_k = top_k or self.top_k
+        if isinstance(query, str):
+            query = [{"query": query}]
+        for batch in chunked(query, batch_size):
+            yield [self._top_k(q["query"], top_k, filters) for q in batch]
+
+    def _top_k(self, query: str, top_k: int, filters: Optional[Dict[str, List]] = None) -> List[Document]:
+        scores = self.get_scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        if filters:
+            candidates = candidates[[self._match(self.documents[int(i)], filters) for i in candidates]]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [self._to_document(int(i), float(scores[i])) for i in candidates]
+
+    def _match(self, doc: dict, filters: Dict[str, List]) -> bool:
+        meta = doc.get("meta") or {}
+        return all(doc.get(k, meta.get(k)) in values for k, values in filters.items())
+
+    def _to_document(self, i: int, score: float) -> Document:
+        document = Document.from_dict(self.documents[i], field_map=self.field_map)
+        document.score = score
+        # same scaling as `ElasticDocStore` for BM25 scores
+        document.probability = float(expit(score / 8))
+        return document
+
+    def save(self, save_dir: Union[str, pathlib.Path]):
+        save_dir = pathlib.Path(save_dir)
+        save_dir.mkdir(parents=True, exist_ok=True)
+        for name in ("indptr", "doc_ids", "weights", "doc_len"):
+            np.save(save_dir / f"{name}.npy", getattr(self, name))
+        with open(str(save_dir / "vocab.json"), "w", encoding="utf-8") as j_ptr:
+            json.dump(self.vocab, j_ptr, ensure_ascii=False)
+        with open(str(save_dir / "config.json"), "w", encoding="utf-8") as j_ptr:
+            json.dump({"k1": self.k1, "b": self.b, "top_k": self.top_k, "field_map": self.field_map}, j_ptr, indent=4)
+        io.save(self.documents, save_dir, embedding_field=None, filename="documents")
+
+    @classmethod
+    def load(
+        cls, save_dir: Union[str, pathlib.Path], tokenizer: Optional[Callable[[List[str]], List[List[str]]]] = None
+    ) -> "LocalBM25Retriever":
+        """
+        Open an index written by `save`. Postings and documents are memory-mapped, not read into memory.
+        """
+        save_dir = pathlib.Path(save_dir)
+        with open(str(save_dir / "config.json"), "r", encoding="utf-8") as j_ptr:
+            config = json.load(j_ptr)
+        retriever = cls(tokenizer=tokenizer, **config)
+        for name in ("indptr", "doc_ids", "weights", "doc_len"):
+            setattr(retriever, name, np.load(str(save_dir / f"{name}.npy"), mmap_mode="r"))
+        with open(str(save_dir / "vocab.json"), "r", encoding="utf-8") as j_ptr:
+            retriever.vocab = json.load(j_ptr)
+        retriever.documents = io.Corpus(save_dir, "documents", embedding_field=None)
+        return retriever
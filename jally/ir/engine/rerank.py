@@ -0,0 +1,63 @@
+import logging
+import types
+from typing import List, Optional, Sequence, Tuple, Union
+
+from jally.ir.document_store import base
+from jally.ir.engine import base as base_engine
+from jally.modeling.ir.module import base as base_model
+
+logger = logging.getLogger(__name__)
+
+
+class RerankGenerator(base_engine.IRGenerator):
+    """
+    Retrieve `candidates` documents with any `IR` and re-rank them with a cascade of `IRGenerator` models
+    (cross-encoders), e.g.
+
+    >> RerankGenerator(bm25, stages=[(CrossEncoder.load("cross-encoder/ms-marco-TinyBERT-L-2-v2"), 20),
+    >>                               (CrossEncoder.load("cross-encoder/ms-marco-MiniLM-L-12-v2"), 5)])
+
+    Every stage scores what the previous one kept and passes on its best `keep` documents, so the expensive model
+    only sees the head of the list. Intermediate stages that could not drop anything (no more documents than they
+    keep) are skipped, the last stage always runs and decides the final order.
+    """
+
+    def __init__(
+        self,
+        retriever: base_engine.IR,
+        stages: Sequence[Tuple[base_model.IRGenerator, Optional[int]]],
+        candidates: int = 100,
+        top_k: int = 5,
+    ) -> None:
+        """
+        :param retriever: First stage retriever.
+        :param stages: (model, keep) pairs, cheapest first. `keep=None` keeps everything.
+        :param candidates: Number of documents requested from `retriever`.
+        :param top_k: Number of documents returned by `generate`.
+        """
+        super(RerankGenerator, self).__init__(retriever)
+        self.stages = list(stages)
+        self.candidates = candidates
+        self.top_k = top_k
+
+    def generate(self, query: str, index: Optional[str] = "document", **kwargs) -> List[base.Document]:
+        top_k = kwargs.pop("top_k", None) or self.top_k
+        response = self.retriever.retrieve_top_k(query, index=index, top_k=self.candidates, **kwargs)
+        return self.rerank(query, self._first(response), top_k=top_k)
+
+    def rerank(self, query: str, documents: List[base.Document], top_k: Optional[int] = None) -> List[base.Document]:
+        top_k = top_k or self.top_k
+        for i, (model, keep) in enumerate(self.stages):
+            keep = top_k if i == len(self.stages) - 1 else max(keep or len(documents), top_k)
+            if i < len(self.stages) - 1 and len(documents) <= keep:
+                continue
+            documents = model.predict(query, documents, top_k=keep)["documents"]
+        return documents[:top_k]
+
+    def _first(self, response: Union[List, types.GeneratorType]) -> List[base.Document]:
+        # retrievers either return the documents of a single query or yield batches of per-query lists
+        if isinstance(response, list) and (not response or isinstance(response[0], (base.Document, dict))):
+            return response
+        for batch in response:
+            return batch[0] if batch else []
+        return []
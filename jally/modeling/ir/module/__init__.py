@@ -1,2 +1,3 @@
 from .base import LanguageModel
 from .dpr import DEncoder, IEncoder, PEncoder
+from .rerank import CrossEncoder
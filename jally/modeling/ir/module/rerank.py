@@ -0,0 +1,123 @@
+import logging
+import pathlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+import mmh3
+import numpy as np
+import torch
+import transformers
+from jally.ir.document_store import base as base_doc
+from jally.modeling.ir.module import base
+from scipy.special import expit
+
+logger = logging.getLogger(__name__)
+
+
+class CrossEncoder(base.IRGenerator):
+    """
+    Scores (query, passage) pairs jointly with a sequence classification model (e.g. `cross-encoder/ms-marco-*`).
+
+    Pairs are sorted by length before batching, so each padded batch holds passages of similar size and little
+    compute goes to padding. Scores are kept in an LRU cache keyed by the 128-bit hash of the pair: candidates that
+    come back for the same query (paging, cascade stages, repeated questions) are not scored twice.
+    """
+
+    def __init__(
+        self,
+        model: transformers.PreTrainedModel,
+        tokenizer: transformers.PreTrainedTokenizerBase,
+        max_seq_len: int = 256,
+        batch_size: int = 32,
+        cache_size: int = 100_000,
+        device: Optional[Union[str, torch.device]] = None,
+    ):
+        """
+        :param model: Model returning one logit (relevance) or two logits (irrelevant, relevant) per pair.
+        :param tokenizer: Tokenizer of `model`.
+        :param max_seq_len: Pairs are truncated to `max_seq_len` tokens, from the passage side.
+        :param batch_size: Number of pairs per forward pass.
+        :param cache_size: Number of pair scores to keep, 0 disables the cache.
+        :param device: Device to run on, CUDA if available by default.
+        """
+        self.device = torch.device(device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.tokenizer = tokenizer
+        self.max_seq_len = max_seq_len
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[int, float]" = OrderedDict()
+
+    @classmethod
+    def load(cls, name_or_path: Union[str, pathlib.Path], **kwargs) -> "CrossEncoder":
+        model = transformers.AutoModelForSequenceClassification.from_pretrained(str(name_or_path))
+        tokenizer = transformers.AutoTokenizer.from_pretrained(str(name_or_path), use_fast=True)
+        return cls(model, tokenizer, **kwargs)
+
+    def score(self, query: str, passages: List[str]) -> np.ndarray:
+        """
+        Relevance of every passage to `query`, higher is better.
+        """
+        keys = [mmh3.hash128(query + "\x00" + p, signed=False) for p in passages]
+        scores = np.empty(len(passages), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                scores[i] = self.cache[key]
+            else:
+                missing.append(i)
+        if missing:
+            scores[missing] = self._score([query] * len(missing), [passages[i] for i in missing])
+            for i in missing:
+                self._remember(keys[i], float(scores[i]))
+        return scores
+
+    def predict(self, query: str, documents: List[base_doc.Document], top_k: Optional[int] = None) -> Dict:
+        """
+        Re-order `documents` by cross-encoder score. Their `score` and `probability` are overwritten.
+
+        :return: {"query": query, "documents": the `top_k` best documents}
+        """
+        scores = self.score(query, [doc.text or "" for doc in documents])
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        ranked = []
+        for i in order:
+            doc = documents[i]
+            doc.score = float(scores[i])
+            doc.probability = float(expit(scores[i]))
+            ranked.append(doc)
+        return {"query": query, "documents": ranked}
+
+    def _score(self, queries: List[str], passages: List[str]) -> np.ndarray:
+        order = np.argsort([len(p) for p in passages], kind="stable")
+        scores = np.empty(len(passages), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start : start + self.batch_size]
+            batch = self.tokenizer(
+                [queries[i] for i in idx],
+                [passages[i] for i in idx],
+                padding=True,
+                truncation="only_second",
+                max_length=self.max_seq_len,
+                return_tensors="pt",
+            )
+            batch = {key: batch[key].to(self.device) for key in batch}
+            with torch.no_grad():
+                logits = self.model(**batch, return_dict=True).logits
+            if logits.shape[-1] == 1:
+                logits = logits[:, 0]
+            else:
+                # two-class heads: log-odds of the "relevant" class keep the scale of single-logit models
+                logits = torch.log_softmax(logits, dim=-1)
+                logits = logits[:, -1] - logits[:, 0]
+            scores[idx] = logits.float().cpu().numpy()
+        return scores
+
+    def _remember(self, key: int, score: float):
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = score
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
@@ -47,10 +47,18 @@ app = Flask(
 
 bot = Teleflask(api_key=os.environ.get("BOT_TOKEN"), app=app)
 
-memo = SimpleDictDriver()
+# drop conversations idle for a week, keep the rest over restarts if STATE_SNAPSHOT is set.
+memo = SimpleDictDriver(
+    max_size=int(os.environ.get("STATE_MAX_SIZE", 100_000)),
+    ttl=7 * 24 * 3600,
+    snapshot_path=os.environ.get("STATE_SNAPSHOT"),
+)
 
 machine = machine.TeleStateMachine(__name__, database_driver=memo, teleflask_or_tblueprint=bot)
 
+# answer the webhook right away, the search runs on the workers (in order per chat).
+dispatcher = machine.use_dispatcher(workers=int(os.environ.get("BOT_WORKERS", 4)))
+
 machine.ASKED_QUERY = TeleState("ASKED_QUERY", machine)
 machine.CONFIRM_DATA = TeleState("CONFIRM_DATA", machine)
 machine.FOUND_RESULT = TeleState("FOUND_RESULT", machine)
@@ -134,6 +142,11 @@ def index(path):
         return send_from_directory(app.static_folder, 'index.html')
 
 
+@app.route("/metrics/updates")
+def update_metrics():
+    return jsonify(dispatcher.metrics())
+
+
 @machine.ALL.on_command("start")
 def start(update, text):
     machine.set("ASKED_QUERY")
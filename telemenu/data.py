@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import json
-from typing import Union, Dict, List
+from collections.abc import MutableMapping
+from typing import Any, Iterator, Union, Dict, List
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
@@ -14,6 +15,9 @@ if __name__ == '__main__':
 # end if
 
 
+SCHEMA_VERSION = 1  # version of the compact `Data.to_array()` format.
+
+
 class CallbackData(object):
     type: str
     value: JSONType
@@ -81,6 +85,9 @@ class MenuData(object):
         if isinstance(data, cls):
             return data
         # end if
+        if isinstance(data, (list, tuple)):
+            return cls.from_array(data)
+        # end if
 
         return cls(
             message_id=data['message_id'],
@@ -89,6 +96,19 @@ class MenuData(object):
         )
     # end def
 
+    def to_array(self) -> List[JSONType]:
+        """
+        Compact form for storage, `[message_id, page, data]`, see `Data.to_array()`.
+        """
+        return [self.message_id, self.page, self.data]
+    # end def
+
+    @classmethod
+    def from_array(cls, array: List[JSONType]) -> 'MenuData':
+        message_id, page, data = array
+        return cls(message_id=message_id, page=page, data=data)
+    # end def
+
     def __repr__(self):
         return (
             f'{self.__class__.__name__}('
@@ -103,6 +123,56 @@ class MenuData(object):
 # end class
 
 
+class LazyMenus(MutableMapping):
+    """
+    The `Data.menus` dict, but the `MenuData` of a menu is only created when that menu is accessed.
+    Menus not accessed during an update are stored again as they were loaded, without being decoded at all.
+    """
+    def __init__(self, raw: Dict[str, Any] = None):
+        self._items: Dict[str, Any] = {} if raw is None else dict(raw)  # MenuData, or the stored array/dict.
+    # end def
+
+    def __getitem__(self, key: str) -> MenuData:
+        value = self._items[key]
+        if not isinstance(value, MenuData):
+            value = self._items[key] = MenuData.from_dict(value)
+        # end if
+        return value
+    # end def
+
+    def __setitem__(self, key: str, value: MenuData) -> None:
+        self._items[key] = value
+    # end def
+
+    def __delitem__(self, key: str) -> None:
+        del self._items[key]
+    # end def
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._items
+    # end def
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+    # end def
+
+    def __len__(self) -> int:
+        return len(self._items)
+    # end def
+
+    def to_arrays(self) -> Dict[str, JSONType]:
+        return {
+            key: value.to_array() if isinstance(value, MenuData) else value
+            for key, value in self._items.items()
+        }
+    # end def
+
+    def __repr__(self):
+        return repr(self._items)
+    # end def
+# end class
+
+
 # TODO: there is needed a way to add your own stuff, e.g. you have other states than only menus...
 class Data(object):
     menus: Dict[str, MenuData]  # keys are (menu) IDs.
@@ -123,6 +193,41 @@ class Data(object):
         }
         # end def
 
+    def to_array(self) -> List[JSONType]:
+        """
+        Compact form for storage: `[SCHEMA_VERSION, {id: [message_id, page, data]}, history, saved_data]`.
+        No repeated key names, and menus which weren't accessed are passed on without decoding them.
+        """
+        menus = self.menus.to_arrays() if isinstance(self.menus, LazyMenus) else {
+            key: MenuData.from_dict(value).to_array() for key, value in self.menus.items()
+        }
+        return [SCHEMA_VERSION, menus, self.history, self.saved_data]
+    # end def
+
+    @classmethod
+    def from_array(cls, array: List[JSONType]) -> 'Data':
+        """
+        Reads `to_array()`'s format. The menus are only decoded when accessed, see `LazyMenus`.
+        """
+        version = array[0]
+        if version != SCHEMA_VERSION:
+            raise ValueError(f'Unknown Data schema version {version!r}, supported is {SCHEMA_VERSION!r}.')
+        # end if
+        _, menus, history, saved_data = array
+        return cls(menus=LazyMenus(menus), history=history, saved_data=saved_data)
+    # end def
+
+    @classmethod
+    def from_stored(cls, data: Union[Dict[str, JSONType], List[JSONType]]) -> 'Data':
+        """
+        Reads both the `to_array()` format and the older `to_dict()` one.
+        """
+        if isinstance(data, (list, tuple)):
+            return cls.from_array(data)
+        # end if
+        return cls.from_dict(data)
+    # end def
+
     @classmethod
     def from_dict(cls, data: Dict[str, JSONType]) -> 'Data':
         if isinstance(data, cls):
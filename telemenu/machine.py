@@ -30,6 +30,9 @@ class TeleStateMachineMenuSerialisationAdapter(TeleStateMachine):
     """
     Normal TeleStateMachine, but with custom (de)serialisation methods,
     directly converting it to and from the `Data` type.
+
+    It's stored in the compact, versioned `Data.to_array()` format, and the menus are only decoded when accessed.
+    Data stored with the older `Data.to_dict()` format is still read.
     """
     @classmethod
     def deserialize(cls, state_name, db_data):
@@ -40,12 +43,12 @@ class TeleStateMachineMenuSerialisationAdapter(TeleStateMachine):
             # no data yet, so we provide a empty skeleton of data
             return Data(menus={}, history=[])
         # end if
-        return Data.from_dict(array)
+        return Data.from_stored(array)
     # end def
 
     @classmethod
     def serialize(cls, state_name, state_data: Union['Data', None]):
-        data = None if state_data is None else state_data.to_dict()
+        data = None if state_data is None else state_data.to_array()
         return super(cls, cls).serialize(state_name, data)
 
     def process_result(self, update, result):
@@ -90,7 +93,7 @@ class TeleMenuInstancesItem(object):
 
     @property
     def global_data(self) -> 'Data':
-        return Data.from_dict(self.state.data)
+        return Data.from_stored(self.state.data)
     # end def
 
     @property
@@ -289,12 +292,14 @@ class TeleMenuMachine(object):
     instances: Dict[str, TeleMenuInstancesItem]
     states: Union[TeleStateMachineMenuSerialisationAdapter, TeleStateMachine]
 
-    def __init__(self, states: TeleStateMachineMenuSerialisationAdapter = None, database_driver=None, teleflask_or_tblueprint=None):
+    def __init__(self, states: TeleStateMachineMenuSerialisationAdapter = None, database_driver=None, teleflask_or_tblueprint=None, serializer=None):
         assert_type_or_raise(states, TeleStateMachineMenuSerialisationAdapter, None, parameter_name='states')
         self.instances = {}
         self.states = states
         if not self.states:
-            self.states = TeleStateMachineMenuSerialisationAdapter(__name__, database_driver, teleflask_or_tblueprint)
+            self.states = TeleStateMachineMenuSerialisationAdapter(
+                __name__, database_driver, teleflask_or_tblueprint, serializer=serializer,
+            )
         # end def
     # end def
 
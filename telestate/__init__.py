@@ -3,10 +3,16 @@
 from luckydonaldUtils.logger import logging
 
 __author__ = 'luckydonald'
-__all__ = ["TeleStateMachine", "TeleStateUpdateHandler", "TeleState", "TeleStateDatabaseDriver"]
+__all__ = ["TeleStateMachine", "TeleStateUpdateHandler", "TeleState", "TeleStateDatabaseDriver", "UpdateDispatcher",
+           "AsyncTeleStateMachine", "AsyncTeleState", "AsyncTeleStateDatabaseDriver",
+           "StateSerializer", "JSONSerializer", "MsgpackSerializer", "StateTracer"]
 logger = logging.getLogger(__name__)
 
 from .constants import KEEP_PREVIOUS
 from .machine import TeleStateMachine, TeleMachine
 from .state import TeleState, TeleStateUpdateHandler
-from .database_driver import TeleStateDatabaseDriver
+from .database_driver import TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver
+from .dispatcher import UpdateDispatcher
+from .aio import AsyncTeleStateMachine, AsyncTeleState
+from .serializer import StateSerializer, JSONSerializer, MsgpackSerializer
+from .tracing import StateTracer
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import inspect
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update as TGUpdate
+from teleflask import Teleflask
+from teleflask.exceptions import AbortProcessingPlease
+
+from .context import StateContext, ChatLocks
+from .database_driver import AsyncTeleStateDatabaseDriver
+from .machine import TeleStateMachine
+from .serializer import StateSerializer
+from .state import TeleState
+
+__author__ = 'luckydonald'
+__all__ = ["AsyncTeleStateMachine", "AsyncTeleState"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class AsyncTeleState(TeleState):
+    """
+    A TeleState for the `AsyncTeleStateMachine`, whose handlers may be `async def` functions.
+
+    The decorators work like the ones of teleflask:
+
+    >>> @states.ASK.on_command('cancel')
+    >>> async def cmd_cancel(update, text): ...
+
+    >>> @states.ASK.on_message('text')
+    >>> async def on_text(update, msg): ...
+
+    >>> @states.ASK.on_update('callback_query')
+    >>> async def on_button(update): ...
+
+    Plain functions are supported as well, they are called directly on the event loop.
+    """
+
+    # (kind, required keywords or command, function), kind being 'update', 'message' or 'command'.
+    async_handlers: List[Tuple[str, Union[Tuple[str, ...], str], Callable]]
+
+    def __init__(self, name=None, machine: 'AsyncTeleStateMachine' = None):
+        self.async_handlers = []
+        super().__init__(name, machine)
+    # end def
+
+    def on_update(self, *required_keywords):
+        """
+        Registers a handler called with `(update)`, if all of the `required_keywords` are set in the update.
+        Can be used as `@on_update` as well, to receive every update.
+        """
+        if len(required_keywords) == 1 and callable(required_keywords[0]):
+            return self._add_handler('update', (), required_keywords[0])
+        # end if
+        return lambda function: self._add_handler('update', required_keywords, function)
+    # end def
+
+    def on_message(self, *required_keywords):
+        """
+        Registers a handler called with `(update, msg)`, if it is a message with all of the `required_keywords` set.
+        Can be used as `@on_message` as well, to receive every message.
+        """
+        if len(required_keywords) == 1 and callable(required_keywords[0]):
+            return self._add_handler('message', (), required_keywords[0])
+        # end if
+        return lambda function: self._add_handler('message', required_keywords, function)
+    # end def
+
+    def on_command(self, command: str):
+        """
+        Registers a handler called with `(update, text)` for `/command`, `text` being the rest of the message or `None`.
+        """
+        return lambda function: self._add_handler('command', command, function)
+    # end def
+
+    command = on_command
+
+    def _add_handler(self, kind: str, condition: Union[Tuple[str, ...], str], function: Callable) -> Callable:
+        logger.debug(f'Registering {kind} handler {function!r} for {self.name!r}.')
+        self.async_handlers.append((kind, condition, function))
+        return function
+    # end def
+
+    def _handler_args(self, kind: str, condition: Union[Tuple[str, ...], str], update: TGUpdate) -> Optional[tuple]:
+        """
+        The arguments to call a handler with, or `None` if it doesn't apply to the update.
+        """
+        if kind == 'update':
+            return (update,) if all(getattr(update, key, None) for key in condition) else None
+        # end if
+        msg = update.message
+        if not msg:
+            return None
+        # end if
+        if kind == 'message':
+            return (update, msg) if all(getattr(msg, key, None) for key in condition) else None
+        # end if
+        if not msg.text or not msg.text.startswith('/'):
+            return None
+        # end if
+        command, _, text = msg.text[1:].partition(' ')
+        command, _, username = command.partition('@')
+        if command != condition or (username and username != self.username):
+            return None
+        # end if
+        return update, text or None
+    # end def
+
+    async def handle_update(self, update: TGUpdate) -> None:
+        """
+        Calls (and awaits) all the handlers applying to the update, and sends their results.
+        """
+        loop = asyncio.get_running_loop()
+        for kind, condition, function in self.async_handlers:
+            args = self._handler_args(kind, condition, update)
+            if args is None:
+                continue
+            # end if
+            result = function(*args)
+            if inspect.isawaitable(result):
+                result = await result
+            # end if
+            if result is not None:
+                # sending is blocking http, keep it off the event loop.
+                await loop.run_in_executor(None, self.process_result, update, result)
+            # end if
+        # end for
+    # end def
+# end class
+
+
+class AsyncTeleStateMachine(TeleStateMachine):
+    """
+    A TeleStateMachine processing updates as asyncio tasks, with an `AsyncTeleStateDatabaseDriver`
+    and `AsyncTeleState`s, whose handlers can be `async def` functions.
+
+    Usage example:
+
+    >>> from telestate.contrib.simple import AsyncSimpleDictDriver
+    >>> states = AsyncTeleStateMachine(__name__, database_driver=AsyncSimpleDictDriver(), teleflask_or_tblueprint=bot)
+    >>> states.ASK = AsyncTeleState('ASK', states)
+
+    Updates arriving from the (synchronous) teleflask webhook are scheduled on `loop` and acknowledged right away.
+    If no loop is given, one is started in a background thread on the first update.
+    Handlers waiting for I/O don't block a thread, so many conversations are processed concurrently,
+    while updates of the same chat and user are still processed one after another.
+    """
+    state_class = AsyncTeleState
+    database_driver_class = AsyncTeleStateDatabaseDriver
+
+    loop: Union[asyncio.AbstractEventLoop, None]
+
+    def __init__(
+        self,
+        name: str,
+        database_driver: AsyncTeleStateDatabaseDriver,
+        teleflask_or_tblueprint: Teleflask = None,
+        serializer: Optional[StateSerializer] = None,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ):
+        self.loop = loop
+        self._loop_lock = threading.Lock()
+        self.async_chat_locks = ChatLocks(lock_class=asyncio.Lock)
+        super().__init__(name, database_driver, teleflask_or_tblueprint, serializer=serializer)
+    # end def
+
+    def use_dispatcher(self, *args, **kwargs):
+        raise TypeError('The AsyncTeleStateMachine processes updates on it\'s event loop already, it has no dispatcher.')
+    # end def
+
+    def receive_update(self, update):
+        """
+        Listener for incoming updates: schedules them on the event loop, without waiting for them.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.process_update(update), self._get_loop())
+        future.add_done_callback(self._log_failure)
+    # end def
+
+    @staticmethod
+    def _log_failure(future: Future) -> None:
+        exception = future.exception()
+        if exception is not None and not isinstance(exception, AbortProcessingPlease):
+            logger.error('Update processing failed.', exc_info=exception)
+        # end if
+    # end def
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='telestate-loop', daemon=True).start()
+            # end if
+        # end with
+        return self.loop
+    # end def
+
+    async def process_update(self, update):
+        chat_id, user_id = self.update_get_chat_and_user(update)
+        async with self.async_chat_locks(chat_id, user_id):
+            token = self._context.set(StateContext(self.DEFAULT))
+            try:
+                await self._process_update_async(update, chat_id, user_id)
+            finally:
+                self._context.reset(token)
+            # end try
+        # end with
+    # end def
+
+    async def _process_update_async(self, update, chat_id, user_id):
+        trace = self.tracer.begin(chat_id, user_id)
+        state_name, state_data = await self.database_driver.load_state_for_chat_user(chat_id, user_id)
+        trace.loaded(state_name, state_data)
+        current = self._activate_loaded_state(update, chat_id, user_id, state_name, state_data)
+        # noinspection PyBroadException
+        try:
+            # noinspection PyBroadException
+            try:
+                await self._handle_update(current, update)
+            except AbortProcessingPlease as abort_e:
+                logger.debug('Should abort (AbortProcessingPlease), via state\'s process_update(...).', exc_info=True)
+                raise abort_e
+            except:
+                logger.exception(f'Update processing for state {current.name} failed.')
+            # end try
+
+            # ok, so we can still continue, as we had no AbortProcessingPlease.
+            # noinspection PyBroadException
+            try:
+                await self._handle_update(self.ALL, update)
+            except AbortProcessingPlease as abort_e:
+                logger.debug('Should abort (AbortProcessingPlease), via ALL\'s process_update(...).', exc_info=True)
+                raise abort_e
+            except:
+                logger.exception('Update processing for special (always active) ALL state failed.')
+            # end try
+        except AbortProcessingPlease as e:
+            abort_e = e
+        else:
+            abort_e = None
+        # end try
+        trace.handled(aborted=abort_e is not None)
+        state_name, state_data = self._serialize_current_state(chat_id, user_id, state_data)
+        await self.database_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        trace.stored(state_name, state_data)
+        self.tracer.finish(trace)
+        if abort_e:
+            logger.debug('Re-raising AbortProcessingPlease exception.')
+            raise abort_e  # re-raise so we don't process other stuff afterwards.
+        # end if
+    # end def
+
+    @staticmethod
+    async def _handle_update(state: TeleState, update: TGUpdate) -> Any:
+        if isinstance(state, AsyncTeleState):
+            return await state.handle_update(update)
+        # end if
+        # a plain TeleState registered with us, its teleflask handlers are synchronous.
+        if state.update_handler is not None:
+            return state.update_handler.process_update(update)
+        # end if
+    # end def
+# end class
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import threading
+from typing import Any, Callable, List, Union, TYPE_CHECKING
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+
+if TYPE_CHECKING:
+    from .state import TeleState
+# end if
+
+__author__ = 'luckydonald'
+__all__ = ["StateContext", "ChatLocks"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class StateContext(object):
+    """
+    The active state of one update, together with the data and update it was activated with.
+
+    `TeleStateMachine` keeps one of those per update in a `contextvars.ContextVar`,
+    so `machine.CURRENT` and `state.data` resolve to the update being processed in the calling thread or asyncio task,
+    instead of a single instance shared by all of them.
+    """
+    __slots__ = ('state', 'data', 'update')
+
+    def __init__(self, state: 'TeleState', data: Any = None, update: Union[Update, None] = None):
+        self.state = state
+        self.data = data
+        self.update = update
+    # end def
+
+    def __repr__(self):
+        return "<{clazz} {state!r}>".format(clazz=self.__class__.__name__, state=self.state)
+    # end def
+# end class
+
+
+class ChatLocks(object):
+    """
+    A fixed set of locks, picked by the hash of `(chat_id, user_id)`.
+
+    Holding the lock over load, processing and saving of a state makes sure two updates of the same chat and user
+    never work on the same state concurrently, while different chats mostly get different locks and run in parallel.
+    Use `lock_class=asyncio.Lock` to get locks for asyncio tasks instead of threads.
+    """
+    def __init__(self, stripes: int = 64, lock_class: Callable[[], Any] = threading.RLock):
+        self.locks: List[Any] = [lock_class() for _ in range(stripes)]
+    # end def
+
+    def __call__(self, chat_id: Union[int, str, None], user_id: Union[int, str, None]) -> Any:
+        return self.locks[hash((chat_id, user_id)) % len(self.locks)]
+    # end def
+# end class
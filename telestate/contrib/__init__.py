@@ -4,4 +4,4 @@ from luckydonaldUtils.logger import logging
 __author__ = 'luckydonald'
 logger = logging.getLogger(__name__)
 
-__all__ = ['mongo', 'pony_orm', 'simple']
+__all__ = ['cached', 'mongo', 'pony_orm', 'simple']
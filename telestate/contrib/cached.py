@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import atexit
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple, Union, Optional
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+from ..database_driver import TeleStateDatabaseDriver
+
+__author__ = 'luckydonald'
+__all__ = ['CachedDriver']
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+Key = Tuple[Union[int, str, None], Union[int, str, None]]  # (chat_id, user_id)
+
+
+class CachedDriver(TeleStateDatabaseDriver):
+    """
+    Write-behind cache in front of any other driver, e.g. the `MongoDriver` or `PonyDriver`.
+
+    - The states of the `capacity` most recently used (chat, user) pairs are kept in memory,
+      so loading them doesn't need a database round-trip.
+    - Saving a state equal to the cached one (same name, same pickled data) is skipped.
+    - Changed states are collected and written by a background thread every `flush_interval` seconds,
+      or as soon as `max_pending` are waiting, via the driver's `save_states_for_chat_users`.
+      Several saves of the same chat and user in between are written only once.
+    - `close()` (called at interpreter exit as well) writes everything still pending.
+
+    Note, states not yet flushed are lost if the process gets killed, and other processes using the same database
+    don't see them. Use it only if a single process owns the states of a chat.
+
+    Usage example:
+
+    >>> driver = CachedDriver(MongoDriver(collection), capacity=10_000, flush_interval=1.0)
+    >>> states = TeleStateMachine(__name__, database_driver=driver)
+    """
+    def __init__(
+        self,
+        driver: TeleStateDatabaseDriver,
+        capacity: int = 10_000,
+        flush_interval: float = 1.0,
+        max_pending: int = 1_000,
+    ):
+        """
+        :param driver: The driver actually storing the states.
+        :param capacity: Number of (chat, user) states kept in memory.
+        :param flush_interval: Seconds between writes of the changed states.
+        :param max_pending: Number of changed states triggering an early write.
+        """
+        assert isinstance(driver, TeleStateDatabaseDriver)
+        self.driver = driver
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (chat_id, user_id): (state_name, pickled data), in least recently used order.
+        self.cache: 'OrderedDict[Key, Tuple[Optional[str], bytes]]' = OrderedDict()
+        # (chat_id, user_id): (state_name, data), the states changed since the last flush.
+        self.pending: Dict[Key, Tuple[Optional[str], JSONType]] = {}
+        # the pending states currently being written, the database may not have them yet.
+        self.flushing: Dict[Key, Tuple[Optional[str], JSONType]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.flushed = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # only one flush at a time, so writes of a key stay in order.
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='telestate-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        super().__init__()
+    # end def
+
+    def __enter__(self) -> 'CachedDriver':
+        return self
+    # end def
+
+    def __exit__(self, *exc):
+        self.close()
+    # end def
+
+    def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType]:
+        key = (chat_id, user_id)
+        with self._lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            elif key in self.pending or key in self.flushing:
+                # evicted from the cache, but not written yet.
+                state_name, state_data = self.pending[key] if key in self.pending else self.flushing[key]
+                cached = self._remember(key, state_name, state_data)
+                self.hits += 1
+            # end if
+        # end with
+        if cached is not None:
+            state_name, blob = cached
+            # a fresh copy, so changes of the handlers don't end up in the cache before they get saved.
+            return state_name, pickle.loads(blob)
+        # end if
+        state_name, state_data = self.driver.load_state_for_chat_user(chat_id, user_id)
+        with self._lock:
+            self.misses += 1
+            if key not in self.cache and key not in self.pending and key not in self.flushing:  # unless saved meanwhile.
+                try:
+                    self._remember(key, state_name, state_data)
+                except Exception:
+                    logger.debug(f'Could not pickle state data for {chat_id}|{user_id}, not caching it.')
+                # end try
+            # end if
+        # end with
+        return state_name, state_data
+    # end def
+
+    def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        key = (chat_id, user_id)
+        try:
+            blob = pickle.dumps(state_data, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.warning(f'Could not pickle state data for {chat_id}|{user_id}, writing it without caching.', exc_info=True)
+            # an older state of this key may be being flushed right now, it must not land after this one.
+            with self._flush_lock:
+                with self._lock:
+                    self.cache.pop(key, None)
+                    self.pending.pop(key, None)
+                # end with
+                self.driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+            # end with
+            return
+        # end try
+        with self._lock:
+            if self.cache.get(key) == (state_name, blob):
+                self.cache.move_to_end(key)
+                self.skipped += 1
+                return
+            # end if
+            self.cache[key] = (state_name, blob)
+            self.cache.move_to_end(key)
+            self._evict()
+            self.pending[key] = (state_name, state_data)
+            pending = len(self.pending)
+        # end with
+        if pending >= self.max_pending:
+            self._wakeup.set()
+        # end if
+    # end def
+
+    def flush(self) -> int:
+        """
+        Writes all the changed states now.
+
+        :return: The number of states written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+                self.flushing = pending
+            # end with
+            if not pending:
+                return 0
+            # end if
+            try:
+                self.driver.save_states_for_chat_users(
+                    (chat_id, user_id, state_name, state_data)
+                    for (chat_id, user_id), (state_name, state_data) in pending.items()
+                )
+            except Exception:
+                logger.exception(f'Flushing {len(pending)} states failed, retrying with the next flush.')
+                with self._lock:
+                    # keep newer saves which came in meanwhile.
+                    pending.update(self.pending)
+                    self.pending = pending
+                    self.flushing = {}
+                # end with
+                return 0
+            # end try
+            with self._lock:
+                self.flushing = {}
+            # end with
+            self.flushed += len(pending)
+            logger.debug(f'Flushed {len(pending)} states.')
+            return len(pending)
+        # end with
+    # end def
+
+    def close(self) -> None:
+        """
+        Stops the background thread and writes everything still pending.
+        """
+        if self._closed:
+            return
+        # end if
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+    # end def
+
+    def _remember(self, key: Key, state_name: Optional[str], state_data: JSONType) -> Tuple[Optional[str], bytes]:
+        cached = self.cache[key] = (state_name, pickle.dumps(state_data, protocol=pickle.HIGHEST_PROTOCOL))
+        self._evict()
+        return cached
+    # end def
+
+    def _evict(self) -> None:
+        while len(self.cache) > self.capacity:
+            # pending states stay in self.pending until written.
+            self.cache.popitem(last=False)
+        # end while
+    # end def
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        # end while
+    # end def
+# end class
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple, Union, Optional
+from typing import Any, Dict, Iterable, Tuple, Union, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
+from pymongo import ASCENDING, ReplaceOne, WriteConcern
 from pymongo.collection import Collection
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver
 
 __author__ = 'luckydonald'
-__all__ = ['MongoDriver']
+__all__ = ['MongoDriver', 'AsyncMongoDriver']
 logger = logging.getLogger(__name__)
 
 
@@ -26,13 +27,52 @@ class MongoDriver(TeleStateDatabaseDriver):
     }
     ```
     Note, if `user_id` or `chat_id` are `None`, that will be stored as `"null"`. See `msg_get_chat_and_user_mongo_prepared(...)`
+
+    On startup it creates a unique index on `(chat_id, user_id)` (unless `create_index=False`),
+    so loading is an index lookup and there is only ever one document per chat and user.
+    Saves are upserts, and `save_states_for_chat_users` (used by the `CachedDriver` to flush) sends one `bulk_write`
+    per `batch_size` states.
+
+    Any collection with the pymongo interface works, e.g. `mongomock.MongoClient().db.states` for tests.
     """
-    def __init__(self, mongodb_table):
-        assert isinstance(mongodb_table, Collection)
+    INDEX_NAME = 'chat_id_user_id'
+    PROJECTION = {'_id': False, 'state': True, 'data': True}  # everything we need to load a state.
+
+    def __init__(
+        self,
+        mongodb_table: Collection,
+        create_index: bool = True,
+        write_concern: Optional[WriteConcern] = None,
+        batch_size: int = 1_000,
+    ):
+        """
+        :param mongodb_table: The collection to store the states in.
+        :param create_index: If the unique `(chat_id, user_id)` index should be created, if missing.
+        :param write_concern: Write concern for the saves, e.g. `WriteConcern(w=1)`. `None` uses the collection's.
+        :param batch_size: Maximum number of states per `bulk_write`.
+        """
+        assert all(hasattr(mongodb_table, method) for method in ('find_one', 'replace_one', 'bulk_write')), \
+            'Needs a pymongo (compatible) collection.'
+        if write_concern is not None:
+            mongodb_table = mongodb_table.with_options(write_concern=write_concern)
+        # end if
         self.mongodb_table = mongodb_table
+        self.batch_size = batch_size
+        if create_index:
+            self.create_index()
+        # end if
         super().__init__()
     # end def
 
+    def create_index(self) -> None:
+        """
+        Creates the unique compound index on `(chat_id, user_id)`. Does nothing if it exists already.
+        """
+        self.mongodb_table.create_index(
+            [('chat_id', ASCENDING), ('user_id', ASCENDING)], name=self.INDEX_NAME, unique=True,
+        )
+    # end def
+
     def load_state_for_chat_user(
         self,
         chat_id: Union[int, str, None],
@@ -41,11 +81,12 @@ class MongoDriver(TeleStateDatabaseDriver):
         chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
         data = self.mongodb_table.find_one(
             filter={'chat_id': chat_id, 'user_id': user_id},
+            projection=self.PROJECTION,
         )
         if not data:
             return None, None
         # end if
-        return data['state'], data['data']
+        return data['state'], data.get('data')
     # end def
 
     @staticmethod
@@ -68,22 +109,106 @@ class MongoDriver(TeleStateDatabaseDriver):
         return chat_id, user_id
     # end def
 
-    def save_state_for_chat_user(
-        self,
+    @classmethod
+    def upsert_arguments(
+        cls,
         chat_id: Union[int, str, None],
         user_id: Union[int, str, None],
         state_name: str,
         state_data: JSONType
-    ) -> None:
-        chat_id, user_id = self.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
-        self.mongodb_table.replace_one(
+    ) -> Dict[str, Any]:
+        """
+        Arguments for `replace_one` (or `ReplaceOne`) storing a state, creating the document if it doesn't exist.
+        """
+        chat_id, user_id = cls.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
+        return dict(
             filter={'chat_id': chat_id, 'user_id': user_id},
             replacement={
                 'chat_id': chat_id,
                 'user_id': user_id,
                 'state': state_name,
                 'data': state_data,
-            }
+            },
+            upsert=True,
+        )
+    # end def
+
+    def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        self.mongodb_table.replace_one(**self.upsert_arguments(chat_id, user_id, state_name, state_data))
+    # end def
+
+    def save_states_for_chat_users(
+        self,
+        states: Iterable[Tuple[Union[int, str, None], Union[int, str, None], str, JSONType]]
+    ) -> None:
+        # only the last state per chat and user counts, then the order doesn't matter and the server can parallelize.
+        latest = {(chat_id, user_id): (state_name, state_data) for chat_id, user_id, state_name, state_data in states}
+        requests = [
+            ReplaceOne(**self.upsert_arguments(chat_id, user_id, state_name, state_data))
+            for (chat_id, user_id), (state_name, state_data) in latest.items()
+        ]
+        for i in range(0, len(requests), self.batch_size):
+            self.mongodb_table.bulk_write(requests[i:i + self.batch_size], ordered=False)
+        # end for
+    # end def
+# end class
+
+
+class AsyncMongoDriver(AsyncTeleStateDatabaseDriver):
+    """
+    The `MongoDriver` for the `AsyncTeleStateMachine`, using an asyncio collection like motor's:
+
+    >>> from motor.motor_asyncio import AsyncIOMotorClient
+    >>> driver = AsyncMongoDriver(AsyncIOMotorClient(url).bot.states)
+
+    Stores the same documents as the `MongoDriver`. Await `create_index()` once on startup.
+    """
+    def __init__(self, mongodb_table):
+        """
+        :param mongodb_table: A collection with coroutine `find_one` and `replace_one`, e.g. `AsyncIOMotorCollection`.
+        """
+        self.mongodb_table = mongodb_table
+        super().__init__()
+    # end def
+
+    async def create_index(self) -> None:
+        """
+        Creates the unique compound index on `(chat_id, user_id)`, like `MongoDriver.create_index`.
+        """
+        await self.mongodb_table.create_index(
+            [('chat_id', ASCENDING), ('user_id', ASCENDING)], name=MongoDriver.INDEX_NAME, unique=True,
         )
     # end def
+
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType]:
+        chat_id, user_id = MongoDriver.msg_get_chat_and_user_mongo_prepared(chat_id, user_id)
+        data = await self.mongodb_table.find_one(
+            filter={'chat_id': chat_id, 'user_id': user_id},
+            projection=MongoDriver.PROJECTION,
+        )
+        if not data:
+            return None, None
+        # end if
+        return data['state'], data.get('data')
+    # end def
+
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        await self.mongodb_table.replace_one(**MongoDriver.upsert_arguments(chat_id, user_id, state_name, state_data))
+    # end def
 # end class
@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
-from typing import Type, Union, Tuple, Optional
+import json
+from concurrent.futures import Executor
+from typing import Iterable, Type, Union, Tuple, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 from pony import orm
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, ThreadedAsyncDriver
 
 
 __author__ = 'luckydonald'
-__all__ = ['PonyDriver']
+__all__ = ['PonyDriver', 'AsyncPonyDriver']
 
 logger = logging.getLogger(__name__)
 if __name__ == '__main__':
@@ -20,6 +22,18 @@ if __name__ == '__main__':
 class PonyDriver(TeleStateDatabaseDriver):
     """
      A TeleStateMachine implementation preserving it's values in a sql instance via PonyORM.
+
+    There is one row per `(chat_id, user_id)`, enforced by a unique key, so saving is a single native upsert
+    (`INSERT ... ON CONFLICT ... DO UPDATE` on PostgreSQL and SQLite, `ON DUPLICATE KEY UPDATE` on MySQL),
+    and saves of different chats don't wait for each other.
+    `save_states_for_chat_users` writes many states in one transaction,
+    wrap the driver in a `CachedDriver` to batch the saves of the bot like that.
+
+    Tables created by older versions lack the unique key, add it before using the native upsert, e.g.
+    `CREATE UNIQUE INDEX unq_state__chat_id_user_id ON state (chat_id, user_id);` (after removing duplicates),
+    or pass `native_upsert=False`.
+    Rows with a `None` chat or user (inline queries, channels) are saved via the ORM, as SQL doesn't consider
+    `NULL` values equal for unique keys.
     """
 
     class State(object):
@@ -38,14 +52,29 @@ class PonyDriver(TeleStateDatabaseDriver):
     # end class
     StateTable: Type[State]
 
-    def __init__(self, db: orm.Database, state_table=None, state_upsert_lock=None):
+    UPSERT_PROVIDERS = ('postgres', 'sqlite', 'cockroach', 'mysql')
+
+    def __init__(
+        self,
+        db: orm.Database,
+        state_table=None,
+        state_upsert_lock=None,
+        native_upsert: Optional[bool] = None,
+        batch_size: int = 500,
+    ):
         """
         A TeleStateMachine implementation preserving it's values in a sql instance via PonyORM.
         :param db: The database instance to append our tables to.
         :param state_table: overwrite the db.State table. If None, the generate one will be accessible at `self.StateTable`.
-        :param state_upsert_lock: overwrite the db.StateUpsertLock table. If None, the generate one will be accessible at `self.UpsertLockTable`.
+                            It needs a unique key on `(chat_id, user_id)` for the native upsert.
+        :param state_upsert_lock: Deprecated and ignored, saves don't need a global lock anymore.
+        :param native_upsert: Use the database's upsert statement. `None` does so if the database supports it.
+        :param batch_size: Maximum number of states written per transaction by `save_states_for_chat_users`.
         """
         super().__init__()
+        self.db = db
+        self.native_upsert = native_upsert
+        self.batch_size = batch_size
 
         if state_table is not None:
             assert issubclass(state_table, self.State), "Needs to be subclass of PonyDriver.State"
@@ -57,17 +86,14 @@ class PonyDriver(TeleStateDatabaseDriver):
                 chat_id = orm.Optional(int, size=64, default=None, index=True, nullable=True)  # can be None (e.g. inline_query)
                 state = orm.Required(str)
                 data = orm.Optional(orm.Json, default=None, nullable=True)  # can be None
+                orm.composite_key(chat_id, user_id)
             # end class
             self.StateTable = State
         # end if
         if state_upsert_lock is not None:
-            self.UpsertLockTable = state_upsert_lock
-        else:
-            class StateUpsertLock(db.Entity):
-                pass
-            # end class
-            self.UpsertLockTable = StateUpsertLock
+            logger.warning('The state_upsert_lock table is not used anymore, saves are native upserts now.')
         # end if
+        self._upsert_sql: Optional[str] = None
     # end def
 
     @orm.db_session
@@ -92,8 +118,41 @@ class PonyDriver(TeleStateDatabaseDriver):
         state_name: str,
         state_data: JSONType
     ) -> None:
+        self._save(chat_id, user_id, state_name, state_data)
+    # end def
+
+    def save_states_for_chat_users(
+        self,
+        states: Iterable[Tuple[Union[int, str, None], Union[int, str, None], str, JSONType]]
+    ) -> None:
+        # only the last state per chat and user counts, and a fixed order avoids deadlocks between concurrent flushes.
+        latest = {(chat_id, user_id): (state_name, state_data) for chat_id, user_id, state_name, state_data in states}
+        keys = sorted(latest, key=lambda key: (key[0] is None, key[0] or 0, key[1] is None, key[1] or 0))
+        for i in range(0, len(keys), self.batch_size):
+            with orm.db_session:
+                for chat_id, user_id in keys[i:i + self.batch_size]:
+                    self._save(chat_id, user_id, *latest[(chat_id, user_id)])
+                # end for
+            # end with
+        # end for
+    # end def
 
-        ul = self.UpsertLockTable.select().for_update().first()  # enforce only one is in a session.
+    def _save(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        """
+        Writes a state, has to be called inside a `db_session`.
+        """
+        if chat_id is not None and user_id is not None and self._use_native_upsert():
+            self.db.execute(self._get_upsert_sql(), dict(
+                chat_id=chat_id, user_id=user_id, state=state_name, data=json.dumps(state_data),
+            ))
+            return
+        # end if
         logger.debug(f"Searching entry for chat {chat_id} and user {user_id}.")
         # noinspection PyUnresolvedReferences
         db_state = self.StateTable.get(
@@ -109,7 +168,7 @@ class PonyDriver(TeleStateDatabaseDriver):
                 data=state_data,
             )
         else:
-            logger.debug(f"Creating new entry for chat {chat_id} and user {user_id} with state {state_name!r} and data:\n{state_data!r}.")
+            logger.debug(f"Creating new entry for chat {chat_id} and user {user_id} with state {state_name!r}.")
             # noinspection PyArgumentList
             self.StateTable(
                 chat_id=chat_id,
@@ -119,4 +178,71 @@ class PonyDriver(TeleStateDatabaseDriver):
             )
         # end if
     # end def
+
+    def _use_native_upsert(self) -> bool:
+        if self.native_upsert is None:
+            self.native_upsert = self.db.provider_name in self.UPSERT_PROVIDERS
+        # end if
+        return self.native_upsert
+    # end def
+
+    def _get_upsert_sql(self) -> str:
+        """
+        The upsert statement for the state table, with `$chat_id`, `$user_id`, `$state` and `$data` parameters.
+        """
+        if self._upsert_sql is None:
+            quote = self.db.provider.quote_name
+            table = quote(self.StateTable._table_)
+            chat_id, user_id, state, data = (
+                quote(attr.column) for attr in (
+                    self.StateTable.chat_id, self.StateTable.user_id, self.StateTable.state, self.StateTable.data,
+                )
+            )
+            insert = (
+                f"INSERT INTO {table} ({chat_id}, {user_id}, {state}, {data}) "
+                f"VALUES ($chat_id, $user_id, $state, $data) "
+            )
+            if self.db.provider_name == 'mysql':
+                self._upsert_sql = insert + f"ON DUPLICATE KEY UPDATE {state} = VALUES({state}), {data} = VALUES({data})"
+            else:
+                self._upsert_sql = insert + (
+                    f"ON CONFLICT ({chat_id}, {user_id}) DO UPDATE SET {state} = excluded.{state}, {data} = excluded.{data}"
+                )
+            # end if
+        # end if
+        return self._upsert_sql
+    # end def
+# end class
+
+
+class AsyncPonyDriver(ThreadedAsyncDriver):
+    """
+    The `PonyDriver` for the `AsyncTeleStateMachine`.
+    PonyORM has no asyncio support, so the queries run on a thread pool, keeping the event loop free meanwhile.
+    """
+    def __init__(
+        self,
+        db: orm.Database,
+        state_table=None,
+        state_upsert_lock=None,
+        executor: Optional[Executor] = None,
+        native_upsert: Optional[bool] = None,
+    ):
+        """
+        :param db: The database instance to append our tables to, see `PonyDriver`.
+        :param state_table: overwrite the db.State table, see `PonyDriver`.
+        :param state_upsert_lock: Deprecated and ignored, see `PonyDriver`.
+        :param executor: The executor to run the queries in. `None` uses the event loop's default one.
+        :param native_upsert: Use the database's upsert statement, see `PonyDriver`.
+        """
+        super().__init__(
+            PonyDriver(db, state_table=state_table, state_upsert_lock=state_upsert_lock, native_upsert=native_upsert),
+            executor=executor,
+        )
+    # end def
+
+    @property
+    def StateTable(self):
+        return self.driver.StateTable
+    # end def
 # end class
@@ -1,34 +1,68 @@
 # -*- coding: utf-8 -*-
+import atexit
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
 from typing import Union, Tuple, Optional
 
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 
-from ..database_driver import TeleStateDatabaseDriver
+from ..database_driver import TeleStateDatabaseDriver, AsyncTeleStateDatabaseDriver
 
 __author__ = 'luckydonald'
-__all__ = ['SimpleDictDriver']
+__all__ = ['SimpleDictDriver', 'AsyncSimpleDictDriver']
 logger = logging.getLogger(__name__)
 
 
+Key = Tuple[Union[int, str, None], Union[int, str, None]]  # (chat_id, user_id)
+
+
 class SimpleDictDriver(TeleStateDatabaseDriver):
     """
     A TeleStateMachine implementation preserving it's values in an in-memory python dict.
 
-    Stored like `cache[chat_id][user_id] = (state, data)`:
+    Stored like `cache[(chat_id, user_id)] = (state, data, last_access)`, least recently used first:
     ```py
     {
-        '1000123123112': {
-            '1234': (
-                'DEFAULT',
-                {'some': 1, 'random': None, 'data': ['yay', 'wooho', 111]}
-            )
-        },
+        ('1000123123112', '1234'): (
+            'DEFAULT',
+            {'some': 1, 'random': None, 'data': ['yay', 'wooho', 111]},
+            1651234567.89,
+        ),
     }
+    ```
+
+    To stay bounded for long running bots,
+    - at most `max_size` chat/user states are kept, the least recently used one is dropped first,
+    - states not used for `ttl` seconds are dropped,
+    - if `snapshot_path` is given, the states are pickled there on `close()` (and at interpreter exit),
+      and loaded from there again on startup.
+    A dropped state simply starts at `DEFAULT` again.
     """
-    def __init__(self):
+    def __init__(
+        self,
+        max_size: Optional[int] = 100_000,
+        ttl: Optional[float] = None,
+        snapshot_path: Union[str, os.PathLike, None] = None,
+    ):
+        """
+        :param max_size: Maximum number of chat/user states kept. `None` for no limit.
+        :param ttl: Seconds after which a state not loaded or saved is dropped. `None` keeps them.
+        :param snapshot_path: File to keep the states in over restarts. `None` keeps them in memory only.
+        """
         logger.debug('creating new SimpleDictDriver instance.')
-        self.cache = dict()  # {'chat_id': {'user_id': 'state'}}
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.cache: 'OrderedDict[Key, Tuple[str, JSONType, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        if snapshot_path is not None:
+            self.load_snapshot()
+            atexit.register(self.close)
+        # end if
         super().__init__()
     # end def
 
@@ -37,19 +71,27 @@ class SimpleDictDriver(TeleStateDatabaseDriver):
         chat_id: Union[int, str, None],
         user_id: Union[int, str, None]
     ) -> Tuple[Optional[str], JSONType]:
-        logger.debug('states: {!r}'.format(self.cache))
-        cache_data = self.cache.get(chat_id, {})
-        # cache_data now contains all the users for the current chat, as dict.
-        state_name, cache_data = cache_data.get(user_id, (None, None))
-        # cache_data now is the state's data or None,
-        # state_name is the state's name or None.
-        logger.debug(f'cached state for {chat_id}|{user_id}: {state_name!r}\ndata: {cache_data!r}')
-        if state_name:
-            return state_name, cache_data
-        else:
-            logger.debug('no state found for update.')
+        key = (chat_id, user_id)
+        now = time.time()
+        with self._lock:
+            cached = self.cache.get(key)
+            if cached is not None and self.ttl is not None and cached[2] < now - self.ttl:
+                del self.cache[key]
+                cached = None
+            # end if
+            if cached is None:
+                logger.debug(f'no state found for {chat_id}|{user_id}.')
+                return None, None
+            # end if
+            state_name, state_data, _ = cached
+            self.cache[key] = (state_name, state_data, now)
+            self.cache.move_to_end(key)
+        # end with
+        logger.debug(f'cached state for {chat_id}|{user_id}: {state_name!r}')
+        if not state_name:
             return None, None
-        # end def
+        # end if
+        return state_name, state_data
     # end def
 
     def save_state_for_chat_user(
@@ -59,15 +101,107 @@ class SimpleDictDriver(TeleStateDatabaseDriver):
         state_name: str,
         state_data: JSONType
     ) -> None:
-        logger.debug(f'storing state for {chat_id}|{user_id}: {state_name!r}\ndata: {state_data!r}')
-
-        if chat_id not in self.cache:
-            # chat_id level does not exist, create, with the {user_id: (state_name, data)} already inserted.
-            self.cache[chat_id] = {user_id: (state_name, state_data)}
-        else:
-            # chat_id level does exist, just store the state in the user_id dict element. This can overwrite.
-            self.cache[chat_id][user_id] = (state_name, state_data)
+        logger.debug(f'storing state for {chat_id}|{user_id}: {state_name!r}')
+        key = (chat_id, user_id)
+        now = time.time()
+        with self._lock:
+            self.cache[key] = (state_name, state_data, now)
+            self.cache.move_to_end(key)
+            self._evict(now)
+        # end with
+    # end def
+
+    def _evict(self, now: float) -> None:
+        """
+        Drops the least recently used states, while there are too many or they are expired.
+        As the cache is ordered by last access, that only looks at the ones actually dropped (plus one).
+        """
+        while self.max_size is not None and len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        # end while
+        if self.ttl is not None:
+            deadline = now - self.ttl
+            while self.cache and next(iter(self.cache.values()))[2] < deadline:
+                self.cache.popitem(last=False)
+            # end while
+        # end if
+    # end def
+
+    def __len__(self) -> int:
+        return len(self.cache)
+    # end def
+
+    def save_snapshot(self) -> None:
+        """
+        Pickles all states to `snapshot_path`. Written to a temporary file first, so a crash can't leave half a file.
+        """
+        with self._lock:
+            states = list(self.cache.items())
+        # end with
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(states, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # end with
+        os.replace(tmp_path, self.snapshot_path)
+        logger.debug(f'saved {len(states)} states to {self.snapshot_path!r}.')
+    # end def
+
+    def load_snapshot(self) -> None:
+        """
+        Loads the states pickled to `snapshot_path`, if that exists. Expired ones are dropped right away.
+        """
+        if not os.path.exists(self.snapshot_path):
+            return
         # end if
-        logger.debug('states: {!r}'.format(self.cache))
+        with open(self.snapshot_path, 'rb') as f:
+            states = pickle.load(f)
+        # end with
+        with self._lock:
+            self.cache = OrderedDict(sorted(states, key=lambda item: item[1][2]))
+            self._evict(time.time())
+        # end with
+        logger.debug(f'loaded {len(self.cache)} states from {self.snapshot_path!r}.')
+    # end def
+
+    def close(self) -> None:
+        """
+        Writes the snapshot, if `snapshot_path` is set.
+        """
+        if self.snapshot_path is not None:
+            self.save_snapshot()
+        # end if
+    # end def
+# end class
+
+
+class AsyncSimpleDictDriver(AsyncTeleStateDatabaseDriver):
+    """
+    The `SimpleDictDriver` for the `AsyncTeleStateMachine`.
+    As it's all in memory, there is nothing to wait for, it simply calls the wrapped driver.
+    """
+    def __init__(self, driver: Optional[SimpleDictDriver] = None):
+        """
+        :param driver: The `SimpleDictDriver` holding the states. If `None`, a new one is created.
+        """
+        self.driver = SimpleDictDriver() if driver is None else driver
+        super().__init__()
+    # end def
+
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Optional[str], JSONType]:
+        return self.driver.load_state_for_chat_user(chat_id, user_id)
+    # end def
+
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        self.driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
     # end def
 # end class
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import asyncio
 from abc import abstractmethod
-from typing import Tuple, Union
+from concurrent.futures import Executor
+from typing import Iterable, Tuple, Union, Optional
 from luckydonaldUtils.logger import logging
 from luckydonaldUtils.typing import JSONType
 
@@ -51,4 +53,106 @@ class TeleStateDatabaseDriver(object):
         """
         raise NotImplementedError('Your database driver subclass must implement this.')
     # end def
+
+    def save_states_for_chat_users(
+        self,
+        states: Iterable[Tuple[Union[int, str, None], Union[int, str, None], str, JSONType]]
+    ) -> None:
+        """
+        Saves several states at once, used by write-behind caches to flush.
+        Subclasses can overwrite this with a bulk write, the default calls `save_state_for_chat_user` for each.
+
+        :param states: Tuples of `(chat_id, user_id, state_name, state_data)`.
+
+        :return: Nothing.
+        """
+        for chat_id, user_id, state_name, state_data in states:
+            self.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        # end for
+    # end def
+# end class
+
+
+class AsyncTeleStateDatabaseDriver(object):
+    """
+    Like `TeleStateDatabaseDriver`, but with coroutines, for the `AsyncTeleStateMachine`.
+    """
+    @abstractmethod
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType]:
+        """
+        Loads a state, and sets it.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+
+        :return: Tuple of the name of the state and optionally data.
+        """
+        raise NotImplementedError('Your database driver subclass must implement this.')
+    # end def
+
+    @abstractmethod
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        """
+        Saves the current state.
+
+        :param chat_id: ID of the user/group chat.
+        :param user_id: ID of the user.
+        :param state_name: the name of the current state.
+        :param state_data: the additional data for that state.
+
+        :return: Nothing.
+        """
+        raise NotImplementedError('Your database driver subclass must implement this.')
+    # end def
+# end class
+
+
+class ThreadedAsyncDriver(AsyncTeleStateDatabaseDriver):
+    """
+    Makes a blocking `TeleStateDatabaseDriver` usable with the `AsyncTeleStateMachine`,
+    by running it's calls on a thread pool, so they don't block the event loop.
+
+    Use this for backends without an asyncio client library, e.g. PonyORM.
+    """
+    def __init__(self, driver: TeleStateDatabaseDriver, executor: Optional[Executor] = None):
+        """
+        :param driver: The blocking driver to wrap.
+        :param executor: The executor to run it in. `None` uses the event loop's default one.
+        """
+        self.driver = driver
+        self.executor = executor
+        super().__init__()
+    # end def
+
+    async def load_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None]
+    ) -> Tuple[Union[str, None], JSONType]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.driver.load_state_for_chat_user, chat_id, user_id)
+    # end def
+
+    async def save_state_for_chat_user(
+        self,
+        chat_id: Union[int, str, None],
+        user_id: Union[int, str, None],
+        state_name: str,
+        state_data: JSONType
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, self.driver.save_state_for_chat_user, chat_id, user_id, state_name, state_data,
+        )
+    # end def
 # end class
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import atexit
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Union
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update as TGUpdate
+from teleflask.exceptions import AbortProcessingPlease
+
+__author__ = 'luckydonald'
+__all__ = ["UpdateDispatcher"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+_STOP = object()  # put into a worker's queue to let it exit.
+
+
+class UpdateDispatcher(object):
+    """
+    Processes updates on a pool of worker threads, instead of inline in the webhook request.
+
+    Every worker has its own bounded queue, and updates are sharded by chat (or by user, if there is no chat),
+    so all updates of a chat are processed by the same worker in the order they arrived,
+    while independent chats are processed in parallel.
+
+    If the queue of a chat's worker is full, `submit` blocks up to `put_timeout` seconds (forever if `None`),
+    which keeps the webhook request open and so slows down Telegram's delivery (backpressure).
+    If it is still full after that, the update is dropped and counted in `metrics()['rejected']`.
+
+    Usage example:
+
+    >>> dispatcher = UpdateDispatcher(states.process_update, workers=4)
+    >>> dispatcher.submit(update)  # returns as soon as it is queued.
+
+    Usually you don't create it directly, but call `TeleStateMachine.use_dispatcher(...)`.
+    """
+    def __init__(
+        self,
+        process_update: Callable[[TGUpdate], Any],
+        workers: int = 4,
+        queue_size: int = 100,
+        put_timeout: Union[float, None] = None,
+        name: str = 'telestate',
+    ):
+        """
+        :param process_update: The function processing one update, e.g. `TeleStateMachine.process_update`.
+        :param workers: Number of worker threads (and queues).
+        :param queue_size: Maximum number of waiting updates per worker.
+        :param put_timeout: Seconds `submit` waits for a full queue, before dropping the update. `None` waits forever.
+        :param name: Prefix of the worker thread names.
+        """
+        assert workers > 0, 'Need at least one worker.'
+        self.process_update = process_update
+        self.put_timeout = put_timeout
+        self.name = name
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Union[int, float]] = dict(
+            submitted=0, processed=0, failed=0, rejected=0, max_depth=0, processing_seconds=0.0,
+        )
+        self.running = False
+    # end def
+
+    def start(self) -> 'UpdateDispatcher':
+        if self.running:
+            return self
+        # end if
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self._work, args=(q,), name=f'{self.name}-worker-{i}', daemon=True)
+            for i, q in enumerate(self.queues)
+        ]
+        for thread in self.threads:
+            thread.start()
+        # end for
+        atexit.register(self.shutdown)
+        logger.debug(f'Started {len(self.threads)} update workers.')
+        return self
+    # end def
+
+    def shard(self, update: TGUpdate) -> int:
+        """
+        Index of the worker responsible for the chat (or user, for updates without a chat) of the given update.
+        """
+        from .machine import TeleStateMachine
+        chat_id, user_id = TeleStateMachine.update_get_chat_and_user(update)
+        key = chat_id if chat_id is not None else user_id
+        return hash(key) % len(self.queues)
+    # end def
+
+    def submit(self, update: TGUpdate) -> bool:
+        """
+        Queues an update for processing.
+
+        :return: If the update got queued. `False` if the worker's queue stayed full for `put_timeout` seconds.
+        """
+        if not self.running:
+            self.start()
+        # end if
+        q = self.queues[self.shard(update)]
+        try:
+            q.put(update, timeout=self.put_timeout)
+        except queue.Full:
+            self._count('rejected')
+            logger.warning(f'Update queue full ({q.maxsize} updates), dropping update {update.update_id!r}.')
+            return False
+        # end try
+        with self._lock:
+            self._counters['submitted'] += 1
+            self._counters['max_depth'] = max(self._counters['max_depth'], q.qsize())
+        # end with
+        return True
+    # end def
+
+    def queue_depths(self) -> List[int]:
+        """
+        Number of updates waiting per worker.
+        """
+        return [q.qsize() for q in self.queues]
+    # end def
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Counters since start, plus the current queue depths. Cheap enough to be polled by a health endpoint.
+        """
+        with self._lock:
+            metrics = dict(self._counters)
+        # end with
+        metrics['queue_depths'] = self.queue_depths()
+        metrics['queued'] = sum(metrics['queue_depths'])
+        metrics['workers'] = len(self.queues)
+        return metrics
+    # end def
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stops the workers after they have processed what is already queued.
+        """
+        if not self.running:
+            return
+        # end if
+        self.running = False
+        for q in self.queues:
+            q.put(_STOP)
+        # end for
+        if wait:
+            for thread in self.threads:
+                thread.join()
+            # end for
+        # end if
+        atexit.unregister(self.shutdown)
+        logger.debug('Stopped update workers.')
+    # end def
+
+    def _count(self, counter: str, value: Union[int, float] = 1) -> None:
+        with self._lock:
+            self._counters[counter] += value
+        # end with
+    # end def
+
+    def _work(self, q: queue.Queue) -> None:
+        while True:
+            update = q.get()
+            if update is _STOP:
+                return
+            # end if
+            start = time.perf_counter()
+            # noinspection PyBroadException
+            try:
+                self.process_update(update)
+            except AbortProcessingPlease:
+                # nothing is processed after us anyway.
+                logger.debug('Update processing got aborted (AbortProcessingPlease).')
+            except:
+                self._count('failed')
+                logger.exception('Update processing failed.')
+            # end try
+            with self._lock:
+                self._counters['processed'] += 1
+                self._counters['processing_seconds'] += time.perf_counter() - start
+            # end with
+        # end while
+    # end def
+# end class
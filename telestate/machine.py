@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import inspect
 from abc import ABC
+from contextvars import ContextVar
 from typing import Dict, cast, Union, Any, Callable, Tuple, Optional, Type
 
 from luckydonaldUtils.exceptions import assert_type_or_raise
@@ -14,15 +15,12 @@ from teleflask.server.blueprints import TBlueprintSetupState
 from teleflask.server.mixins import StartupMixin
 
 from telestate.constants import KEEP_PREVIOUS
+from .context import StateContext, ChatLocks
 from .state import TeleState, assert_can_be_name, can_be_name
 from .database_driver import TeleStateDatabaseDriver
-
-# if available use pformat for printing the current data.
-try:
-    from pprint import pformat
-except ImportError:
-    pformat = repr
-# end if
+from .dispatcher import UpdateDispatcher
+from .serializer import StateSerializer
+from .tracing import LazyPformat, StateTracer
 
 __author__ = 'luckydonald'
 __all__ = ["TeleStateMachine"]
@@ -50,28 +48,51 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
     >>> states = TeleStateMachine(__name__, driver=SimpleDictDriver())  # choose any driver like `SimpleDictDriver`, see the contrib folder.
 
     You can access the current state via `states.CURRENT`, and the default state for a new user/chat is `states.DEFAULT`.
+    `CURRENT` (and the `data` and `update` of it) is kept per update in a `contextvars.ContextVar`,
+    so updates can be processed concurrently from several threads or asyncio tasks.
+    Updates of the same chat and user are still processed one after another, see `ChatLocks`.
+
+    By default updates are processed inline, while the webhook request waits.
+    Call `states.use_dispatcher(workers=4)` to acknowledge them immediately and process them on a worker pool instead,
+    see `UpdateDispatcher`.
 
     You switch the state with `states.set('EXAMPLE_STATE')`, or `states.EXAMPLE_STATE.activate()`.
     If you want to store additional data, both commands support `data='1234'` parameter.
     That data can be any type, which your storage backend is able to process.
     Using basic python types (`dict`, `list`, `str`, `int`, `bool` and `None`) should be safe to use with most of them.
+    With `serializer=MsgpackSerializer()` (see `telestate.serializer`) the data is stored as compact bytes instead.
+
+    The loaded and stored data is only logged on DEBUG level. For timings, state transitions and sizes of
+    (a sample of) the processed updates, set a `StateTracer`, e.g. `states.tracer = StateTracer(sample_rate=0.01)`.
     """
     is_registered: bool  # if we did call self.register_teleflask()
     listeners_registered: bool  # if we did call self.register_listeners()
     blueprint: Union[Teleflask, TBlueprint]
     active_state: Union[None, TeleState]
+    dispatcher: Union[None, UpdateDispatcher]
+    serializer: Union[None, StateSerializer]
+    tracer: StateTracer
     did_init: bool
 
+    state_class: Type[TeleState] = TeleState  # used for DEFAULT, ALL and states registered by name only
+    database_driver_class: Type = TeleStateDatabaseDriver
+
     def __init__(
         self,
         name: str,
         database_driver: Union[Type[TeleStateDatabaseDriver], TeleStateDatabaseDriver],
-        teleflask_or_tblueprint: Teleflask = None
+        teleflask_or_tblueprint: Teleflask = None,
+        serializer: Optional[StateSerializer] = None,
     ):
         self.did_init = False
         self.listeners_registered = False
+        self._context: ContextVar[Optional[StateContext]] = ContextVar(f'telestate_{name}', default=None)
+        self.chat_locks = ChatLocks()
+        self.dispatcher = None
+        self.serializer = serializer
+        self.tracer = StateTracer()
         self.states: Dict[str, TeleState] = {}  # NAME: telestate_instance
-        assert_type_or_raise(database_driver, TeleStateDatabaseDriver, parameter_name='driver')
+        assert_type_or_raise(database_driver, self.database_driver_class, parameter_name='driver')
         self.database_driver = database_driver
         super(TeleStateMachine, self).__init__()
         if teleflask_or_tblueprint:
@@ -95,8 +116,8 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         # end if
         self.active_state = None
 
-        self.DEFAULT = TeleState('DEFAULT', self)
-        self.ALL = TeleState('ALL', self)  # so you can register to states.ALL to be called on all the states.
+        self.DEFAULT = self.state_class('DEFAULT', self)
+        self.ALL = self.state_class('ALL', self)  # so you can register to states.ALL to be called on all the states.
         self.CURRENT = self.DEFAULT
         self.did_init = True
     # end def
@@ -128,7 +149,7 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
     def register_listeners(self):
         """
-        Register the do_startup and process_update methods for retrieving updates.
+        Register the do_startup and receive_update methods for retrieving updates.
         :return:
         """
         if self.listeners_registered:
@@ -137,7 +158,36 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         # end if
         self.listeners_registered = True
         self.blueprint.on_startup(self.do_startup)
-        self.blueprint.on_update(self.process_update)
+        self.blueprint.on_update(self.receive_update)
+    # end def
+
+    def use_dispatcher(self, workers: int = 4, queue_size: int = 100, put_timeout: Optional[float] = None) -> UpdateDispatcher:
+        """
+        Process updates on `workers` threads instead of inline in the webhook request.
+        Updates of a chat stay in order, see `UpdateDispatcher` for the parameters.
+
+        Note, as the webhook already returned, an `AbortProcessingPlease` raised by a state
+        can't stop other listeners of the bot anymore.
+
+        :return: The started dispatcher, e.g. to read it's `metrics()`.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        # end if
+        self.dispatcher = UpdateDispatcher(
+            self.process_update, workers=workers, queue_size=queue_size, put_timeout=put_timeout,
+        ).start()
+        return self.dispatcher
+    # end def
+
+    def receive_update(self, update):
+        """
+        Listener for incoming updates: hands them to the dispatcher if one is used, else processes them right away.
+        """
+        if self.dispatcher is None:
+            return self.process_update(update)
+        # end if
+        self.dispatcher.submit(update)
     # end def
 
     def register_state(self, name, state=None):
@@ -200,14 +250,14 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
                 self.states[name] = state
             else:
                 logger.debug('Name given only. Replacing state {!r} with new state.'.format(self.states[name]))
-                self.states[name] = TeleState(name, self)
+                self.states[name] = self.state_class(name, self)
             # end def
             return self.states[name]
         else:
             logger.debug('State {name!r} does not exist. Adding newly.'.format(name=name))
             if not state:  # name given only
                 logger.debug('Name given only. Creating new state.')
-                state = TeleState(name, self)
+                state = self.state_class(name, self)
             else:  # name + state given
                 logger.debug('Registering state.')
                 state.register_machine(self, name)
@@ -249,6 +299,36 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
     __str__ = __repr__
 
+    @property
+    def CURRENT(self) -> TeleState:
+        """
+        The state active for the update processed in the calling thread or asyncio task, `DEFAULT` outside of one.
+        """
+        context = self._context.get()
+        if context is None:
+            return self.DEFAULT
+        # end if
+        return context.state
+    # end def
+
+    @CURRENT.setter
+    def CURRENT(self, state: TeleState):
+        context = self._context.get()
+        if context is None:
+            self._context.set(StateContext(state))
+        else:
+            context.state = state
+        # end if
+    # end def
+
+    @property
+    def context(self) -> Optional[StateContext]:
+        """
+        The `StateContext` of the update processed in the calling thread or asyncio task, if any.
+        """
+        return self._context.get()
+    # end def
+
     def set(
         self,
         state: Union[TeleState, str, None],
@@ -266,9 +346,11 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
         :return: The new current state, i.e. the one you just applied.
         """
-        logger.debug('going to set state {!r}'.format(state))
-        logger.debug('got state data: {!r}'.format(data))
-        logger.debug('got update meta: {!r}'.format(update))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('going to set state %r', state)
+            logger.debug('got state data: %s', LazyPformat(data))
+            logger.debug('got update meta: %r', update)
+        # end if
         assert_type_or_raise(state, str, TeleState, None, parameter_name='state')
         if isinstance(state, TeleState):
             if state.name not in self.states:
@@ -312,30 +394,22 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
 
     def process_update(self, update):
         chat_id, user_id = self.update_get_chat_and_user(update)
+        with self.chat_locks(chat_id, user_id):
+            # a fresh context per update, so neither other threads nor the next update see this one's state.
+            token = self._context.set(StateContext(self.DEFAULT))
+            try:
+                self._process_update(update, chat_id, user_id)
+            finally:
+                self._context.reset(token)
+            # end try
+        # end with
+    # end def
+
+    def _process_update(self, update, chat_id, user_id):
+        trace = self.tracer.begin(chat_id, user_id)
         state_name, state_data = self.database_driver.load_state_for_chat_user(chat_id, user_id)
-        logger.info(
-            f"Loading state {state_name!r} for user {user_id!r} in chat {chat_id!r}.\n"
-            f"Data: {pformat(state_data)}"
-        )
-        if state_name is None:
-            state_name = "DEFAULT"
-        # end if
-        abort_e = None
-        try:
-            state_data = self.deserialize(state_name, state_data)
-        except:
-            # resets state, make sure we can still function at all.
-            logger.exception(
-                "Error in deserialize, resetting state to DEFAULT (None):\n"
-                f"Old state: {state_name}\n"
-                f"Lost data: {state_data!r}"
-            )
-            state_name, state_data = None, None
-        # end try
-        self.set(state_name, data=state_data, update=update)
-        assert self.CURRENT.name == state_name or (state_name is None and self.CURRENT.name == "DEFAULT")
-        current: TeleState = self.CURRENT  # to suppress race-conditions of the logging exception and setting of states.
-        logger.debug('Got update for state {}.'.format(current.name))
+        trace.loaded(state_name, state_data)
+        current = self._activate_loaded_state(update, chat_id, user_id, state_name, state_data)
         # noinspection PyBroadException
         try:
             # noinspection PyBroadException
@@ -363,10 +437,67 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
         else:
             abort_e = None
         # end try
+        trace.handled(aborted=abort_e is not None)
+        state_name, state_data = self._serialize_current_state(chat_id, user_id, state_data)
+        self.database_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
+        trace.stored(state_name, state_data)
+        self.tracer.finish(trace)
+        if abort_e:
+            logger.debug('Re-raising AbortProcessingPlease exception.')
+            raise abort_e  # re-raise so we don't process other stuff afterwards.
+        # end if
+    # end def
+
+    def _activate_loaded_state(self, update, chat_id, user_id, state_name, state_data) -> TeleState:
+        """
+        Deserializes the state as loaded from the database, and sets it as `CURRENT` for this update.
+
+        :return: The now current state.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Loading state %r for user %r in chat %r.\nData: %s", state_name, user_id, chat_id, LazyPformat(state_data),
+            )
+        # end if
+        if state_name is None:
+            state_name = "DEFAULT"
+        # end if
+        try:
+            if self.serializer is not None:
+                state_data = self.serializer.loads(state_data)
+            # end if
+            state_data = self.deserialize(state_name, state_data)
+        except:
+            # resets state, make sure we can still function at all.
+            logger.exception(
+                "Error in deserialize, resetting state to DEFAULT (None):\n"
+                f"Old state: {state_name}\n"
+                f"Lost data: {state_data!r}"
+            )
+            state_name, state_data = None, None
+        # end try
+        self.set(state_name, data=state_data, update=update)
+        assert self.CURRENT.name == state_name or (state_name is None and self.CURRENT.name == "DEFAULT")
+        current: TeleState = self.CURRENT  # to suppress race-conditions of the logging exception and setting of states.
+        logger.debug('Got update for state %s.', current.name)
+        return current
+    # end def
+
+    def _serialize_current_state(self, chat_id, user_id, state_data) -> Tuple[Optional[str], JSONType]:
+        """
+        Serializes the `CURRENT` state after processing, to be written to the database.
+
+        :param state_data: The data as loaded, only used for logging if serialisation fails.
+
+        :return: Tuple of the name of the state and the serialized data.
+        """
         state_name = self.CURRENT.name
         # noinspection PyBroadException
         try:
             state_data = self.serialize(state_name, self.CURRENT.data)
+            if self.serializer is not None:
+                state_data = self.serializer.dumps(state_data)
+            # end if
         except:
             # resets state, make sure we can still function at all.
             logger.exception(
@@ -376,15 +507,12 @@ class TeleStateMachine(StartupMixin, TeleflaskMixinBase):
             )
             state_name, state_data = None, None
         # end try
-        logger.info(
-            f"Storing state {state_name!r} for user {user_id!r} in chat {chat_id!r}.\n"
-            f"Data: {pformat(state_data)}"
-        )
-        self.database_driver.save_state_for_chat_user(chat_id, user_id, state_name, state_data)
-        if abort_e:
-            logger.debug('Re-raising AbortProcessingPlease exception.')
-            raise abort_e  # re-raise so we don't process other stuff afterwards.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Storing state %r for user %r in chat %r.\nData: %s", state_name, user_id, chat_id, LazyPformat(state_data),
+            )
         # end if
+        return state_name, state_data
     # end def
 
     @property
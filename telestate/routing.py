@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from luckydonaldUtils.logger import logging
+from pytgbot.api_types.receivable.updates import Update
+from teleflask.exceptions import AbortProcessingPlease
+from teleflask.server.mixins import MessagesMixin, UpdatesMixin
+
+__author__ = 'luckydonald'
+__all__ = ["ListenerIndex", "IndexedMessagesMixin", "IndexedUpdatesMixin", "UPDATE_TYPES", "MESSAGE_CONTENT_TYPES"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+# the attributes of an update, of which (usually) exactly one is set.
+UPDATE_TYPES = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query', 'chosen_inline_result',
+    'callback_query', 'shipping_query', 'pre_checkout_query', 'poll', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request',
+)
+
+# the attributes of a message telling what kind of message it is.
+MESSAGE_CONTENT_TYPES = (
+    'text', 'animation', 'audio', 'document', 'photo', 'sticker', 'video', 'video_note', 'voice', 'caption',
+    'contact', 'dice', 'game', 'poll', 'venue', 'location', 'new_chat_members', 'left_chat_member', 'new_chat_title',
+    'new_chat_photo', 'delete_chat_photo', 'group_chat_created', 'supergroup_chat_created', 'channel_chat_created',
+    'migrate_to_chat_id', 'migrate_from_chat_id', 'pinned_message', 'invoice', 'successful_payment',
+    'connected_website', 'passport_data', 'reply_markup',
+)
+
+# listener: [required keywords, ...], as teleflask stores them. `None` or `[]` allow everything.
+Listeners = Dict[Callable, List[Optional[List[str]]]]
+Route = List[Tuple[Callable, List[Optional[List[str]]]]]
+
+
+class ListenerIndex(object):
+    """
+    Finds the listeners which can apply to an update (or message), without looking at all of them.
+
+    The `fields` set on the update form the routing key, e.g. `('callback_query',)` or `('text', 'reply_markup')`.
+    On the first update with a key, all listeners are checked once. Those requiring a field which isn't part
+    of the key can never match, the others are cached as the route for that key.
+    Following updates only look up the route, so the cost doesn't grow with the number of registered listeners.
+    The requirements on attributes which are not in `fields` are still checked for every update, on the route only.
+
+    Call `invalidate()` whenever the listeners change.
+    """
+    def __init__(self, fields: Tuple[str, ...], max_routes: int = 256):
+        self.fields = fields
+        self.field_set: FrozenSet[str] = frozenset(fields)
+        self.max_routes = max_routes
+        self.routes: Dict[Tuple[str, ...], Route] = {}
+    # end def
+
+    def invalidate(self) -> None:
+        self.routes.clear()
+    # end def
+
+    def key(self, obj: Any) -> Tuple[str, ...]:
+        return tuple(field for field in self.fields if getattr(obj, field, None))
+    # end def
+
+    def route(self, listeners: Listeners, obj: Any) -> Route:
+        key = self.key(obj)
+        route = self.routes.get(key)
+        if route is None:
+            if len(self.routes) >= self.max_routes:
+                self.routes.clear()
+            # end if
+            route = self.routes[key] = self.compile(listeners, frozenset(key))
+            logger.debug('Compiled route for %r: %d of %d listeners.', key, len(route), len(listeners))
+        # end if
+        return route
+    # end def
+
+    def compile(self, listeners: Listeners, present: FrozenSet[str]) -> Route:
+        route = []
+        for listener, required_fields_array in listeners.items():
+            possible = [
+                required_fields for required_fields in required_fields_array
+                if not required_fields or all(f in present for f in required_fields if f in self.field_set)
+            ]
+            if possible:
+                route.append((listener, possible))
+            # end if
+        # end for
+        return route
+    # end def
+# end class
+
+
+def call_listeners(mixin, route: Route, obj: Any, update: Update, *args) -> bool:
+    """
+    Calls the listeners of the route whose requirements `obj` fulfills, like the teleflask mixins do.
+
+    :return: If processing should stop, i.e. a listener raised `AbortProcessingPlease`.
+    """
+    for listener, required_fields_array in route:
+        for required_fields in required_fields_array:
+            try:
+                if not required_fields or all([hasattr(obj, f) and getattr(obj, f) for f in required_fields]):
+                    mixin.process_result(update, listener(update, *args))
+                    break  # stop processing other required_fields combinations
+                # end if
+            except AbortProcessingPlease as e:
+                logger.debug('Asked to stop processing updates.')
+                if e.return_value:
+                    mixin.process_result(update, e.return_value)
+                # end if
+                return True
+            except Exception:
+                logger.exception("Error executing the update listener {func}.".format(func=listener))
+            # end try
+        # end for
+    # end for
+    return False
+# end def
+
+
+class IndexedUpdatesMixin(UpdatesMixin):
+    """
+    `UpdatesMixin`, but only calling the listeners the `ListenerIndex` routes the update's type to.
+    """
+    def __init__(self, *args, **kwargs):
+        self.update_index = ListenerIndex(UPDATE_TYPES)
+        super().__init__(*args, **kwargs)
+    # end def
+
+    def add_update_listener(self, function, required_keywords=None):
+        self.update_index.invalidate()
+        return super().add_update_listener(function, required_keywords=required_keywords)
+    # end def
+
+    def remove_update_listener(self, func):
+        self.update_index.invalidate()
+        return super().remove_update_listener(func)
+    # end def
+
+    def process_update(self, update):
+        assert isinstance(update, Update)
+        if call_listeners(self, self.update_index.route(self.update_listeners, update), update, update):
+            return  # not calling super().process_update(update)
+        # end if
+        super(UpdatesMixin, self).process_update(update)  # skip the unindexed UpdatesMixin.process_update
+    # end def
+# end class
+
+
+class IndexedMessagesMixin(MessagesMixin):
+    """
+    `MessagesMixin`, but only calling the listeners the `ListenerIndex` routes the message's content type to.
+    """
+    def __init__(self, *args, **kwargs):
+        self.message_index = ListenerIndex(MESSAGE_CONTENT_TYPES)
+        super().__init__(*args, **kwargs)
+    # end def
+
+    def add_message_listener(self, function, required_keywords=None):
+        self.message_index.invalidate()
+        return super().add_message_listener(function, required_keywords=required_keywords)
+    # end def
+
+    def remove_message_listeners(self, func):
+        self.message_index.invalidate()
+        return super().remove_message_listeners(func)
+    # end def
+
+    def process_update(self, update):
+        assert isinstance(update, Update)
+        if update.message:
+            msg = update.message
+            if call_listeners(self, self.message_index.route(self.message_listeners, msg), msg, update, msg):
+                return  # not calling super().process_update(update)
+            # end if
+        # end if
+        super(MessagesMixin, self).process_update(update)  # skip the unindexed MessagesMixin.process_update
+    # end def
+# end class
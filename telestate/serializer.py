@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Type
+
+from luckydonaldUtils.logger import logging
+from luckydonaldUtils.typing import JSONType
+
+# msgpack is optional, without it only the JSON serializer is available.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+# end try
+
+__author__ = 'luckydonald'
+__all__ = ["StateSerializer", "JSONSerializer", "MsgpackSerializer"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class StateSerializer(ABC):
+    """
+    Turns the (already `TeleStateMachine.serialize`d) state data into bytes for the database, and back.
+
+    Every blob starts with one byte naming the format, so `loads` of any serializer reads the blobs of all the others,
+    and data stored before a serializer was used (anything not `bytes`) is passed through unchanged.
+    That way the serializer of a bot can be switched without migrating the database.
+
+    Note, the driver has to be able to store `bytes`, like the `SimpleDictDriver`, `CachedDriver` and `MongoDriver` do.
+    The `Json` column of the `PonyDriver` can't.
+    """
+    FORMAT: bytes
+    # format byte: serializer class, every subclass defining a `FORMAT` is registered.
+    formats: Dict[bytes, Type['StateSerializer']] = {}
+    # format byte: instance used to read blobs of other serializers, created on first use.
+    readers: Dict[bytes, 'StateSerializer'] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'FORMAT' in cls.__dict__:
+            StateSerializer.formats[cls.FORMAT] = cls
+            StateSerializer.readers.pop(cls.FORMAT, None)
+        # end if
+    # end def
+
+    def dumps(self, data: JSONType) -> bytes:
+        return self.FORMAT + self.encode(data)
+    # end def
+
+    def loads(self, blob: Any) -> JSONType:
+        if not isinstance(blob, (bytes, bytearray, memoryview)):
+            return blob
+        # end if
+        blob = bytes(blob)
+        serializer = self if blob[:1] == self.FORMAT else self.reader(blob[:1])
+        return serializer.decode(blob[1:])
+    # end def
+
+    @staticmethod
+    def reader(format_byte: bytes) -> 'StateSerializer':
+        """
+        An instance of the serializer registered for `format_byte`, created without arguments.
+        """
+        serializer = StateSerializer.readers.get(format_byte)
+        if serializer is None:
+            serializer_class = StateSerializer.formats.get(format_byte)
+            if serializer_class is None:
+                raise ValueError(f'Unknown state serialisation format {format_byte!r}.')
+            # end if
+            serializer = StateSerializer.readers[format_byte] = serializer_class()
+        # end if
+        return serializer
+    # end def
+
+    @abstractmethod
+    def encode(self, data: JSONType) -> bytes:
+        raise NotImplementedError('Your serializer subclass must implement this.')
+    # end def
+
+    @abstractmethod
+    def decode(self, blob: bytes) -> JSONType:
+        raise NotImplementedError('Your serializer subclass must implement this.')
+    # end def
+# end class
+
+
+class JSONSerializer(StateSerializer):
+    """
+    Compact UTF-8 JSON, without any whitespace.
+    """
+    FORMAT = b'j'
+
+    def encode(self, data: JSONType) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    # end def
+
+    def decode(self, blob: bytes) -> JSONType:
+        return json.loads(blob)
+    # end def
+# end class
+
+
+class MsgpackSerializer(StateSerializer):
+    """
+    MessagePack, needs the `msgpack` package. Smaller than JSON and faster to encode and decode.
+    Tuples come back as lists, like with JSON.
+    """
+    FORMAT = b'm'
+
+    def encode(self, data: JSONType) -> bytes:
+        if msgpack is None:
+            raise ImportError('The MsgpackSerializer needs the msgpack package: pip install msgpack')
+        # end if
+        return msgpack.packb(data, use_bin_type=True)
+    # end def
+
+    def decode(self, blob: bytes) -> JSONType:
+        if msgpack is None:
+            raise ImportError('The MsgpackSerializer needs the msgpack package: pip install msgpack')
+        # end if
+        return msgpack.unpackb(blob, raw=False, strict_map_key=False)
+    # end def
+# end class
+
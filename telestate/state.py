@@ -8,12 +8,14 @@ from luckydonaldUtils.typing import JSONType
 from pytgbot.api_types.receivable.updates import Update
 from teleflask import TBlueprint, Teleflask
 from teleflask.server.base import TeleflaskMixinBase
-from teleflask.server.mixins import BotCommandsMixin, MessagesMixin, RegisterBlueprintsMixin, UpdatesMixin
+from teleflask.server.mixins import BotCommandsMixin, RegisterBlueprintsMixin
 
 __author__ = 'luckydonald'
 __all__ = ["TeleStateUpdateHandler", "TeleState"]
 
 from telestate.constants import KEEP_PREVIOUS
+from telestate.context import StateContext
+from telestate.routing import IndexedMessagesMixin, IndexedUpdatesMixin
 
 logger = logging.getLogger(__name__)
 if __name__ == '__main__':
@@ -79,11 +81,13 @@ def can_be_name(name: str, allow_defaults: bool = False) -> bool:
 # end def
 
 
-class TeleStateUpdateHandler(RegisterBlueprintsMixin, BotCommandsMixin, MessagesMixin, UpdatesMixin, TeleflaskMixinBase):
+class TeleStateUpdateHandler(RegisterBlueprintsMixin, BotCommandsMixin, IndexedMessagesMixin, IndexedUpdatesMixin, TeleflaskMixinBase):
     """
     This class does the actual @command, @on_update, etc. logic, by extending the mixins providing that functionality.
 
     TeleStateMachine.process_update will call the current state's TeleStateUpdateHandler's process_update, which will leave that to the mixins.
+    Commands are looked up by name, message and update listeners are routed by the message's content and update's type,
+    see `telestate.routing.ListenerIndex`. Every state has it's own handler, so it's own routes.
     """
 
     def __init__(self, wrapped_state, teleflask, *args, **kwargs):
@@ -143,8 +147,8 @@ class TeleState(TBlueprint):
     warn_on_modifications: bool = True
 
     machine: Union['TeleStateMachine', None]
-    data: Union[Any, None]
-    update: Union[Update, None]  # store the update activation this. Used for sending/updating menus.
+    _data: Union[Any, None]  # only used while this state is not the CURRENT one of an update, see `data`.
+    _update: Union[Update, None]
     update_handler: Union[TeleStateUpdateHandler, None]
 
     def __init__(self, name=None, machine: 'TeleStateMachine' = None):
@@ -164,8 +168,8 @@ class TeleState(TBlueprint):
         assert machine is None or isinstance(machine, TeleStateMachine)
 
         self.machine: Union[TeleStateMachine, None] = None  # set by self.register_machine(...), below
-        self.data = None
-        self.update = None
+        self._data = None
+        self._update = None
         self.update_handler: Union[TeleStateUpdateHandler, None] = None
         super(TeleState, self).__init__(name)  # writes self.name
 
@@ -287,13 +291,70 @@ class TeleState(TBlueprint):
 
     # end def
 
+    def _current_context(self) -> Union[StateContext, None]:
+        """
+        The context of the update processed in the calling thread or asyncio task, if this state is active in it.
+        """
+        if self.machine is None:
+            return None
+        # end if
+        context = self.machine.context
+        if context is None or context.state is not self:
+            return None
+        # end if
+        return context
+
+    # end def
+
+    @property
+    def data(self) -> Union[Any, None]:
+        """
+        The additional data of this state, for the update currently processed.
+        """
+        context = self._current_context()
+        return self._data if context is None else context.data
+
+    # end def
+
+    @data.setter
+    def data(self, data: Union[JSONType, Any]):
+        self.set_data(data)
+
+    # end def
+
+    @property
+    def update(self) -> Union[Update, None]:
+        """
+        The update which activated this state. Used for sending/updating menus.
+        """
+        context = self._current_context()
+        return self._update if context is None else context.update
+
+    # end def
+
+    @update.setter
+    def update(self, update: Union[Update, None]):
+        self.set_update(update)
+
+    # end def
+
     def set_data(self, data: Union[JSONType, Any]):
-        self.data = data
+        context = self._current_context()
+        if context is None:
+            self._data = data
+        else:
+            context.data = data
+        # end if
 
     # end def
 
     def set_update(self, update: Union[Update, None]):
-        self.update = update
+        context = self._current_context()
+        if context is None:
+            self._update = update
+        else:
+            context.update = update
+        # end if
 
     # end def
 
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from luckydonaldUtils.logger import logging
+
+# if available use pformat for printing the current data.
+try:
+    from pprint import pformat
+except ImportError:
+    pformat = repr
+# end try
+
+__author__ = 'luckydonald'
+__all__ = ["LazyPformat", "UpdateTrace", "StateTracer"]
+
+logger = logging.getLogger(__name__)
+if __name__ == '__main__':
+    logging.add_colored_handler(level=logging.DEBUG)
+# end if
+
+
+class LazyPformat(object):
+    """
+    Pretty prints the value only when the log message is actually formatted, use as a `%s` logging argument:
+
+    >>> logger.debug('Data: %s', LazyPformat(state_data))
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+    # end def
+
+    def __str__(self):
+        return pformat(self.value)
+    # end def
+
+    __repr__ = __str__
+# end class
+
+
+def data_size(data: Any) -> Union[int, None]:
+    """
+    Size of stored state data, if that is known without encoding it (i.e. it is `bytes` or `str` already).
+    """
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    # end if
+    return None
+# end def
+
+
+class UpdateTrace(object):
+    """
+    Timings and state transition of processing one update. Created for every update, so it only records
+    timestamps and references, everything else is computed in `as_dict()`, if the trace is actually emitted.
+    """
+    __slots__ = (
+        'chat_id', 'user_id', 'from_state', 'to_state', 'loaded_data', 'stored_data', 'aborted',
+        'started', 'loaded_at', 'handled_at', 'stored_at',
+    )
+
+    def __init__(self, chat_id: Union[int, str, None], user_id: Union[int, str, None]):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.from_state = self.to_state = None
+        self.loaded_data = self.stored_data = None
+        self.aborted = False
+        self.started = time.perf_counter()
+        self.loaded_at = self.handled_at = self.stored_at = None
+    # end def
+
+    def loaded(self, state_name: Optional[str], state_data: Any) -> None:
+        self.loaded_at = time.perf_counter()
+        self.from_state = state_name
+        self.loaded_data = state_data
+    # end def
+
+    def handled(self, aborted: bool = False) -> None:
+        self.handled_at = time.perf_counter()
+        self.aborted = aborted
+    # end def
+
+    def stored(self, state_name: Optional[str], state_data: Any) -> None:
+        self.stored_at = time.perf_counter()
+        self.to_state = state_name
+        self.stored_data = state_data
+    # end def
+
+    @property
+    def duration(self) -> float:
+        return (self.stored_at or time.perf_counter()) - self.started
+    # end def
+
+    def as_dict(self) -> Dict[str, Any]:
+        def ms(start, end):
+            return None if start is None or end is None else round((end - start) * 1000, 3)
+        # end def
+
+        return {
+            'chat_id': self.chat_id,
+            'user_id': self.user_id,
+            'from_state': self.from_state,
+            'to_state': self.to_state,
+            'transition': self.from_state != self.to_state,
+            'aborted': self.aborted,
+            'load_ms': ms(self.started, self.loaded_at),
+            'handle_ms': ms(self.loaded_at, self.handled_at),
+            'save_ms': ms(self.handled_at, self.stored_at),
+            'total_ms': ms(self.started, self.stored_at),
+            'loaded_bytes': data_size(self.loaded_data),
+            'stored_bytes': data_size(self.stored_data),
+        }
+    # end def
+# end class
+
+
+class StateTracer(object):
+    """
+    Decides which `UpdateTrace`s are emitted: a random `sample_rate` share of all updates,
+    plus every update slower than `slow_threshold` seconds.
+    Emitted traces are logged as one line (with the values as `extra={'telestate': {...}}` for structured handlers)
+    and passed to the `listeners`, e.g. to feed metrics.
+
+    The default traces nothing, so it costs a few `perf_counter()` calls per update.
+
+    >>> states.tracer = StateTracer(sample_rate=0.01, slow_threshold=2.0)
+    """
+    def __init__(
+        self,
+        sample_rate: float = 0.0,
+        slow_threshold: Optional[float] = None,
+        level: int = logging.INFO,
+        listeners: Optional[List[Callable[[Dict[str, Any]], None]]] = None,
+    ):
+        """
+        :param sample_rate: Share of updates to trace, between `0.0` (none) and `1.0` (all).
+        :param slow_threshold: Seconds after which an update is always traced. `None` to disable.
+        :param level: Log level of the trace lines.
+        :param listeners: Functions called with `UpdateTrace.as_dict()` of every emitted trace.
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.level = level
+        self.listeners = [] if listeners is None else listeners
+    # end def
+
+    def begin(self, chat_id: Union[int, str, None], user_id: Union[int, str, None]) -> UpdateTrace:
+        return UpdateTrace(chat_id, user_id)
+    # end def
+
+    def finish(self, trace: UpdateTrace) -> None:
+        slow = self.slow_threshold is not None and trace.duration > self.slow_threshold
+        sampled = self.sample_rate > 0 and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+        if not slow and not sampled:
+            return
+        # end if
+        log = logger.isEnabledFor(self.level)
+        if not log and not self.listeners:
+            return
+        # end if
+        values = trace.as_dict()
+        if log:
+            logger.log(
+                self.level,
+                '%s update of chat %r, user %r: %s -> %s in %sms (load %sms, handlers %sms, save %sms), %s -> %s bytes.',
+                'Slow' if slow else 'Traced', values['chat_id'], values['user_id'],
+                values['from_state'], values['to_state'], values['total_ms'],
+                values['load_ms'], values['handle_ms'], values['save_ms'],
+                values['loaded_bytes'], values['stored_bytes'],
+                extra={'telestate': values},
+            )
+        # end if
+        for listener in self.listeners:
+            # noinspection PyBroadException
+            try:
+                listener(values)
+            except:
+                logger.exception(f'Trace listener {listener!r} failed.')
+            # end try
+        # end for
+    # end def
+# end class